@@ -2,6 +2,7 @@ import re
 import os
 import json
 from pathlib import Path
+from typing import Optional
 from fastapi import APIRouter, HTTPException, UploadFile, File
 from fastapi.responses import StreamingResponse
 
@@ -17,6 +18,8 @@ from schemas import (
     DocumentInfo,
     DocumentUploadResponse,
     DocumentDeleteResponse,
+    RetrievalHealthResponse,
+    MilvusLoadResponse,
 )
 from agent import chat_with_agent, chat_with_agent_stream, storage
 from document_loader import DocumentLoader
@@ -24,6 +27,8 @@ from parent_chunk_store import ParentChunkStore
 from milvus_writer import MilvusWriter
 from milvus_client import MilvusManager
 from embedding import EmbeddingService
+from rag_utils import get_retrieval_health
+from rag_pipeline import invalidate_semantic_cache, get_semantic_cache_stats, get_speculation_stats
 
 BASE_DIR = Path(__file__).resolve().parent
 DATA_DIR = BASE_DIR.parent / "data"
@@ -210,7 +215,8 @@ async def upload_document(file: UploadFile = File(...)):
             f.write(content)
 
         try:
-            new_docs = loader.load_document(str(file_path), filename)
+            pages = loader.load_pages(str(file_path), filename)
+            new_docs = loader.split_pages(pages)
         except Exception as doc_err:
             raise HTTPException(status_code=500, detail=f"文档处理失败: {doc_err}")
 
@@ -222,8 +228,24 @@ async def upload_document(file: UploadFile = File(...)):
         if not leaf_docs:
             raise HTTPException(status_code=500, detail="文档处理失败，未生成可检索叶子分块")
 
-        parent_chunk_store.upsert_documents(parent_docs)
-        milvus_writer.write_documents(leaf_docs)
+        # 叶子正文外置时叶子块也写入本地分块存储（先于 Milvus 写入，检索不会拿到无正文的 ID）
+        stored_docs = parent_docs + leaf_docs if milvus_manager.leaf_text_offload else parent_docs
+        parent_chunk_store.upsert_documents(stored_docs, pages=pages)
+        try:
+            milvus_writer.write_documents(leaf_docs)
+            milvus_writer.write_root_documents(parent_docs)
+        except Exception:
+            # Milvus 写入失败时撤回本地分块存储与已写入的部分向量，两边保持一致
+            try:
+                milvus_manager.delete(delete_expr)
+            except Exception:
+                pass
+            parent_chunk_store.delete_by_filename(filename)
+            raise
+        finally:
+            # 旧数据已删除，无论成败知识库都已变化；Milvus 写完后才递增代数，其他 worker 不会把旧索引的结果记到新代下
+            parent_chunk_store.bump_generation()
+            invalidate_semantic_cache()
 
         return DocumentUploadResponse(
             filename=filename,
@@ -248,6 +270,8 @@ async def delete_document(filename: str):
         delete_expr = f'filename == "{filename}"'
         result = milvus_manager.delete(delete_expr)
         parent_chunk_store.delete_by_filename(filename)
+        parent_chunk_store.bump_generation()
+        invalidate_semantic_cache()
 
         return DocumentDeleteResponse(
             filename=filename,
@@ -256,3 +280,42 @@ async def delete_document(filename: str):
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"删除文档失败: {str(e)}")
+
+
+@router.get("/metrics/retrieval", response_model=RetrievalHealthResponse)
+async def retrieval_metrics():
+    """检索后端健康状态（熔断器状态与是否处于降级模式）、语义缓存命中率及投机重写命中率"""
+    return RetrievalHealthResponse(
+        **get_retrieval_health(),
+        semantic_cache=get_semantic_cache_stats(),
+        speculation=get_speculation_stats(),
+    )
+
+
+@router.post("/milvus/load", response_model=MilvusLoadResponse)
+async def load_milvus_collections(apply_mmap: bool = False):
+    """加载向量集合到查询节点；apply_mmap=true 时先把 MILVUS_MMAP_* 配置应用到已有集合（会短暂释放集合）"""
+    try:
+        mmap = milvus_manager.apply_mmap_settings() if apply_mmap else None
+        return MilvusLoadResponse(load_state=milvus_manager.load(), mmap=mmap, message="集合已加载")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"加载集合失败: {str(e)}")
+
+
+@router.post("/milvus/release", response_model=MilvusLoadResponse)
+async def release_milvus_collections():
+    """从查询节点释放向量集合（释放期间检索降级 / 失败）"""
+    try:
+        return MilvusLoadResponse(load_state=milvus_manager.release(), message="集合已释放")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"释放集合失败: {str(e)}")
+
+
+@router.post("/milvus/warmup", response_model=MilvusLoadResponse)
+async def warm_up_milvus_collections(queries: Optional[int] = None):
+    """加载集合并执行预热查询"""
+    try:
+        result = milvus_manager.warm_up(queries)
+        return MilvusLoadResponse(load_state=result["load_state"], warm_up=result, message="预热完成")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"预热失败: {str(e)}")
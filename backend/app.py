@@ -1,17 +1,36 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
 import os
+import threading
 
 import api as api_module
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 FRONTEND_DIR = BASE_DIR / "frontend"
+# 启动后在后台加载并预热 Milvus 集合，避免重启后的首批查询承担冷启动延迟
+MILVUS_WARMUP_ON_STARTUP = os.getenv("MILVUS_WARMUP_ON_STARTUP", "true").lower() == "true"
+
+
+def _warm_up_milvus():
+    try:
+        api_module.milvus_manager.warm_up()
+    except Exception:
+        # Milvus 未就绪时不影响服务启动，检索链路自有熔断降级
+        pass
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    if MILVUS_WARMUP_ON_STARTUP:
+        threading.Thread(target=_warm_up_milvus, daemon=True).start()
+    yield
 
 
 def create_app() -> FastAPI:
-    app = FastAPI(title="Cute Cat Bot API")
+    app = FastAPI(title="Cute Cat Bot API", lifespan=_lifespan)
 
     app.add_middleware(
         CORSMiddleware,
@@ -0,0 +1,321 @@
+"""批量导入 - 首次大规模入库 / 重建索引时，把向量化后的叶子分块写成 Parquet 文件，经 Milvus bulk import 导入。
+
+逐批 insert 每 50 行一次 RPC，百万级分块会产生数万次调用并持续触发 segment 合并；
+批量导入由 Milvus 直接读取对象存储中的列式文件建 segment，适合初次加载与全量重建。
+进度按文件记录在 manifest 中（pending -> written -> importing -> imported），中断后重跑会跳过已完成的阶段。
+
+依赖 pymilvus[bulk_writer]（pyarrow、minio），仅在使用批量导入时需要安装。
+"""
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List
+
+from dotenv import load_dotenv
+from pymilvus import CollectionSchema
+
+from document_loader import DocumentLoader
+from milvus_client import MilvusManager
+from milvus_writer import MilvusWriter
+from parent_chunk_store import ParentChunkStore
+
+load_dotenv()
+
+# Milvus 所用对象存储（docker-compose 中的 MinIO），导入文件需上传到 Milvus 的 bucket 内
+MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT", "localhost:9000")
+MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY", "minioadmin")
+MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY", "minioadmin")
+MINIO_BUCKET = os.getenv("MINIO_BUCKET", "a-bucket")
+MINIO_SECURE = os.getenv("MINIO_SECURE", "false").lower() == "true"
+BULK_REMOTE_PATH = os.getenv("BULK_REMOTE_PATH", "bulk_ingest")
+# 并发调用嵌入 API 的线程数
+BULK_EMBED_WORKERS = int(os.getenv("BULK_EMBED_WORKERS", "4"))
+# 单个导入任务最多包含的文件组数（Milvus 限制为 1024）
+BULK_FILES_PER_JOB = int(os.getenv("BULK_FILES_PER_JOB", "512"))
+
+SUPPORTED_SUFFIXES = (".pdf", ".docx", ".doc", ".xlsx", ".xls")
+
+
+def _require_bulk_writer():
+    try:
+        from pymilvus.bulk_writer import BulkFileType, RemoteBulkWriter, bulk_import, get_import_progress
+    except ModuleNotFoundError as e:
+        raise RuntimeError(f"批量导入需要安装 pymilvus[bulk_writer]: {e}")
+    return BulkFileType, RemoteBulkWriter, bulk_import, get_import_progress
+
+
+def write_parquet(schema, rows: List[dict]) -> list:
+    """把行数据写成 Parquet 并上传到 Milvus 的对象存储，返回可提交给 bulk_import 的文件组。"""
+    BulkFileType, RemoteBulkWriter, _, _ = _require_bulk_writer()
+    connect_param = RemoteBulkWriter.S3ConnectParam(
+        endpoint=MINIO_ENDPOINT,
+        access_key=MINIO_ACCESS_KEY,
+        secret_key=MINIO_SECRET_KEY,
+        bucket_name=MINIO_BUCKET,
+        secure=MINIO_SECURE,
+    )
+    with RemoteBulkWriter(
+        schema=schema,
+        remote_path=BULK_REMOTE_PATH,
+        connect_param=connect_param,
+        file_type=BulkFileType.PARQUET,
+    ) as writer:
+        for row in rows:
+            writer.append_row(row)
+        writer.commit()
+        return writer.batch_files
+
+
+def import_files(milvus_url: str, collection_name: str, files: list, poll_interval: float = 5.0) -> None:
+    """提交导入任务并等待完成（不记录进度，供一次性导入使用），失败时抛出 RuntimeError。"""
+    _, _, bulk_import, get_import_progress = _require_bulk_writer()
+    for i in range(0, len(files), BULK_FILES_PER_JOB):
+        response = bulk_import(url=milvus_url, collection_name=collection_name, files=files[i:i + BULK_FILES_PER_JOB])
+        job_id = response.json()["data"]["jobId"]
+        while True:
+            data = get_import_progress(url=milvus_url, job_id=job_id).json().get("data", {})
+            state = data.get("state")
+            if state == "Completed":
+                break
+            if state == "Failed":
+                raise RuntimeError(f"导入任务 {job_id} 失败: {data.get('reason', 'import failed')}")
+            time.sleep(poll_interval)
+
+
+class BulkIngestManifest:
+    """批量导入进度记录（JSON 文件，整体原子替换）。"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.data: Dict[str, Any] = {"files": {}}
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+
+    @property
+    def files(self) -> Dict[str, dict]:
+        return self.data.setdefault("files", {})
+
+    def save(self) -> None:
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        tmp_path.replace(self.path)
+
+    def reset(self) -> None:
+        self.data = {"files": {}}
+        self.save()
+
+
+class BulkIngestor:
+    """文件夹级批量入库：解析分块 -> 写本地分块存储 -> 并发向量化 -> Parquet 上传 -> bulk import。"""
+
+    def __init__(
+        self,
+        milvus_manager: MilvusManager | None = None,
+        milvus_writer: MilvusWriter | None = None,
+        parent_chunk_store: ParentChunkStore | None = None,
+        loader: DocumentLoader | None = None,
+        manifest_path: Path | None = None,
+        batch_size: int = 64,
+        workers: int = BULK_EMBED_WORKERS,
+    ):
+        self.milvus_manager = milvus_manager or MilvusManager()
+        self.milvus_writer = milvus_writer or MilvusWriter(milvus_manager=self.milvus_manager)
+        self.parent_chunk_store = parent_chunk_store or ParentChunkStore()
+        self.loader = loader or DocumentLoader()
+        data_dir = Path(__file__).resolve().parent.parent / "data"
+        self.manifest = BulkIngestManifest(manifest_path or (data_dir / "bulk_ingest" / "manifest.json"))
+        self.batch_size = batch_size
+        self.workers = max(1, workers)
+        self.milvus_url = f"http://{self.milvus_manager.host}:{self.milvus_manager.port}"
+
+    @staticmethod
+    def _fingerprint(path: Path) -> str:
+        stat = path.stat()
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _sync_manifest(self, paths: List[Path]) -> None:
+        """文件内容变化（大小 / 修改时间）的条目退回 pending。"""
+        for path in paths:
+            fingerprint = self._fingerprint(path)
+            entry = self.manifest.files.get(path.name)
+            if entry is None or entry.get("fingerprint") != fingerprint:
+                self.manifest.files[path.name] = {"fingerprint": fingerprint, "status": "pending"}
+        self.manifest.save()
+
+    def _load_file(self, path: Path) -> tuple[list[dict], list[dict]]:
+        pages = self.loader.load_pages(str(path), path.name)
+        return pages, self.loader.split_pages(pages)
+
+    def _embed(self, leaf_docs: List[dict], server_bm25: bool) -> tuple[list, list | None]:
+        batches = [leaf_docs[i:i + self.batch_size] for i in range(0, len(leaf_docs), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(
+                lambda batch: self.milvus_writer.embed_batch([doc["text"] for doc in batch], server_bm25),
+                batches,
+            ))
+        dense = [vector for batch_dense, _ in results for vector in batch_dense]
+        if server_bm25:
+            return dense, None
+        return dense, [vector for _, batch_sparse in results for vector in batch_sparse]
+
+    def _write_file(self, path: Path, pages: List[dict], docs: List[dict], schema, server_bm25: bool) -> dict:
+        """单个文件：替换本地分块存储与 Milvus 旧数据，向量化后写成 Parquet 并上传，返回 manifest 条目更新。"""
+        # 缺少依赖时在删除旧数据之前失败
+        _require_bulk_writer()
+        parent_docs = [doc for doc in docs if int(doc.get("chunk_level", 0) or 0) in (1, 2)]
+        leaf_docs = [doc for doc in docs if int(doc.get("chunk_level", 0) or 0) == 3]
+        if not leaf_docs:
+            return {"status": "imported", "chunks": 0, "batch_files": []}
+
+        self.milvus_manager.delete(f'filename == {json.dumps(path.name, ensure_ascii=False)}')
+        self.parent_chunk_store.delete_by_filename(path.name)
+        stored_docs = parent_docs + leaf_docs if self.milvus_manager.leaf_text_offload else parent_docs
+        self.parent_chunk_store.upsert_documents(stored_docs, pages=pages)
+
+        dense, sparse = self._embed(leaf_docs, server_bm25)
+        rows = MilvusWriter.build_rows(leaf_docs, dense, sparse, self.milvus_manager.stores_leaf_text())
+        batch_files = write_parquet(schema, rows)
+
+        # 根块集合规模小，仍走逐批插入
+        self.milvus_writer.write_root_documents(parent_docs)
+        return {"status": "written", "chunks": len(leaf_docs), "batch_files": batch_files}
+
+    def _submit_imports(self) -> None:
+        written = [(name, entry) for name, entry in self.manifest.files.items() if entry.get("status") == "written"]
+        if not written:
+            return
+        _, _, bulk_import, _ = _require_bulk_writer()
+        for i in range(0, len(written), BULK_FILES_PER_JOB):
+            group = written[i:i + BULK_FILES_PER_JOB]
+            files = [batch for _, entry in group for batch in entry.get("batch_files", [])]
+            response = bulk_import(url=self.milvus_url, collection_name=self.milvus_manager.collection_name, files=files)
+            job_id = response.json()["data"]["jobId"]
+            for _, entry in group:
+                entry.update({"status": "importing", "job_id": job_id, "error": None})
+            self.manifest.save()
+
+    def _wait_imports(self, poll_interval: float) -> None:
+        pending_jobs = {
+            entry["job_id"] for entry in self.manifest.files.values()
+            if entry.get("status") == "importing" and entry.get("job_id")
+        }
+        if not pending_jobs:
+            return
+        _, _, _, get_import_progress = _require_bulk_writer()
+        while pending_jobs:
+            for job_id in list(pending_jobs):
+                data = get_import_progress(url=self.milvus_url, job_id=job_id).json().get("data", {})
+                state = data.get("state")
+                if state not in ("Completed", "Failed"):
+                    continue
+                pending_jobs.discard(job_id)
+                for entry in self.manifest.files.values():
+                    if entry.get("job_id") != job_id:
+                        continue
+                    if state == "Completed":
+                        entry["status"] = "imported"
+                    else:
+                        # 文件已在对象存储中，下次运行直接重新提交导入
+                        entry.update({"status": "written", "error": data.get("reason", "import failed")})
+                self.manifest.save()
+            if pending_jobs:
+                time.sleep(poll_interval)
+
+    def _fit_bm25(self, pending: List[Path]) -> List[str]:
+        """
+        Python 端 BM25：每次导入只拟合一次。逐个解析尚未计入统计的待处理文件并增量拟合（不在内存中保留解析结果），
+        拟合后的统计写入 manifest 与 BM25_STATS_PATH；断点续传时直接复用 manifest 中的统计，
+        保证同一次导入的所有文件按同一份统计编码稀疏向量。
+        :return: 解析失败的文件名
+        """
+        embedding_service = self.milvus_writer.embedding_service
+        if self.manifest.data.get("bm25_stats"):
+            embedding_service.load_stats(self.manifest.data["bm25_stats"])
+        to_fit = [path for path in pending if not self.manifest.files[path.name].get("bm25_fitted")]
+        if not to_fit:
+            embedding_service.save_stats()
+            return []
+
+        failed = []
+        for path in to_fit:
+            try:
+                _, docs = self._load_file(path)
+            except Exception as e:
+                failed.append(path.name)
+                self.manifest.files[path.name]["error"] = str(e)
+                continue
+            embedding_service.fit_corpus([
+                doc["text"] for doc in docs if int(doc.get("chunk_level", 0) or 0) == 3
+            ])
+            self.manifest.files[path.name]["bm25_fitted"] = True
+        # 先写 manifest：中断在两次写入之间时，重跑以 manifest 为准，不会重复计入
+        self.manifest.data["bm25_stats"] = embedding_service.export_stats()
+        self.manifest.save()
+        embedding_service.save_stats()
+        return failed
+
+    def run(self, folder: str, recreate: bool = False, poll_interval: float = 5.0) -> Dict[str, Any]:
+        """
+        导入文件夹下全部支持的文档，可重复执行（断点续传）
+        :param recreate: 删除并重建集合，清空 manifest、本地分块存储与 BM25 统计（全量重建索引）
+        :return: 各状态文件数、本次写入的叶子分块数与耗时
+        """
+        started = time.perf_counter()
+        if recreate:
+            self.milvus_manager.drop_collection()
+            self.manifest.reset()
+            self.parent_chunk_store.clear()
+            self.milvus_writer.embedding_service.reset_stats()
+        self.milvus_manager.init_collection()
+        server_bm25 = self.milvus_manager.uses_server_bm25()
+
+        paths = sorted(
+            path for path in Path(folder).iterdir()
+            if path.is_file() and path.name.lower().endswith(SUPPORTED_SUFFIXES)
+        )
+        self._sync_manifest(paths)
+        pending = [path for path in paths if self.manifest.files[path.name]["status"] == "pending"]
+
+        failed = [] if server_bm25 else self._fit_bm25(pending)
+
+        schema = None
+        if pending:
+            schema = CollectionSchema.construct_from_dict(
+                self.milvus_manager.client.describe_collection(self.milvus_manager.collection_name)
+            )
+        written_chunks = 0
+        for path in pending:
+            if path.name in failed:
+                continue
+            try:
+                pages, docs = self._load_file(path)
+                update = self._write_file(path, pages, docs, schema, server_bm25)
+            except Exception as e:
+                failed.append(path.name)
+                self.manifest.files[path.name]["error"] = str(e)
+                self.manifest.save()
+                continue
+            self.manifest.files[path.name].update({**update, "error": None})
+            self.manifest.save()
+            written_chunks += update["chunks"]
+
+        self._submit_imports()
+        self._wait_imports(poll_interval)
+        self.milvus_manager.load()
+        # bulk import 完成后叶子才可检索，此时才递增知识库代数
+        self.parent_chunk_store.bump_generation()
+
+        statuses: Dict[str, int] = {}
+        for entry in self.manifest.files.values():
+            statuses[entry["status"]] = statuses.get(entry["status"], 0) + 1
+        return {
+            "files": statuses,
+            "failed": failed,
+            "written_chunks": written_chunks,
+            "elapsed_s": round(time.perf_counter() - started, 1),
+        }
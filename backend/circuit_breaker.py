@@ -0,0 +1,60 @@
+"""熔断器 - 下游连续失败后在冷却期内直接跳过调用"""
+import threading
+import time
+
+
+class CircuitBreaker:
+    """连续失败 failure_threshold 次后熔断（open），冷却 cooldown 秒后放行一次探测（half_open），
+    探测成功恢复（closed），失败则重新熔断。"""
+
+    def __init__(self, name: str, failure_threshold: int = 3, cooldown: float = 30.0):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._last_error = None
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """是否允许本次调用；冷却结束后只放行一个探测请求。"""
+        with self._lock:
+            if self._state == "closed":
+                return True
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.cooldown:
+                self._state = "half_open"
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+            self._last_error = None
+
+    def record_failure(self, error: str | None = None) -> None:
+        with self._lock:
+            self._failures += 1
+            self._last_error = error
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                self._state = "open"
+                self._opened_at = time.monotonic()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            retry_in = 0.0
+            if self._state == "open":
+                retry_in = max(0.0, self.cooldown - (time.monotonic() - self._opened_at))
+            return {
+                "name": self.name,
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "retry_in_seconds": round(retry_in, 1),
+                "last_error": self._last_error,
+            }
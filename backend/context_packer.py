@@ -0,0 +1,168 @@
+"""上下文打包 - 近重复片段去除，按 token 预算挑选并裁剪检索片段"""
+import re
+from typing import Any, Dict, List, Tuple
+
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯＀-￯]")
+_WORD_RE = re.compile(r"[A-Za-z0-9_]+|[^\sA-Za-z0-9_぀-ヿ㐀-䶿一-鿿가-힯＀-￯]")
+# 句子边界：中英文句末标点与换行，标点保留在前一句
+_SENTENCE_RE = re.compile(r"[^。！？!?；;\n]*(?:[。！？!?；;\n]+|$)")
+_SPACE_RE = re.compile(r"\s+")
+# 字符级 shingle 长度，对中文与英文都适用
+SHINGLE_SIZE = 5
+
+
+def estimate_tokens(text: str) -> int:
+    """不依赖分词器的 token 数估算：CJK 字符约 1 token/字，英文单词约 1.3 token/词，标点 1 token。"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    words = _WORD_RE.findall(text)
+    latin = sum(1 for word in words if word[0].isalnum() or word[0] == "_")
+    return cjk + int(latin * 1.3 + 0.5) + (len(words) - latin)
+
+
+def chunk_tokens(doc: dict) -> int:
+    """优先使用入库时记录的 token_count，历史数据现场估算。"""
+    count = doc.get("token_count")
+    if isinstance(count, int) and count > 0:
+        return count
+    return estimate_tokens(doc.get("text", ""))
+
+
+def _sentences(text: str) -> List[Tuple[int, int]]:
+    return [(m.start(), m.end()) for m in _SENTENCE_RE.finditer(text) if m.end() > m.start()]
+
+
+def trim_to_matches(doc: dict, neighbors: int = 1) -> dict | None:
+    """把合并得到的父块裁剪为命中叶子所在句子及前后 neighbors 句；无法定位命中区间时返回 None。"""
+    text = doc.get("text", "")
+    spans = doc.get("matched_spans") or []
+    if not text or not spans:
+        return None
+    sentences = _sentences(text)
+    keep = set()
+    for start, end in spans:
+        for idx, (s_start, s_end) in enumerate(sentences):
+            if s_start < end and s_end > start:
+                keep.update(range(max(0, idx - neighbors), min(len(sentences), idx + neighbors + 1)))
+    if not keep or len(keep) == len(sentences):
+        return None
+
+    parts = []
+    previous = None
+    for idx in sorted(keep):
+        if previous is not None and idx != previous + 1:
+            parts.append("……")
+        s_start, s_end = sentences[idx]
+        parts.append(text[s_start:s_end].strip())
+        previous = idx
+    trimmed_text = "".join(part for part in parts if part)
+    trimmed = {**doc, "text": trimmed_text, "token_count": estimate_tokens(trimmed_text), "context_trimmed": True}
+    return trimmed
+
+
+def _shingles(text: str) -> set:
+    normalized = _SPACE_RE.sub("", text or "")
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized} if normalized else set()
+    return {hash(normalized[i:i + SHINGLE_SIZE]) for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def _is_ancestor(doc: dict, other: dict) -> bool:
+    chunk_id = doc.get("chunk_id")
+    return bool(chunk_id) and chunk_id != other.get("chunk_id") and chunk_id in (
+        other.get("parent_chunk_id"),
+        other.get("root_chunk_id"),
+    )
+
+
+def suppress_near_duplicates(docs: List[dict], threshold: float = 0.8) -> Tuple[List[dict], int]:
+    """按排名顺序去除已被其他入选片段覆盖的片段，返回 (保留的片段, 去除个数)。
+    - 层级包含：入选片段的祖先块会取代它（占据其中排名最高者的位置），祖先已入选时子孙块直接去除；
+    - 文本覆盖：片段的字符 shingle 有 threshold 以上已出现在入选片段中时去除（兄弟窗口重叠、跨文件重复等）。
+    threshold <= 0 时只去除完全相同的片段。"""
+    selected: List[dict] = []
+    selected_shingles: List[set] = []
+    seen_texts = set()
+    dropped = 0
+    for doc in docs:
+        text_key = (doc.get("filename"), doc.get("page_number"), doc.get("text"))
+        if text_key in seen_texts:
+            dropped += 1
+            continue
+        if threshold <= 0:
+            seen_texts.add(text_key)
+            selected.append(doc)
+            continue
+
+        if any(_is_ancestor(item, doc) for item in selected):
+            dropped += 1
+            continue
+        shingles = _shingles(doc.get("text", ""))
+        descendants = [idx for idx, item in enumerate(selected) if _is_ancestor(doc, item)]
+        if descendants:
+            # 祖先块完整包含这些子孙块：放到排名最高的子孙块位置，其余子孙块去除
+            first = descendants[0]
+            for idx in reversed(descendants[1:]):
+                del selected[idx]
+                del selected_shingles[idx]
+            selected[first] = doc
+            selected_shingles[first] = shingles
+            dropped += len(descendants)
+            seen_texts.add(text_key)
+            continue
+
+        if shingles:
+            covered = set().union(*selected_shingles) & shingles if selected_shingles else set()
+            if len(covered) / len(shingles) >= threshold:
+                dropped += 1
+                continue
+        seen_texts.add(text_key)
+        selected.append(doc)
+        selected_shingles.append(shingles)
+    return selected, dropped
+
+
+def pack_context(docs: List[dict], budget: int, neighbors: int = 1) -> Tuple[List[dict], Dict[str, Any]]:
+    """按排名顺序把片段装入 token 预算。超出预算时先把合并父块裁剪到命中句附近，
+    再按排名贪心装入，放不下的片段跳过（让位给后面更短的片段）。budget <= 0 表示不限。"""
+    total = sum(chunk_tokens(doc) for doc in docs)
+    meta: Dict[str, Any] = {
+        "context_token_budget": budget if budget > 0 else None,
+        "context_tokens_before": total,
+        "context_tokens": total,
+        "context_trimmed_chunks": 0,
+        "context_dropped_chunks": 0,
+    }
+    if budget <= 0 or total <= budget:
+        return docs, meta
+
+    candidates = []
+    for doc in docs:
+        trimmed = trim_to_matches(doc, neighbors) if doc.get("merged_from_children") else None
+        candidates.append(trimmed or doc)
+
+    packed: List[dict] = []
+    used = 0
+    for doc in candidates:
+        tokens = chunk_tokens(doc)
+        if used + tokens > budget:
+            continue
+        packed.append(doc)
+        used += tokens
+
+    if not packed and candidates:
+        # 预算连排名第一的片段都放不下时，仍保留它的前缀，避免上下文为空
+        first = candidates[0]
+        text = first.get("text", "")
+        ratio = budget / max(chunk_tokens(first), 1)
+        cut = text[: max(1, int(len(text) * ratio))]
+        packed = [{**first, "text": cut, "token_count": estimate_tokens(cut), "context_trimmed": True}]
+        used = packed[0]["token_count"]
+
+    meta.update({
+        "context_tokens": used,
+        "context_trimmed_chunks": sum(1 for doc in packed if doc.get("context_trimmed")),
+        "context_dropped_chunks": len(docs) - len(packed),
+    })
+    return packed, meta
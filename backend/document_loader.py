@@ -4,6 +4,8 @@ from typing import Dict, List
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, UnstructuredExcelLoader
 
+from context_packer import estimate_tokens
+
 
 class DocumentLoader:
     """文档加载和分片服务"""
@@ -40,6 +42,26 @@ class DocumentLoader:
     def _build_chunk_id(filename: str, page_number: int, level: int, index: int) -> str:
         return f"{filename}::p{page_number}::l{level}::{index}"
 
+    @staticmethod
+    def _build_page_id(filename: str, page_ordinal: int) -> str:
+        return f"{filename}::page{page_ordinal}"
+
+    @staticmethod
+    def _locate_span(source_text: str, source_start: int, split_doc, chunk_text: str) -> tuple[int, int]:
+        """根据 add_start_index 计算分块在整页文本中的绝对区间，无法定位时返回 (-1, -1)。"""
+        if source_start < 0:
+            return -1, -1
+        content = split_doc.page_content or ""
+        local_start = split_doc.metadata.get("start_index", -1)
+        if local_start is None or local_start < 0:
+            local_start = source_text.find(chunk_text)
+        else:
+            local_start += len(content) - len(content.lstrip())
+        if local_start < 0:
+            return -1, -1
+        start = source_start + local_start
+        return start, start + len(chunk_text)
+
     def _split_page_to_three_levels(
         self,
         text: str,
@@ -64,6 +86,7 @@ class DocumentLoader:
                 continue
             level_1_id = self._build_chunk_id(filename, page_number, 1, level_1_counter)
             level_1_counter += 1
+            level_1_start, level_1_end = self._locate_span(text, 0, level_1_doc, level_1_text)
 
             level_1_chunk = {
                 **base_doc,
@@ -73,17 +96,22 @@ class DocumentLoader:
                 "root_chunk_id": level_1_id,
                 "chunk_level": 1,
                 "chunk_idx": page_global_chunk_idx,
+                "start_index": level_1_start,
+                "end_index": level_1_end,
+                "token_count": estimate_tokens(level_1_text),
             }
             page_global_chunk_idx += 1
             root_chunks.append(level_1_chunk)
 
             level_2_docs = self._splitter_level_2.create_documents([level_1_text], [base_doc])
+            level_1_children = 0
             for level_2_doc in level_2_docs:
                 level_2_text = (level_2_doc.page_content or "").strip()
                 if not level_2_text:
                     continue
                 level_2_id = self._build_chunk_id(filename, page_number, 2, level_2_counter)
                 level_2_counter += 1
+                level_2_start, level_2_end = self._locate_span(level_1_text, level_1_start, level_2_doc, level_2_text)
 
                 level_2_chunk = {
                     **base_doc,
@@ -93,17 +121,23 @@ class DocumentLoader:
                     "root_chunk_id": level_1_id,
                     "chunk_level": 2,
                     "chunk_idx": page_global_chunk_idx,
+                    "start_index": level_2_start,
+                    "end_index": level_2_end,
+                    "token_count": estimate_tokens(level_2_text),
                 }
                 page_global_chunk_idx += 1
                 root_chunks.append(level_2_chunk)
+                level_1_children += 1
 
                 level_3_docs = self._splitter_level_3.create_documents([level_2_text], [base_doc])
+                level_2_children = 0
                 for level_3_doc in level_3_docs:
                     level_3_text = (level_3_doc.page_content or "").strip()
                     if not level_3_text:
                         continue
                     level_3_id = self._build_chunk_id(filename, page_number, 3, level_3_counter)
                     level_3_counter += 1
+                    level_3_start, level_3_end = self._locate_span(level_2_text, level_2_start, level_3_doc, level_3_text)
                     root_chunks.append({
                         **base_doc,
                         "text": level_3_text,
@@ -112,17 +146,24 @@ class DocumentLoader:
                         "root_chunk_id": level_1_id,
                         "chunk_level": 3,
                         "chunk_idx": page_global_chunk_idx,
+                        "start_index": level_3_start,
+                        "end_index": level_3_end,
+                        "token_count": estimate_tokens(level_3_text),
                     })
                     page_global_chunk_idx += 1
+                    level_2_children += 1
+                # 子块数量供自动合并按覆盖率判断
+                level_2_chunk["child_count"] = level_2_children
+            level_1_chunk["child_count"] = level_1_children
 
         return root_chunks
 
-    def load_document(self, file_path: str, filename: str) -> list[dict]:
+    def load_pages(self, file_path: str, filename: str) -> list[dict]:
         """
-        加载单个文档并分片
+        加载单个文档的整页文本（不分片），供分片与父级分块区间存储共用
         :param file_path: 文件路径
         :param filename: 文件名
-        :return: 分片后的文档列表
+        :return: 页面列表，每页包含 page_id / page_number / text 等字段
         """
         file_lower = filename.lower()
 
@@ -140,17 +181,40 @@ class DocumentLoader:
 
         try:
             raw_docs = loader.load()
+        except Exception as e:
+            raise Exception(f"处理文档失败: {str(e)}")
+
+        return [
+            {
+                "page_id": self._build_page_id(filename, page_ordinal),
+                "filename": filename,
+                "file_path": file_path,
+                "file_type": doc_type,
+                "page_number": doc.metadata.get("page", 0),
+                "text": (doc.page_content or "").strip(),
+            }
+            for page_ordinal, doc in enumerate(raw_docs)
+        ]
+
+    def split_pages(self, pages: list[dict]) -> list[dict]:
+        """
+        对 load_pages 的结果执行三级分块
+        :param pages: 页面列表
+        :return: 分片后的文档列表
+        """
+        try:
             documents = []
             page_global_chunk_idx = 0
-            for doc in raw_docs:
+            for page in pages:
                 base_doc = {
-                    "filename": filename,
-                    "file_path": file_path,
-                    "file_type": doc_type,
-                    "page_number": doc.metadata.get("page", 0),
+                    "filename": page["filename"],
+                    "file_path": page["file_path"],
+                    "file_type": page["file_type"],
+                    "page_number": page["page_number"],
+                    "page_id": page["page_id"],
                 }
                 page_chunks = self._split_page_to_three_levels(
-                    text=(doc.page_content or "").strip(),
+                    text=page["text"],
                     base_doc=base_doc,
                     page_global_chunk_idx=page_global_chunk_idx,
                 )
@@ -160,6 +224,15 @@ class DocumentLoader:
         except Exception as e:
             raise Exception(f"处理文档失败: {str(e)}")
 
+    def load_document(self, file_path: str, filename: str) -> list[dict]:
+        """
+        加载单个文档并分片
+        :param file_path: 文件路径
+        :param filename: 文件名
+        :return: 分片后的文档列表
+        """
+        return self.split_pages(self.load_pages(file_path, filename))
+
     def load_documents_from_folder(self, folder_path: str) -> list[dict]:
         """
         从文件夹加载所有文档并分片
@@ -1,18 +1,39 @@
 """文本向量化服务 - 支持密集向量和稀疏向量（BM25）"""
 import os
 import re
+import json
 import math
+import threading
 import requests
 from collections import Counter
+from pathlib import Path
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# BM25 语料统计（词汇表、文档频率）落盘位置，入库进程与检索进程共用同一份词汇表
+BM25_STATS_PATH = Path(os.getenv(
+    "BM25_STATS_PATH",
+    str(Path(__file__).resolve().parent.parent / "data" / "bm25_stats.json"),
+))
+
+# 高频虚字：几乎出现在每个分块中，倒排索引里对应的 posting list 最长而区分度最低。
+# 只收助词 / 连词，"有""中" 等常组成实词的字不在其列，可用 SPARSE_STOP_CHARS 覆盖
+DEFAULT_STOP_CHARS = "的了着过吗呢吧啊呀之其而及与或且"
+_SPARSE_RUN_RE = re.compile(r'[\u4e00-\u9fff]+|[a-zA-Z]+')
+
 
 class EmbeddingService:
     """文本向量化服务 - 支持密集向量和稀疏向量"""
 
-    def __init__(self):
+    def __init__(
+        self,
+        cjk_ngram: int | None = None,
+        drop_stop_chars: bool | None = None,
+        doc_top_n: int | None = None,
+        query_top_n: int | None = None,
+        persist_stats: bool = True,
+    ):
         self.base_url = os.getenv("BASE_URL")
         self.embedder = os.getenv("EMBEDDER")
         self.api_key = os.getenv("ARK_API_KEY")
@@ -20,20 +41,136 @@ class EmbeddingService:
         # BM25 参数
         self.k1 = 1.5  # 词频饱和参数
         self.b = 0.75  # 文档长度归一化参数
+
+        # 稀疏编码参数（参数缺省时读取环境变量，便于基准脚本逐组对比）
+        # 中文切分粒度：1 为单字，2 为相邻双字（bigram），posting list 更短
+        self.cjk_ngram = cjk_ngram if cjk_ngram is not None else int(os.getenv("SPARSE_CJK_NGRAM", "1"))
+        if drop_stop_chars is None:
+            drop_stop_chars = os.getenv("SPARSE_DROP_STOP_CHARS", "false").lower() == "true"
+        self.stop_chars = set(os.getenv("SPARSE_STOP_CHARS", DEFAULT_STOP_CHARS)) if drop_stop_chars else set()
+        # 每个文档 / 查询只保留权重最高的 N 个词，0 表示不裁剪
+        self.doc_top_n = doc_top_n if doc_top_n is not None else int(os.getenv("SPARSE_DOC_TOP_N", "0"))
+        self.query_top_n = query_top_n if query_top_n is not None else int(os.getenv("SPARSE_QUERY_TOP_N", "0"))
+        # 双字切分下查询中的孤立单字（如单字查询）只产生单字词项，匹配不到按双字入库的文档；
+        # 查询侧把它扩展为语料中含该字的双字（按文档频率取前 N 个），0 表示不扩展
+        self.single_char_expand = int(os.getenv("SPARSE_SINGLE_CHAR_EXPAND", "32"))
         
         # 词汇表（用于将词映射到稀疏向量索引）
         self._vocab = {}
         self._vocab_counter = 0
+        # 并发检索（如 HyDE 与 step-back 分支）会同时扩充词汇表
+        self._vocab_lock = threading.Lock()
         
         # 文档频率统计（用于 IDF 计算）
         self._doc_freq = Counter()
         self._total_docs = 0
+        self._total_len = 0
         self._avg_doc_len = 0
+        # 单字 -> 语料中含该字的双字词项，供查询侧单字扩展
+        self._char_bigrams: dict[str, set[str]] = {}
+
+        # persist_stats=False 时统计只留在进程内（如基准脚本逐组拟合），不读写 BM25_STATS_PATH
+        self._stats_path = BM25_STATS_PATH if persist_stats else None
+        self._stats_mtime = None
+        self._sync_stats()
+
+    def export_stats(self) -> dict:
+        """导出 BM25 语料统计（可 JSON 序列化）"""
+        with self._vocab_lock:
+            return {
+                "vocab": dict(self._vocab),
+                "vocab_counter": self._vocab_counter,
+                "doc_freq": dict(self._doc_freq),
+                "total_docs": self._total_docs,
+                "total_len": self._total_len,
+                "avg_doc_len": self._avg_doc_len,
+                "cjk_ngram": self.cjk_ngram,
+                "stop_chars": "".join(sorted(self.stop_chars)),
+            }
+
+    def check_stats_config(self, stats: dict):
+        """统计的切分配置（cjk_ngram / 停用字）与当前配置不一致时抛出 ValueError，词项对不上无法复用。"""
+        if "cjk_ngram" in stats and int(stats["cjk_ngram"]) != self.cjk_ngram:
+            raise ValueError(f"BM25 统计的 cjk_ngram={stats['cjk_ngram']}，当前 SPARSE_CJK_NGRAM={self.cjk_ngram}")
+        if "stop_chars" in stats and stats["stop_chars"] != "".join(sorted(self.stop_chars)):
+            raise ValueError("BM25 统计的停用字与当前 SPARSE_DROP_STOP_CHARS / SPARSE_STOP_CHARS 不一致")
+
+    def load_stats(self, stats: dict):
+        """载入 export_stats 导出的统计，替换当前词汇表与文档频率"""
+        self.check_stats_config(stats)
+        vocab = {token: int(idx) for token, idx in stats.get("vocab", {}).items()}
+        total_docs = int(stats.get("total_docs", 0))
+        avg_doc_len = float(stats.get("avg_doc_len", 0))
+        with self._vocab_lock:
+            self._vocab = vocab
+            self._vocab_counter = int(stats.get("vocab_counter", len(vocab)))
+            self._doc_freq = Counter(stats.get("doc_freq", {}))
+            self._total_docs = total_docs
+            self._total_len = int(stats.get("total_len", round(avg_doc_len * total_docs)))
+            self._avg_doc_len = avg_doc_len
+            self._char_bigrams = {}
+            for token in self._doc_freq:
+                self._index_bigram(token)
+        # 显式载入的统计优先于磁盘上的当前版本，之后文件再有更新才重新同步
+        if self._stats_path is not None and self._stats_path.exists():
+            self._stats_mtime = self._stats_path.stat().st_mtime_ns
+
+    def stats_summary(self) -> dict:
+        """统计概况：persisted 为 False 时检索进程没有可用的词汇表，client 模式下查询稀疏向量无法命中已入库的词项。"""
+        with self._vocab_lock:
+            summary = {"total_docs": self._total_docs, "vocab_size": len(self._vocab)}
+        summary["persisted"] = self._stats_path is not None and self._stats_path.exists()
+        summary["path"] = str(self._stats_path) if self._stats_path is not None else None
+        return summary
+
+    def reset_stats(self):
+        """清空统计并落盘（重建集合时调用，旧文档的词频不再计入）"""
+        with self._vocab_lock:
+            self._vocab = {}
+            self._vocab_counter = 0
+            self._doc_freq = Counter()
+            self._total_docs = 0
+            self._total_len = 0
+            self._avg_doc_len = 0
+            self._char_bigrams = {}
+        self.save_stats()
+
+    def save_stats(self):
+        """把当前统计写入 BM25_STATS_PATH（整体原子替换）"""
+        if self._stats_path is None:
+            return
+        self._stats_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._stats_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.export_stats(), f, ensure_ascii=False)
+        tmp_path.replace(self._stats_path)
+        self._stats_mtime = self._stats_path.stat().st_mtime_ns
+
+    def _sync_stats(self):
+        """统计文件被其他进程 / 实例更新（上传、快照导入）后重新载入。"""
+        if self._stats_path is None:
+            return
+        try:
+            mtime = self._stats_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._stats_mtime:
+            return
+        try:
+            with open(self._stats_path, "r", encoding="utf-8") as f:
+                self.load_stats(json.load(f))
+        except OSError:
+            return
+        except ValueError:
+            # 切分配置已变更（需重新入库）或文件损坏：保留当前统计，同一版本文件不再重复读取
+            pass
+        self._stats_mtime = mtime
 
-    def get_embeddings(self, texts: list[str]) -> list[list[float]]:
+    def get_embeddings(self, texts: list[str], timeout: float | None = None) -> list[list[float]]:
         """
         调用嵌入 API 生成密集向量
         :param texts: 待转换的文本列表（支持批量）
+        :param timeout: 请求超时（秒），None 表示不限
         :return: 向量列表
         """
         headers = {
@@ -47,7 +184,7 @@ class EmbeddingService:
         }
 
         try:
-            response = requests.post(f"{self.base_url}/embeddings", headers=headers, json=data)
+            response = requests.post(f"{self.base_url}/embeddings", headers=headers, json=data, timeout=timeout)
             response.raise_for_status()
             result = response.json()
             return [item["embedding"] for item in result["data"]]
@@ -88,47 +225,102 @@ class EmbeddingService:
         
         return tokens
 
+    def sparse_terms(self, text: str) -> list[str]:
+        """
+        稀疏向量使用的词项：与 tokenize 一致地抽取中文与英文，去除停用字，并按 cjk_ngram 把连续中文切成双字
+        :param text: 输入文本
+        :return: 词项列表
+        """
+        terms = []
+        for match in _SPARSE_RUN_RE.finditer(text.lower()):
+            run = match.group()
+            if run[0].isascii():
+                terms.append(run)
+                continue
+            # 停用字把中文串切成若干段，每段单独生成 n-gram，避免 "的" 等虚字拼进双字词
+            segment = ""
+            for char in run + " ":
+                if char != " " and char not in self.stop_chars:
+                    segment += char
+                    continue
+                if self.cjk_ngram >= 2 and len(segment) >= 2:
+                    terms.extend(segment[i:i + 2] for i in range(len(segment) - 1))
+                else:
+                    terms.extend(segment)
+                segment = ""
+        return terms
+
+    def _index_bigram(self, token: str):
+        """把中文双字词项登记到两个字的扩展索引（调用方持有 _vocab_lock）"""
+        if self.cjk_ngram < 2 or len(token) != 2 or token.isascii():
+            return
+        for char in set(token):
+            self._char_bigrams.setdefault(char, set()).add(token)
+
+    def _expand_single_char(self, char: str) -> list[str]:
+        """语料中含该字的双字词项，按文档频率取前 single_char_expand 个"""
+        with self._vocab_lock:
+            bigrams = list(self._char_bigrams.get(char, ()))
+            bigrams.sort(key=lambda token: (-self._doc_freq.get(token, 0), token))
+        return bigrams[:self.single_char_expand]
+
     def fit_corpus(self, texts: list[str]):
         """
-        拟合语料库，计算 IDF 和平均文档长度
-        :param texts: 文档列表
+        增量拟合语料库：文档数、总词项数与文档频率都在已有统计上累加，IDF 与平均文档长度随之更新。
+        删除文档不回退统计；重建集合时先调用 reset_stats
+        :param texts: 新增文档列表
         """
-        self._total_docs = len(texts)
-        total_len = 0
-        
+        self._sync_stats()
+        doc_terms, total_len = [], 0
         for text in texts:
-            tokens = self.tokenize(text)
+            tokens = self.sparse_terms(text)
             total_len += len(tokens)
-            
-            # 统计文档频率（每个词在多少文档中出现）
-            unique_tokens = set(tokens)
-            for token in unique_tokens:
-                self._doc_freq[token] += 1
-                
-                # 建立词汇表
-                if token not in self._vocab:
-                    self._vocab[token] = self._vocab_counter
-                    self._vocab_counter += 1
-        
-        self._avg_doc_len = total_len / self._total_docs if self._total_docs > 0 else 1
+            doc_terms.append(set(tokens))
+
+        with self._vocab_lock:
+            for unique_tokens in doc_terms:
+                # 统计文档频率（每个词在多少文档中出现）
+                for token in unique_tokens:
+                    if token not in self._doc_freq:
+                        self._index_bigram(token)
+                    self._doc_freq[token] += 1
 
-    def get_sparse_embedding(self, text: str) -> dict:
+                    # 建立词汇表
+                    if token not in self._vocab:
+                        self._vocab[token] = self._vocab_counter
+                        self._vocab_counter += 1
+
+            self._total_docs += len(texts)
+            self._total_len += total_len
+            self._avg_doc_len = self._total_len / self._total_docs if self._total_docs > 0 else 1
+
+    def get_sparse_embedding(self, text: str, top_n: int | None = None, query: bool = True) -> dict:
         """
         生成 BM25 稀疏向量
         :param text: 输入文本
+        :param top_n: 只保留权重最高的 N 个词，缺省为查询侧配置 SPARSE_QUERY_TOP_N（0 表示不裁剪）
+        :param query: 查询侧编码，双字切分下孤立单字扩展为语料中含该字的双字
         :return: 稀疏向量 {index: value, ...}
         """
-        tokens = self.tokenize(text)
+        self._sync_stats()
+        tokens = self.sparse_terms(text)
         doc_len = len(tokens)
         tf = Counter(tokens)
+        if query and self.cjk_ngram >= 2 and self.single_char_expand > 0:
+            for token, freq in list(tf.items()):
+                if len(token) == 1 and not token.isascii():
+                    for bigram in self._expand_single_char(token):
+                        tf[bigram] = max(tf[bigram], freq)
         
         sparse_vector = {}
         
         for token, freq in tf.items():
             if token not in self._vocab:
-                # 新词加入词汇表
-                self._vocab[token] = self._vocab_counter
-                self._vocab_counter += 1
+                with self._vocab_lock:
+                    if token not in self._vocab:
+                        # 新词加入词汇表
+                        self._vocab[token] = self._vocab_counter
+                        self._vocab_counter += 1
             
             idx = self._vocab[token]
             
@@ -147,16 +339,21 @@ class EmbeddingService:
             
             if score > 0:
                 sparse_vector[idx] = float(score)
+
+        top_n = self.query_top_n if top_n is None else top_n
+        if top_n > 0 and len(sparse_vector) > top_n:
+            kept = sorted(sparse_vector.items(), key=lambda item: item[1], reverse=True)[:top_n]
+            sparse_vector = dict(kept)
         
         return sparse_vector
 
     def get_sparse_embeddings(self, texts: list[str]) -> list[dict]:
         """
-        批量生成 BM25 稀疏向量
+        批量生成文档的 BM25 稀疏向量（按 SPARSE_DOC_TOP_N 裁剪）
         :param texts: 文本列表
         :return: 稀疏向量列表
         """
-        return [self.get_sparse_embedding(text) for text in texts]
+        return [self.get_sparse_embedding(text, top_n=self.doc_top_n, query=False) for text in texts]
 
     def get_all_embeddings(self, texts: list[str]) -> tuple[list[list[float]], list[dict]]:
         """
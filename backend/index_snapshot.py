@@ -0,0 +1,431 @@
+"""索引快照 - 把建好的知识库导出为目录，在新环境（CI、预发、开发机）直接导入，无需重新解析文档、调用嵌入 API。
+
+快照目录结构：
+    manifest.json                 格式版本、集合名、向量维度、稀疏模式、嵌入模型与各部分条数
+    chunks.jsonl                  叶子集合的标量字段，一行一个分块，行号与向量文件的行一致
+    dense.npy                     叶子稠密向量 float32 [N, dim]，可 np.load(mmap_mode="r") 直接映射
+    sparse_indptr.npy / sparse_indices.npy / sparse_values.npy
+                                  叶子稀疏向量（CSR，仅 Python 端 BM25；服务端 BM25 由 Milvus 按 text 重新生成）
+    roots.jsonl / roots_dense.npy L1 根块集合（开启由粗到细检索时）
+    parent_chunks.jsonl / pages.jsonl
+                                  本地分块存储原样记录（span 模式保留区间，不展开正文）
+    bm25_stats.json               Python 端 BM25 词汇表与文档频率，导入后查询侧稀疏向量与入库时一致
+
+导出先写到 <目录>.partial，完成后整体改名；导出前后比对分块存储版本与叶子条数，期间有写入则重试，
+保证快照内向量、元数据与分块存储出自同一时刻。
+"""
+import json
+import os
+import shutil
+import time
+from array import array
+from datetime import datetime, timezone
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List
+
+import numpy as np
+from dotenv import load_dotenv
+from pymilvus import CollectionSchema
+
+from embedding import BM25_STATS_PATH, EmbeddingService
+from milvus_client import MilvusManager
+from parent_chunk_store import ParentChunkStore
+
+load_dotenv()
+
+SNAPSHOT_FORMAT_VERSION = 1
+# 导入时逐批 insert 的行数
+SNAPSHOT_INSERT_BATCH_SIZE = int(os.getenv("SNAPSHOT_INSERT_BATCH_SIZE", "500"))
+
+_QUERY_BATCH_SIZE = 1000
+
+# 叶子集合导出的标量字段及缺省值（token_count 为动态字段，早期数据可能没有）
+_CHUNK_FIELDS: Dict[str, Any] = {
+    "text": "",
+    "filename": "",
+    "file_type": "",
+    "file_path": "",
+    "page_number": 0,
+    "chunk_idx": 0,
+    "chunk_id": "",
+    "parent_chunk_id": "",
+    "root_chunk_id": "",
+    "chunk_level": 0,
+    "token_count": 0,
+}
+
+
+class _SnapshotChanged(Exception):
+    """导出期间知识库发生写入。"""
+
+
+def _batched(items: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _write_jsonl(path: Path, items: Iterable[dict]) -> int:
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for item in items:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def _read_jsonl(path: Path) -> Iterator[dict]:
+    if not path.exists():
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _jsonl_offsets(path: Path, key: str) -> Dict[str, int]:
+    """按 key 字段建立 JSONL 行的字节偏移索引，之后按需读取单行，不把整个文件留在内存中。"""
+    offsets: Dict[str, int] = {}
+    if not path.exists():
+        return offsets
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            if line.strip():
+                offsets[json.loads(line)[key]] = offset
+            offset += len(line)
+    return offsets
+
+
+def _read_jsonl_at(path: Path, offsets: Iterable[int]) -> Iterator[dict]:
+    with open(path, "rb") as f:
+        for offset in sorted(offsets):
+            f.seek(offset)
+            yield json.loads(f.readline())
+
+
+class IndexSnapshot:
+    """知识库索引快照的导出与导入。"""
+
+    def __init__(
+        self,
+        milvus_manager: MilvusManager | None = None,
+        parent_chunk_store: ParentChunkStore | None = None,
+        embedding_service: EmbeddingService | None = None,
+    ):
+        self.milvus_manager = milvus_manager or MilvusManager()
+        self.parent_chunk_store = parent_chunk_store or ParentChunkStore()
+        self.embedding_service = embedding_service or EmbeddingService()
+
+    @property
+    def client(self):
+        return self.milvus_manager.client
+
+    def _count(self, collection_name: str) -> int:
+        rows = self.client.query(
+            collection_name=collection_name,
+            filter="",
+            output_fields=["count(*)"],
+            consistency_level="Strong",
+        )
+        return int(rows[0]["count(*)"]) if rows else 0
+
+    def _dense_dim(self, collection_name: str) -> int:
+        for field in self.client.describe_collection(collection_name).get("fields", []):
+            if field.get("name") == "dense_embedding":
+                return int(field.get("params", {}).get("dim", 0))
+        raise ValueError(f"集合 {collection_name} 中没有 dense_embedding 字段")
+
+    def _iterate(self, collection_name: str, output_fields: List[str]) -> Iterator[dict]:
+        iterator = self.client.query_iterator(
+            collection_name=collection_name,
+            batch_size=_QUERY_BATCH_SIZE,
+            filter="",
+            output_fields=output_fields,
+        )
+        try:
+            while True:
+                batch = iterator.next()
+                if not batch:
+                    break
+                yield from batch
+        finally:
+            iterator.close()
+
+    # ---------------- 导出 ----------------
+
+    @staticmethod
+    def _save_csr(out: Path, indptr: array, indices: array, values: array) -> None:
+        np.save(out / "sparse_indptr.npy", np.frombuffer(indptr, dtype=np.int64))
+        np.save(out / "sparse_indices.npy", np.frombuffer(indices, dtype=np.uint32))
+        np.save(out / "sparse_values.npy", np.frombuffer(values, dtype=np.float32))
+
+    def _export_leaves(self, out: Path, dense_dim: int, with_sparse: bool) -> int:
+        """稠密向量按 count(*) 预分配 .npy 并逐行写入，标量字段写 chunks.jsonl，稀疏向量拼成 CSR。"""
+        name = self.milvus_manager.collection_name
+        total = self._count(name)
+        dense = np.lib.format.open_memmap(out / "dense.npy", mode="w+", dtype=np.float32, shape=(total, dense_dim))
+        indptr, indices, values = array("q", [0]), array("I"), array("f")
+        output_fields = ["dense_embedding", *_CHUNK_FIELDS] + (["sparse_embedding"] if with_sparse else [])
+        written = 0
+        with open(out / "chunks.jsonl", "w", encoding="utf-8") as f:
+            for row in self._iterate(name, output_fields):
+                if written >= total:
+                    raise _SnapshotChanged("叶子条数在导出期间增加")
+                dense[written] = row["dense_embedding"]
+                if with_sparse:
+                    for idx, value in sorted((int(k), float(v)) for k, v in (row.get("sparse_embedding") or {}).items()):
+                        indices.append(idx)
+                        values.append(value)
+                    indptr.append(len(indices))
+                record = {field: row.get(field, default) for field, default in _CHUNK_FIELDS.items()}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                written += 1
+        dense.flush()
+        del dense
+        if written != total:
+            raise _SnapshotChanged("叶子条数在导出期间减少")
+        if with_sparse:
+            self._save_csr(out, indptr, indices, values)
+        return total
+
+    def _export_roots(self, out: Path) -> int:
+        name = self.milvus_manager.root_collection_name
+        if not self.client.has_collection(name):
+            return 0
+        vectors, records = [], []
+        for row in self._iterate(name, ["dense_embedding", "filename", "chunk_id"]):
+            vectors.append(row["dense_embedding"])
+            records.append({"filename": row.get("filename", ""), "chunk_id": row.get("chunk_id", "")})
+        if not records:
+            return 0
+        np.save(out / "roots_dense.npy", np.asarray(vectors, dtype=np.float32))
+        return _write_jsonl(out / "roots.jsonl", records)
+
+    def _leaf_texts(self, out: Path) -> List[str]:
+        """按 chunks.jsonl 的行序取叶子正文，外置到本地分块存储的正文批量补全。"""
+        chunks = [(row["chunk_id"], row.get("text", "")) for row in _read_jsonl(out / "chunks.jsonl")]
+        missing = [chunk_id for chunk_id, text in chunks if not text]
+        found: Dict[str, str] = {}
+        for batch in _batched(missing, _QUERY_BATCH_SIZE):
+            for doc in self.parent_chunk_store.get_documents_by_ids(batch):
+                found[doc["chunk_id"]] = doc.get("text", "")
+        return [text or found.get(chunk_id, "") for chunk_id, text in chunks]
+
+    def _export_bm25_stats(self, out: Path) -> str:
+        """
+        复制入库时落盘的 BM25 统计；旧知识库没有统计文件时，按全部叶子正文重新拟合并重编码稀疏向量，
+        保证快照内文档向量与查询侧词汇表的下标一致（纯本地计算，不调用嵌入 API）。
+        """
+        if BM25_STATS_PATH.exists():
+            shutil.copyfile(BM25_STATS_PATH, out / "bm25_stats.json")
+            return "copied"
+        service = EmbeddingService(persist_stats=False)
+        texts = self._leaf_texts(out)
+        service.fit_corpus(texts)
+        indptr, indices, values = array("q", [0]), array("I"), array("f")
+        for batch in _batched(texts, _QUERY_BATCH_SIZE):
+            for vector in service.get_sparse_embeddings(batch):
+                for idx, value in sorted(vector.items()):
+                    indices.append(idx)
+                    values.append(value)
+                indptr.append(len(indices))
+        self._save_csr(out, indptr, indices, values)
+        with open(out / "bm25_stats.json", "w", encoding="utf-8") as f:
+            json.dump(service.export_stats(), f, ensure_ascii=False)
+        return "refit"
+
+    def _export_once(self, out: Path) -> Dict[str, Any]:
+        name = self.milvus_manager.collection_name
+        if not self.client.has_collection(name):
+            raise ValueError(f"集合 {name} 不存在，没有可导出的索引")
+        server_bm25 = self.milvus_manager.uses_server_bm25()
+        dense_dim = self._dense_dim(name)
+        version = self.parent_chunk_store.get_version()
+
+        leaves = self._export_leaves(out, dense_dim, with_sparse=not server_bm25)
+        roots = self._export_roots(out)
+        parent_chunks = _write_jsonl(out / "parent_chunks.jsonl", self.parent_chunk_store.export_records())
+        pages = _write_jsonl(out / "pages.jsonl", self.parent_chunk_store.export_pages())
+        bm25_stats = None if server_bm25 else self._export_bm25_stats(out)
+
+        if self.parent_chunk_store.get_version() != version or self._count(name) != leaves:
+            raise _SnapshotChanged("分块存储或叶子集合在导出期间发生变化")
+        return {
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "collection": name,
+            "dense_dim": dense_dim,
+            "sparse_mode": "bm25" if server_bm25 else "client",
+            "leaf_text_offload": self.milvus_manager.leaf_text_offload,
+            "embedder": self.embedding_service.embedder or "",
+            "knowledge_base_version": version,
+            "bm25_stats": bm25_stats,
+            "counts": {"leaves": leaves, "roots": roots, "parent_chunks": parent_chunks, "pages": pages},
+        }
+
+    def export_to(self, path: str, retries: int = 3) -> Dict[str, Any]:
+        """
+        导出快照到 path（目录须不存在）
+        :param retries: 导出期间知识库被写入时的重试次数
+        :return: manifest
+        """
+        target = Path(path)
+        if target.exists():
+            raise FileExistsError(f"快照目录已存在: {target}")
+        partial = target.with_name(target.name + ".partial")
+        for attempt in range(retries + 1):
+            shutil.rmtree(partial, ignore_errors=True)
+            partial.mkdir(parents=True)
+            try:
+                manifest = self._export_once(partial)
+            except _SnapshotChanged:
+                if attempt == retries:
+                    shutil.rmtree(partial, ignore_errors=True)
+                    raise RuntimeError("导出期间知识库持续有写入，请暂停上传后重试")
+                continue
+            except Exception:
+                shutil.rmtree(partial, ignore_errors=True)
+                raise
+            with open(partial / "manifest.json", "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            partial.replace(target)
+            return manifest
+
+    # ---------------- 导入 ----------------
+
+    @staticmethod
+    def _read_manifest(snapshot: Path) -> Dict[str, Any]:
+        manifest_path = snapshot / "manifest.json"
+        if not manifest_path.exists():
+            raise FileNotFoundError(f"不是有效的快照目录（缺少 manifest.json）: {snapshot}")
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"不支持的快照格式版本: {manifest.get('format_version')}")
+        return manifest
+
+    def _check_compatible(self, manifest: Dict[str, Any], stats: Dict[str, Any] | None) -> None:
+        """快照与当前配置不一致时拒绝导入，避免查询侧向量与库内向量不匹配。"""
+        if manifest["sparse_mode"] != self.milvus_manager.sparse_mode:
+            raise ValueError(
+                f"快照稀疏模式为 {manifest['sparse_mode']}，当前 MILVUS_SPARSE_MODE={self.milvus_manager.sparse_mode}"
+            )
+        if manifest["leaf_text_offload"] != self.milvus_manager.leaf_text_offload:
+            raise ValueError(
+                f"快照 LEAF_TEXT_OFFLOAD={str(manifest['leaf_text_offload']).lower()}，与当前配置不一致"
+            )
+        embedder = self.embedding_service.embedder or ""
+        if manifest.get("embedder") and embedder and manifest["embedder"] != embedder:
+            raise ValueError(f"快照嵌入模型为 {manifest['embedder']}，当前 EMBEDDER={embedder}")
+        if stats is not None:
+            self.embedding_service.check_stats_config(stats)
+
+    @staticmethod
+    def _leaf_rows(snapshot: Path, with_sparse: bool) -> Iterator[dict]:
+        """按行拼装叶子集合的插入数据，向量从 .npy 内存映射读取。"""
+        dense = np.load(snapshot / "dense.npy", mmap_mode="r")
+        if with_sparse:
+            indptr = np.load(snapshot / "sparse_indptr.npy")
+            indices = np.load(snapshot / "sparse_indices.npy", mmap_mode="r")
+            values = np.load(snapshot / "sparse_values.npy", mmap_mode="r")
+        for i, row in enumerate(_read_jsonl(snapshot / "chunks.jsonl")):
+            row["dense_embedding"] = dense[i].tolist()
+            if with_sparse:
+                start, end = int(indptr[i]), int(indptr[i + 1])
+                row["sparse_embedding"] = {
+                    int(idx): float(value) for idx, value in zip(indices[start:end], values[start:end])
+                }
+            yield row
+
+    def _import_leaves(self, snapshot: Path, with_sparse: bool, bulk: bool, poll_interval: float) -> None:
+        name = self.milvus_manager.collection_name
+        rows = self._leaf_rows(snapshot, with_sparse)
+        if bulk:
+            from bulk_ingest import import_files, write_parquet
+
+            schema = CollectionSchema.construct_from_dict(self.client.describe_collection(name))
+            milvus_url = f"http://{self.milvus_manager.host}:{self.milvus_manager.port}"
+            import_files(milvus_url, name, write_parquet(schema, rows), poll_interval)
+            return
+        for batch in _batched(rows, SNAPSHOT_INSERT_BATCH_SIZE):
+            self.milvus_manager.insert(batch)
+        self.client.flush(name)
+
+    def _import_roots(self, snapshot: Path, dense_dim: int) -> None:
+        self.milvus_manager.init_root_collection(dense_dim)
+        dense = np.load(snapshot / "roots_dense.npy", mmap_mode="r")
+        rows = (
+            {**record, "dense_embedding": dense[i].tolist()}
+            for i, record in enumerate(_read_jsonl(snapshot / "roots.jsonl"))
+        )
+        for batch in _batched(rows, SNAPSHOT_INSERT_BATCH_SIZE):
+            self.milvus_manager.insert_roots(batch)
+        self.client.flush(self.milvus_manager.root_collection_name)
+
+    def _import_chunk_store(self, snapshot: Path) -> None:
+        """分批流式恢复本地分块存储。SQLite 后端先写整页文本再写记录；JSON 后端不存整页文本，
+        每批只按偏移读取本批 span_only 记录用到的页，用于还原正文。"""
+        pages_path = snapshot / "pages.jsonl"
+        page_offsets: Dict[str, int] = {}
+        if self.parent_chunk_store.stores_pages:
+            for batch in _batched(_read_jsonl(pages_path), SNAPSHOT_INSERT_BATCH_SIZE):
+                self.parent_chunk_store.import_pages(batch)
+        else:
+            page_offsets = _jsonl_offsets(pages_path, "page_id")
+        for batch in _batched(_read_jsonl(snapshot / "parent_chunks.jsonl"), SNAPSHOT_INSERT_BATCH_SIZE):
+            page_texts = None
+            if page_offsets:
+                needed = {page_offsets[record["page_id"]] for record in batch
+                          if record.get("span_only") and record.get("page_id") in page_offsets}
+                page_texts = {page["page_id"]: page.get("text", "") for page in _read_jsonl_at(pages_path, needed)}
+            self.parent_chunk_store.import_records(batch, page_texts)
+
+    def import_from(self, path: str, recreate: bool = False, bulk: bool = False, poll_interval: float = 5.0) -> Dict[str, Any]:
+        """
+        从快照目录导入到 Milvus 与本地存储
+        :param recreate: 删除并重建集合、清空本地分块存储；不指定时叶子集合、根块集合与本地分块存储都必须为空
+        :param bulk: 叶子集合经 Parquet + bulk import 导入（需 pymilvus[bulk_writer]），适合大快照
+        :return: manifest 中的条数、导入耗时与集合加载状态
+        """
+        started = time.perf_counter()
+        snapshot = Path(path)
+        manifest = self._read_manifest(snapshot)
+        stats = None
+        if (snapshot / "bm25_stats.json").exists():
+            with open(snapshot / "bm25_stats.json", "r", encoding="utf-8") as f:
+                stats = json.load(f)
+        self._check_compatible(manifest, stats)
+        counts = manifest["counts"]
+
+        if recreate:
+            self.milvus_manager.drop_collection()
+            self.parent_chunk_store.clear()
+        else:
+            for name in (self.milvus_manager.collection_name, self.milvus_manager.root_collection_name):
+                if self.client.has_collection(name) and self._count(name) > 0:
+                    raise ValueError(f"集合 {name} 已有数据，使用 recreate 覆盖导入")
+            if not self.parent_chunk_store.is_empty():
+                raise ValueError("本地分块存储已有数据，使用 recreate 覆盖导入")
+
+        self.milvus_manager.init_collection(manifest["dense_dim"])
+        if counts["leaves"]:
+            self._import_leaves(snapshot, manifest["sparse_mode"] == "client", bulk, poll_interval)
+        if counts["roots"]:
+            self._import_roots(snapshot, manifest["dense_dim"])
+
+        self._import_chunk_store(snapshot)
+
+        if stats is not None:
+            self.embedding_service.load_stats(stats)
+            self.embedding_service.save_stats()
+        elif recreate:
+            self.embedding_service.reset_stats()
+        self.parent_chunk_store.bump_generation()
+
+        return {
+            "counts": counts,
+            "load_state": self.milvus_manager.load(),
+            "elapsed_s": round(time.perf_counter() - started, 1),
+        }
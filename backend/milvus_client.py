@@ -1,10 +1,26 @@
 """Milvus 客户端 - 支持密集向量+稀疏向量混合检索"""
+import json
 import os
+import time
 from dotenv import load_dotenv
-from pymilvus import MilvusClient, DataType, AnnSearchRequest, RRFRanker
+from pymilvus import MilvusClient, DataType, AnnSearchRequest, RRFRanker, Function, FunctionType
 
 load_dotenv()
 
+# 检索结果携带的字段（未开启叶子正文外置时）
+_RETRIEVE_OUTPUT_FIELDS = [
+    "text",
+    "filename",
+    "file_type",
+    "page_number",
+    "chunk_id",
+    "parent_chunk_id",
+    "root_chunk_id",
+    "chunk_level",
+    "chunk_idx",
+    "token_count",
+]
+
 
 class MilvusManager:
     """Milvus 连接和集合管理 - 支持混合检索"""
@@ -13,27 +29,122 @@ class MilvusManager:
         self.host = os.getenv("MILVUS_HOST", "localhost")
         self.port = os.getenv("MILVUS_PORT", "19530")
         self.collection_name = os.getenv("MILVUS_COLLECTION", "embeddings_collection")
+        # L1 根块的小索引，供由粗到细检索的第一阶段使用
+        self.root_collection_name = os.getenv("MILVUS_ROOT_COLLECTION", f"{self.collection_name}_roots")
         self.client = MilvusClient(uri=f"http://{self.host}:{self.port}")
+        # 检索参数默认值，可用 tune_search_params.py 按召回率目标标定
+        self.search_ef = int(os.getenv("MILVUS_SEARCH_EF", "64"))
+        self.sparse_drop_ratio = float(os.getenv("MILVUS_SPARSE_DROP_RATIO", "0.2"))
+        self.rrf_k = int(os.getenv("MILVUS_RRF_K", "60"))
+        # 稀疏向量来源：client 为 Python 端 BM25（EmbeddingService），bm25 为 Milvus 服务端 BM25 函数
+        self.sparse_mode = os.getenv("MILVUS_SPARSE_MODE", "client").lower()
+        self.bm25_analyzer = os.getenv("MILVUS_BM25_ANALYZER", "chinese")
+        self._server_bm25: bool | None = None
+        # mmap：原始数据（如 text、dense_embedding）与向量索引可放到磁盘映射，查询节点可服务远超内存的集合
+        self.mmap_fields = self._csv_env("MILVUS_MMAP_FIELDS")
+        self.mmap_indexes = self._csv_env("MILVUS_MMAP_INDEXES")
+        self.warmup_queries = int(os.getenv("MILVUS_WARMUP_QUERIES", "8"))
+        # 叶子正文外置：Milvus 只保存向量、ID 与过滤字段，正文与元数据存本地分块存储，排序后一次批量回取
+        self.leaf_text_offload = os.getenv("LEAF_TEXT_OFFLOAD", "false").lower() == "true"
+
+    def retrieve_output_fields(self) -> list[str]:
+        """检索返回字段：正文外置时只返回 chunk_id，其余由调用方从本地分块存储批量补全。"""
+        return ["chunk_id"] if self.leaf_text_offload else list(_RETRIEVE_OUTPUT_FIELDS)
+
+    def stores_leaf_text(self) -> bool:
+        """写入时是否仍需在 Milvus 中保存叶子正文（服务端 BM25 依赖 text 字段生成稀疏向量）。"""
+        return not self.leaf_text_offload or self.uses_server_bm25()
+
+    @staticmethod
+    def _csv_env(name: str) -> list[str]:
+        return [item.strip() for item in os.getenv(name, "").split(",") if item.strip()]
+
+    def _index_params(self, field_name: str, params: dict) -> dict:
+        if field_name in self.mmap_indexes:
+            return {**params, "mmap.enabled": "true"}
+        return params
+
+    def uses_server_bm25(self) -> bool:
+        """叶子集合的稀疏向量是否由服务端 BM25 函数生成。以集合实际 schema 为准（切换配置不影响已建集合），结果缓存。"""
+        if self._server_bm25 is None:
+            try:
+                if not self.client.has_collection(self.collection_name):
+                    return self.sparse_mode == "bm25"
+                functions = self.client.describe_collection(self.collection_name).get("functions") or []
+            except Exception:
+                return self.sparse_mode == "bm25"
+            self._server_bm25 = any(self._is_bm25_function(function.get("type")) for function in functions)
+        return self._server_bm25
+
+    @staticmethod
+    def _is_bm25_function(function_type) -> bool:
+        # describe_collection 返回的函数类型随 pymilvus 版本可能是枚举、整数或名称
+        if isinstance(function_type, str):
+            return function_type.upper() in ("BM25", str(FunctionType.BM25.value))
+        try:
+            return FunctionType(function_type) == FunctionType.BM25
+        except ValueError:
+            return False
+
+    def _sparse_leg(self, sparse_embedding: dict | None, query_text: str, drop_ratio: float) -> tuple[list, dict]:
+        """稀疏检索的 (data, param)：服务端 BM25 模式直接发送查询原文，由 Milvus 分词并计算 BM25。"""
+        if self.uses_server_bm25():
+            return [query_text], {"metric_type": "BM25", "params": {"drop_ratio_search": drop_ratio}}
+        return [sparse_embedding], {"metric_type": "IP", "params": {"drop_ratio_search": drop_ratio}}
+
+    def resolve_search_params(self, search_params: dict | None = None) -> dict:
+        """合并单次请求的检索参数与默认配置，返回 {"ef", "drop_ratio_search", "rrf_k"}。"""
+        params = {
+            "ef": self.search_ef,
+            "drop_ratio_search": self.sparse_drop_ratio,
+            "rrf_k": self.rrf_k,
+        }
+        params.update({key: value for key, value in (search_params or {}).items() if value is not None})
+        return params
 
     def init_collection(self, dense_dim: int = 2560):
         """
         初始化 Milvus 集合 - 同时支持密集向量和稀疏向量
+        MILVUS_SPARSE_MODE=bm25 时在 text 上定义 BM25 函数，稀疏向量由 Milvus 入库时生成（需 Milvus 2.5+）
         :param dense_dim: 密集向量维度
         """
         if not self.client.has_collection(self.collection_name):
+            server_bm25 = self.sparse_mode == "bm25"
             schema = self.client.create_schema(auto_id=True, enable_dynamic_field=True)
             
             # 主键
             schema.add_field("id", DataType.INT64, is_primary=True, auto_id=True)
             
             # 密集向量（来自 embedding 模型）
-            schema.add_field("dense_embedding", DataType.FLOAT_VECTOR, dim=dense_dim)
+            schema.add_field(
+                "dense_embedding",
+                DataType.FLOAT_VECTOR,
+                dim=dense_dim,
+                **({"mmap_enabled": True} if "dense_embedding" in self.mmap_fields else {}),
+            )
             
             # 稀疏向量（来自 BM25）
             schema.add_field("sparse_embedding", DataType.SPARSE_FLOAT_VECTOR)
             
-            # 文本和元数据字段
-            schema.add_field("text", DataType.VARCHAR, max_length=2000)
+            # 文本和元数据字段；服务端 BM25 模式下 text 需开启分词器
+            text_mmap = {"mmap_enabled": True} if "text" in self.mmap_fields else {}
+            if server_bm25:
+                schema.add_field(
+                    "text",
+                    DataType.VARCHAR,
+                    max_length=2000,
+                    enable_analyzer=True,
+                    analyzer_params={"type": self.bm25_analyzer},
+                    **text_mmap,
+                )
+                schema.add_function(Function(
+                    name="text_bm25",
+                    function_type=FunctionType.BM25,
+                    input_field_names=["text"],
+                    output_field_names=["sparse_embedding"],
+                ))
+            else:
+                schema.add_field("text", DataType.VARCHAR, max_length=2000, **text_mmap)
             schema.add_field("filename", DataType.VARCHAR, max_length=255)
             schema.add_field("file_type", DataType.VARCHAR, max_length=50)
             schema.add_field("file_path", DataType.VARCHAR, max_length=1024)
@@ -54,15 +165,18 @@ class MilvusManager:
                 field_name="dense_embedding",
                 index_type="HNSW",
                 metric_type="IP",
-                params={"M": 16, "efConstruction": 256}
+                params=self._index_params("dense_embedding", {"M": 16, "efConstruction": 256})
             )
             
             # 稀疏向量索引
             index_params.add_index(
                 field_name="sparse_embedding",
                 index_type="SPARSE_INVERTED_INDEX",
-                metric_type="IP",
-                params={"drop_ratio_build": 0.2}
+                metric_type="BM25" if server_bm25 else "IP",
+                params=self._index_params(
+                    "sparse_embedding",
+                    {"inverted_index_algo": "DAAT_MAXSCORE"} if server_bm25 else {"drop_ratio_build": 0.2},
+                )
             )
 
             self.client.create_collection(
@@ -70,11 +184,197 @@ class MilvusManager:
                 schema=schema,
                 index_params=index_params
             )
+            self._server_bm25 = server_bm25
+
+    def init_root_collection(self, dense_dim: int = 2560):
+        """
+        初始化 L1 根块集合 - 只存稠密向量与定位字段，规模约为叶子集合的几十分之一
+        :param dense_dim: 密集向量维度
+        """
+        if not self.client.has_collection(self.root_collection_name):
+            schema = self.client.create_schema(auto_id=True, enable_dynamic_field=False)
+            schema.add_field("id", DataType.INT64, is_primary=True, auto_id=True)
+            schema.add_field("dense_embedding", DataType.FLOAT_VECTOR, dim=dense_dim)
+            schema.add_field("filename", DataType.VARCHAR, max_length=255)
+            schema.add_field("chunk_id", DataType.VARCHAR, max_length=512)
+
+            index_params = self.client.prepare_index_params()
+            index_params.add_index(
+                field_name="dense_embedding",
+                index_type="HNSW",
+                metric_type="IP",
+                params={"M": 16, "efConstruction": 256}
+            )
+
+            self.client.create_collection(
+                collection_name=self.root_collection_name,
+                schema=schema,
+                index_params=index_params
+            )
+
+    def apply_mmap_settings(self) -> dict:
+        """
+        把 MILVUS_MMAP_FIELDS / MILVUS_MMAP_INDEXES 应用到已存在的叶子集合（新建集合在 init_collection 中直接生效）。
+        修改 mmap 需要先释放集合，完成后重新加载。
+        :return: {"fields": [...], "indexes": [...]}
+        """
+        if not (self.mmap_fields or self.mmap_indexes) or not self.client.has_collection(self.collection_name):
+            return {"fields": [], "indexes": []}
+        self.client.release_collection(self.collection_name)
+        try:
+            for field_name in self.mmap_fields:
+                self.client.alter_collection_field(
+                    self.collection_name, field_name=field_name, field_params={"mmap.enabled": True}
+                )
+            for field_name in self.mmap_indexes:
+                # 未指定 index_name 建立的索引以字段名命名
+                self.client.alter_index_properties(
+                    self.collection_name, index_name=field_name, properties={"mmap.enabled": True}
+                )
+        finally:
+            self.client.load_collection(self.collection_name)
+        return {"fields": list(self.mmap_fields), "indexes": list(self.mmap_indexes)}
+
+    def _collections(self) -> list[str]:
+        return [name for name in (self.collection_name, self.root_collection_name) if self.client.has_collection(name)]
+
+    def load(self) -> dict:
+        """显式加载叶子集合与根块集合到查询节点，返回各集合加载状态。"""
+        for name in self._collections():
+            self.client.load_collection(name)
+        return self.load_state()
+
+    def release(self) -> dict:
+        """从查询节点释放集合（释放内存；释放期间检索会失败并触发熔断降级）。"""
+        for name in self._collections():
+            self.client.release_collection(name)
+        return self.load_state()
+
+    def load_state(self) -> dict:
+        """{集合名: 加载状态}，集合不存在时为 NotExist。"""
+        states = {}
+        for name in (self.collection_name, self.root_collection_name):
+            if not self.client.has_collection(name):
+                states[name] = "NotExist"
+                continue
+            state = self.client.get_load_state(name).get("state")
+            states[name] = getattr(state, "name", str(state))
+        return states
+
+    def warm_up(self, num_queries: int | None = None) -> dict:
+        """
+        重启后预热：加载集合，再用集合中抽样的真实向量做若干次稠密 / 稀疏检索，
+        把 HNSW 图、倒排索引与 mmap 的 text 页面提前读入缓存，避免首批用户查询承担冷启动延迟。
+        :param num_queries: 预热查询数，缺省为 MILVUS_WARMUP_QUERIES
+        :return: {"load_state", "queries", "elapsed_ms"}
+        """
+        started = time.perf_counter()
+        num_queries = self.warmup_queries if num_queries is None else num_queries
+        if not self.client.has_collection(self.collection_name):
+            return {"load_state": self.load_state(), "queries": 0, "elapsed_ms": 0.0}
+        self.load()
+
+        server_bm25 = self.uses_server_bm25()
+        output_fields = ["dense_embedding", "text"] + ([] if server_bm25 else ["sparse_embedding"])
+        samples = []
+        if num_queries > 0:
+            samples = self.client.query(
+                collection_name=self.collection_name,
+                filter="id >= 0",
+                output_fields=output_fields,
+                limit=num_queries,
+            )
+        has_roots = self.client.has_collection(self.root_collection_name)
+        for row in samples:
+            self.dense_retrieve(row["dense_embedding"], top_k=10)
+            if server_bm25:
+                self.sparse_retrieve(query_text=(row.get("text") or "")[:64], top_k=10)
+            elif row.get("sparse_embedding"):
+                self.sparse_retrieve(row["sparse_embedding"], top_k=10)
+            if has_roots:
+                self.search_roots(row["dense_embedding"])
+        return {
+            "load_state": self.load_state(),
+            "queries": len(samples),
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
 
     def insert(self, data: list[dict]):
         """插入数据到 Milvus"""
         return self.client.insert(self.collection_name, data)
 
+    def insert_roots(self, data: list[dict]):
+        """插入 L1 根块向量"""
+        return self.client.insert(self.root_collection_name, data)
+
+    def count_roots(self) -> int:
+        """根块集合条数，集合不存在时为 0"""
+        if not self.client.has_collection(self.root_collection_name):
+            return 0
+        rows = self.client.query(
+            collection_name=self.root_collection_name,
+            filter="",
+            output_fields=["count(*)"],
+        )
+        return int(rows[0]["count(*)"]) if rows else 0
+
+    def root_chunk_ids(self) -> set[str]:
+        """根块集合中已有的 chunk_id（回填根块时去重）"""
+        if not self.client.has_collection(self.root_collection_name):
+            return set()
+        iterator = self.client.query_iterator(
+            collection_name=self.root_collection_name,
+            batch_size=1000,
+            filter="",
+            output_fields=["chunk_id"],
+        )
+        chunk_ids = set()
+        try:
+            while True:
+                batch = iterator.next()
+                if not batch:
+                    break
+                chunk_ids.update(row["chunk_id"] for row in batch)
+        finally:
+            iterator.close()
+        return chunk_ids
+
+    def drop_root_collection(self):
+        """只删除根块集合（重建根块索引）"""
+        if self.client.has_collection(self.root_collection_name):
+            self.client.drop_collection(self.root_collection_name)
+
+    def search_roots(
+        self,
+        dense_embedding: list[float],
+        top_k: int = 8,
+        search_params: dict | None = None,
+        timeout: float | None = None,
+    ) -> list[dict]:
+        """
+        由粗到细检索第一阶段：在根块集合中找出最相关的 L1 根块
+        :param timeout: 本次调用的超时（秒），None 表示不限
+        :return: [{"chunk_id", "filename", "score"}, ...]
+        """
+        results = self.client.search(
+            collection_name=self.root_collection_name,
+            data=[dense_embedding],
+            anns_field="dense_embedding",
+            search_params={"metric_type": "IP", "params": {"ef": max(self.resolve_search_params(search_params)["ef"], top_k)}},
+            limit=top_k,
+            output_fields=["chunk_id", "filename"],
+            timeout=timeout,
+        )
+        return [
+            {
+                "chunk_id": hit.get("entity", {}).get("chunk_id", ""),
+                "filename": hit.get("entity", {}).get("filename", ""),
+                "score": hit.get("distance", 0.0),
+            }
+            for hits in results
+            for hit in hits
+        ]
+
     def query(self, filter_expr: str = "", output_fields: list[str] = None, limit: int = 10000):
         """查询数据"""
         return self.client.query(
@@ -107,62 +407,92 @@ class MilvusManager:
             limit=len(ids),
         )
 
+    def dense_scores(
+        self,
+        dense_embedding: list[float],
+        chunk_ids: list[str],
+        timeout: float | None = None,
+    ) -> dict[str, float]:
+        """候选分块与查询的稠密内积分数 {chunk_id: score}（混合检索只返回 RRF 分数，本地精排回退时补取）"""
+        ids = list(dict.fromkeys(item for item in chunk_ids if item))
+        if not ids:
+            return {}
+        quoted_ids = ", ".join(json.dumps(item, ensure_ascii=False) for item in ids)
+        results = self.client.search(
+            collection_name=self.collection_name,
+            data=[dense_embedding],
+            anns_field="dense_embedding",
+            search_params={"metric_type": "IP", "params": {"ef": max(self.resolve_search_params()["ef"], len(ids))}},
+            limit=len(ids),
+            output_fields=["chunk_id"],
+            filter=f"chunk_id in [{quoted_ids}]",
+            timeout=timeout,
+        )
+        return {
+            hit.get("entity", {}).get("chunk_id", ""): hit.get("distance", 0.0)
+            for hits in results
+            for hit in hits
+        }
+
     def hybrid_retrieve(
         self,
         dense_embedding: list[float],
-        sparse_embedding: dict,
+        sparse_embedding: dict | None = None,
         top_k: int = 5,
-        rrf_k: int = 60,     #可调节
+        rrf_k: int | None = None,
         filter_expr: str = "",
+        search_params: dict | None = None,
+        query_text: str = "",
+        timeout: float | None = None,
     ) -> list[dict]:
         """
         混合检索 - 使用 RRF 融合密集向量和稀疏向量的检索结果
         
         :param dense_embedding: 密集向量
-        :param sparse_embedding: 稀疏向量 {index: value, ...}
+        :param sparse_embedding: 稀疏向量 {index: value, ...}（服务端 BM25 模式下不需要）
         :param top_k: 返回结果数量
-        :param rrf_k: RRF 算法参数 k，默认60
+        :param rrf_k: RRF 算法参数 k，默认取 search_params / MILVUS_RRF_K
+        :param search_params: 单次请求的检索参数 {"ef", "drop_ratio_search", "rrf_k"}
+        :param query_text: 查询原文，服务端 BM25 模式下作为稀疏路径的输入
+        :param timeout: 本次调用的超时（秒），None 表示不限
         :return: 检索结果列表
         """
-        output_fields = [
-            "text",
-            "filename",
-            "file_type",
-            "page_number",
-            "chunk_id",
-            "parent_chunk_id",
-            "root_chunk_id",
-            "chunk_level",
-            "chunk_idx",
-        ]
+        params = self.resolve_search_params(search_params)
+        if rrf_k is not None:
+            params["rrf_k"] = rrf_k
+        leg_limit = top_k * 2  # 多取一些用于融合
+        output_fields = self.retrieve_output_fields()
         
         # 密集向量搜索请求
+        # HNSW 要求 ef 不小于返回条数
         dense_search = AnnSearchRequest(
             data=[dense_embedding],
             anns_field="dense_embedding",
-            param={"metric_type": "IP", "params": {"ef": 64}},
-            limit=top_k * 2,  # 多取一些用于融合
+            param={"metric_type": "IP", "params": {"ef": max(params["ef"], leg_limit)}},
+            limit=leg_limit,
             expr=filter_expr,
         )
         
         # 稀疏向量搜索请求
+        sparse_data, sparse_param = self._sparse_leg(sparse_embedding, query_text, params["drop_ratio_search"])
         sparse_search = AnnSearchRequest(
-            data=[sparse_embedding],
+            data=sparse_data,
             anns_field="sparse_embedding",
-            param={"metric_type": "IP", "params": {"drop_ratio_search": 0.2}},
-            limit=top_k * 2,
+            param=sparse_param,
+            limit=leg_limit,
             expr=filter_expr,
         )
         
         # 使用 RRF 排序算法融合结果
-        reranker = RRFRanker(k=rrf_k)
+        reranker = RRFRanker(k=params["rrf_k"])
         
         results = self.client.hybrid_search(
             collection_name=self.collection_name,
             reqs=[dense_search, sparse_search],
             ranker=reranker,
             limit=top_k,
-            output_fields=output_fields
+            output_fields=output_fields,
+            timeout=timeout,
         )
         
         # 格式化返回结果
@@ -180,33 +510,34 @@ class MilvusManager:
                     "root_chunk_id": hit.get("root_chunk_id", ""),
                     "chunk_level": hit.get("chunk_level", 0),
                     "chunk_idx": hit.get("chunk_idx", 0),
+                    "token_count": hit.get("token_count", 0),
                     "score": hit.get("distance", 0.0)
                 })
         
         return formatted_results
 
-    def dense_retrieve(self, dense_embedding: list[float], top_k: int = 5, filter_expr: str = "") -> list[dict]:
+    def dense_retrieve(
+        self,
+        dense_embedding: list[float],
+        top_k: int = 5,
+        filter_expr: str = "",
+        search_params: dict | None = None,
+        timeout: float | None = None,
+    ) -> list[dict]:
         """
         仅使用密集向量检索（降级模式，用于稀疏向量不可用时）
+        :param timeout: 本次调用的超时（秒），None 表示不限
         """
+        ef = max(self.resolve_search_params(search_params)["ef"], top_k)
         results = self.client.search(
             collection_name=self.collection_name,
             data=[dense_embedding],
             anns_field="dense_embedding",
-            search_params={"metric_type": "IP", "params": {"ef": 64}},
+            search_params={"metric_type": "IP", "params": {"ef": ef}},
             limit=top_k,
-            output_fields=[
-                "text",
-                "filename",
-                "file_type",
-                "page_number",
-                "chunk_id",
-                "parent_chunk_id",
-                "root_chunk_id",
-                "chunk_level",
-                "chunk_idx",
-            ],
+            output_fields=self.retrieve_output_fields(),
             filter=filter_expr,
+            timeout=timeout,
         )
         
         formatted_results = []
@@ -223,13 +554,44 @@ class MilvusManager:
                     "root_chunk_id": hit.get("entity", {}).get("root_chunk_id", ""),
                     "chunk_level": hit.get("entity", {}).get("chunk_level", 0),
                     "chunk_idx": hit.get("entity", {}).get("chunk_idx", 0),
+                    "token_count": hit.get("entity", {}).get("token_count", 0),
                     "score": hit.get("distance", 0.0)
                 })
         
         return formatted_results
 
+    def sparse_retrieve(
+        self,
+        sparse_embedding: dict | None = None,
+        top_k: int = 5,
+        filter_expr: str = "",
+        search_params: dict | None = None,
+        query_text: str = "",
+    ) -> list[dict]:
+        """
+        仅使用稀疏向量检索（用于检索参数标定与基准测试），返回 [{"chunk_id", "score"}, ...]
+        """
+        drop_ratio = self.resolve_search_params(search_params)["drop_ratio_search"]
+        sparse_data, sparse_param = self._sparse_leg(sparse_embedding, query_text, drop_ratio)
+        results = self.client.search(
+            collection_name=self.collection_name,
+            data=sparse_data,
+            anns_field="sparse_embedding",
+            search_params=sparse_param,
+            limit=top_k,
+            output_fields=["chunk_id"],
+            filter=filter_expr,
+        )
+        return [
+            {"chunk_id": hit.get("entity", {}).get("chunk_id", ""), "score": hit.get("distance", 0.0)}
+            for hits in results
+            for hit in hits
+        ]
+
     def delete(self, filter_expr: str):
-        """删除数据"""
+        """删除数据（根块集合存在时按同一条件同步删除）"""
+        if self.client.has_collection(self.root_collection_name):
+            self.client.delete(collection_name=self.root_collection_name, filter=filter_expr)
         return self.client.delete(
             collection_name=self.collection_name,
             filter=filter_expr
@@ -243,3 +605,6 @@ class MilvusManager:
         """删除集合（用于重建 schema）"""
         if self.client.has_collection(self.collection_name):
             self.client.drop_collection(self.collection_name)
+        self._server_bm25 = None
+        if self.client.has_collection(self.root_collection_name):
+            self.client.drop_collection(self.root_collection_name)
@@ -1,7 +1,15 @@
-"""文档向量化并写入 Milvus - 支持密集+稀疏向量"""
+"""文档向量化并写入 Milvus - 支持密集+稀疏向量（稀疏向量可由 Milvus 服务端 BM25 函数生成）"""
+import os
+from dotenv import load_dotenv
+
 from embedding import EmbeddingService
 from milvus_client import MilvusManager
 
+load_dotenv()
+
+# 开启由粗到细检索时，入库同时为 L1 根块写入稠密向量
+COARSE_TO_FINE_ENABLED = os.getenv("COARSE_TO_FINE_ENABLED", "false").lower() == "true"
+
 
 class MilvusWriter:
     """文档向量化并写入 Milvus 服务 - 支持混合检索"""
@@ -20,35 +28,114 @@ class MilvusWriter:
             return
 
         self.milvus_manager.init_collection()
-        
-        # 先拟合语料库（用于 BM25 IDF 计算）
-        all_texts = [doc["text"] for doc in documents]
-        self.embedding_service.fit_corpus(all_texts)
+        # 服务端 BM25 模式下稀疏向量由 Milvus 根据 text 生成，不再在 Python 端编码
+        server_bm25 = self.milvus_manager.uses_server_bm25()
+        # 叶子正文外置时正文与元数据只存本地分块存储，Milvus 行内留空
+        store_text = self.milvus_manager.stores_leaf_text()
+
+        if not server_bm25:
+            # 先拟合语料库（用于 BM25 IDF 计算）
+            all_texts = [doc["text"] for doc in documents]
+            self.embedding_service.fit_corpus(all_texts)
+            # 落盘统计，检索进程据此生成与入库一致的查询稀疏向量
+            self.embedding_service.save_stats()
 
         total = len(documents)
         for i in range(0, total, batch_size):
             batch = documents[i:i + batch_size]
-            texts = [doc["text"] for doc in batch]
-            
-            # 同时生成密集向量和稀疏向量
-            dense_embeddings, sparse_embeddings = self.embedding_service.get_all_embeddings(texts)
+            dense_embeddings, sparse_embeddings = self.embed_batch([doc["text"] for doc in batch], server_bm25)
+            insert_data = self.build_rows(batch, dense_embeddings, sparse_embeddings, store_text)
+            self.milvus_manager.insert(insert_data)
 
-            insert_data = [
+    def embed_batch(self, texts: list[str], server_bm25: bool) -> tuple[list[list[float]], list[dict] | None]:
+        """生成一批文本的向量，服务端 BM25 模式下只生成密集向量（稀疏向量返回 None）"""
+        if server_bm25:
+            return self.embedding_service.get_embeddings(texts), None
+        # 同时生成密集向量和稀疏向量
+        return self.embedding_service.get_all_embeddings(texts)
+
+    @staticmethod
+    def build_rows(
+        batch: list[dict],
+        dense_embeddings: list[list[float]],
+        sparse_embeddings: list[dict] | None,
+        store_text: bool = True,
+    ) -> list[dict]:
+        """
+        组装叶子集合的行数据（逐批插入与批量导入共用）
+        :param sparse_embeddings: 服务端 BM25 模式下为 None，不写入稀疏向量
+        :param store_text: 叶子正文外置时为 False，正文与元数据留空
+        """
+        rows = [
+            {
+                "dense_embedding": dense_emb,
+                "text": doc["text"] if store_text else "",
+                "filename": doc["filename"],
+                "file_type": doc["file_type"] if store_text else "",
+                "file_path": doc.get("file_path", "") if store_text else "",
+                "page_number": doc.get("page_number", 0),
+                "chunk_idx": doc.get("chunk_idx", 0),
+                "chunk_id": doc.get("chunk_id", ""),
+                "parent_chunk_id": doc.get("parent_chunk_id", ""),
+                "root_chunk_id": doc.get("root_chunk_id", ""),
+                "chunk_level": doc.get("chunk_level", 0),
+                # 动态字段，供上下文打包按 token 预算挑选片段
+                "token_count": doc.get("token_count", 0),
+            }
+            for doc, dense_emb in zip(batch, dense_embeddings)
+        ]
+        if sparse_embeddings is not None:
+            for row, sparse_emb in zip(rows, sparse_embeddings):
+                row["sparse_embedding"] = sparse_emb
+        return rows
+
+    def write_root_documents(self, documents: list[dict], batch_size: int = 50):
+        """
+        为 L1 根块生成稠密向量并写入根块集合（未开启由粗到细检索时跳过）
+        :param documents: 父级分块列表，只取其中 chunk_level == 1 的根块
+        :param batch_size: 批次大小
+        """
+        roots = [doc for doc in documents if int(doc.get("chunk_level", 0) or 0) == 1]
+        if not COARSE_TO_FINE_ENABLED or not roots:
+            return
+        self._insert_roots(roots, batch_size)
+
+    def backfill_roots(self, parent_chunk_store, rebuild: bool = False, batch_size: int = 50) -> dict:
+        """
+        为本地分块存储中尚未写入根块集合的 L1 根块补写稠密向量（开启由粗到细检索前已入库的文档）
+        :param parent_chunk_store: ParentChunkStore
+        :param rebuild: 先删除根块集合，全部重新生成
+        :return: {"roots": L1 根块总数, "existing": 已有条数, "written": 本次写入条数}
+        """
+        if rebuild:
+            self.milvus_manager.drop_root_collection()
+        existing = self.milvus_manager.root_chunk_ids()
+        root_ids = [
+            record["chunk_id"] for record in parent_chunk_store.export_records()
+            if int(record.get("chunk_level", 0) or 0) == 1
+        ]
+        missing = [chunk_id for chunk_id in root_ids if chunk_id not in existing]
+        written = 0
+        for i in range(0, len(missing), batch_size):
+            # 按批取回（span 模式下还原正文），避免一次加载全部根块正文
+            docs = [doc for doc in parent_chunk_store.get_documents_by_ids(missing[i:i + batch_size]) if doc.get("text")]
+            if docs:
+                self._insert_roots(docs, batch_size)
+                written += len(docs)
+        if rebuild or written:
+            parent_chunk_store.bump_generation()
+        return {"roots": len(root_ids), "existing": len(root_ids) - len(missing), "written": written}
+
+    def _insert_roots(self, roots: list[dict], batch_size: int):
+        self.milvus_manager.init_root_collection()
+        for i in range(0, len(roots), batch_size):
+            batch = roots[i:i + batch_size]
+            dense_embeddings = self.embedding_service.get_embeddings([doc["text"] for doc in batch])
+            self.milvus_manager.insert_roots([
                 {
                     "dense_embedding": dense_emb,
-                    "sparse_embedding": sparse_emb,
-                    "text": doc["text"],
                     "filename": doc["filename"],
-                    "file_type": doc["file_type"],
-                    "file_path": doc.get("file_path", ""),
-                    "page_number": doc.get("page_number", 0),
-                    "chunk_idx": doc.get("chunk_idx", 0),
                     "chunk_id": doc.get("chunk_id", ""),
-                    "parent_chunk_id": doc.get("parent_chunk_id", ""),
-                    "root_chunk_id": doc.get("root_chunk_id", ""),
-                    "chunk_level": doc.get("chunk_level", 0),
                 }
-                for doc, dense_emb, sparse_emb in zip(batch, dense_embeddings, sparse_embeddings)
-            ]
-
-            self.milvus_manager.insert(insert_data)
+                for doc, dense_emb in zip(batch, dense_embeddings)
+            ])
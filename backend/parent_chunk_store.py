@@ -1,16 +1,35 @@
 """父级分块文档存储（用于 Auto-merging Retriever）"""
 import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterable, List
 
+from dotenv import load_dotenv
 
-class ParentChunkStore:
-    """基于本地 JSON 的父级分块存储。"""
+load_dotenv()
 
-    def __init__(self, store_path: Path | None = None):
-        base_dir = Path(__file__).resolve().parent
-        self.store_path = store_path or (base_dir.parent / "data" / "parent_chunks.json")
-        self.store_path.parent.mkdir(parents=True, exist_ok=True)
+# 存储后端：sqlite（默认，按 chunk_id 点查）或 json（旧版单文件）
+PARENT_CHUNK_STORE_BACKEND = os.getenv("PARENT_CHUNK_STORE_BACKEND", "sqlite").lower()
+# 父块正文存储方式：text（逐块存全文）或 span（整页文本只存一份，父块仅记录页内区间，读取时切片还原）
+PARENT_CHUNK_STORAGE_MODE = os.getenv("PARENT_CHUNK_STORAGE_MODE", "text").lower()
+
+# 进程内父块缓存容量（条），0 表示关闭缓存
+PARENT_CHUNK_CACHE_SIZE = int(os.getenv("PARENT_CHUNK_CACHE_SIZE", "4096"))
+
+# SQLite 单条语句的绑定参数上限较低，批量点查时分批执行
+_SQLITE_BATCH_SIZE = 500
+
+
+class JsonChunkBackend:
+    """基于本地 JSON 文件的存储后端（每次读写整个文件）。"""
+
+    supports_spans = False
+
+    def __init__(self, store_path: Path):
+        self.store_path = store_path
 
     def _load(self) -> Dict[str, dict]:
         if not self.store_path.exists():
@@ -30,45 +49,18 @@ class ParentChunkStore:
             json.dump(data, f, ensure_ascii=False)
         tmp_path.replace(self.store_path)
 
-    def upsert_documents(self, docs: List[dict]) -> int:
-        """写入/更新父级分块，返回写入条数。"""
-        if not docs:
-            return 0
-
+    def upsert(self, records: List[dict], pages: List[dict] | None = None) -> int:
         store = self._load()
-        upserted = 0
-        for doc in docs:
-            chunk_id = (doc.get("chunk_id") or "").strip()
-            if not chunk_id:
-                continue
-            store[chunk_id] = {
-                "text": doc.get("text", ""),
-                "filename": doc.get("filename", ""),
-                "file_type": doc.get("file_type", ""),
-                "file_path": doc.get("file_path", ""),
-                "page_number": doc.get("page_number", 0),
-                "chunk_id": chunk_id,
-                "parent_chunk_id": doc.get("parent_chunk_id", ""),
-                "root_chunk_id": doc.get("root_chunk_id", ""),
-                "chunk_level": int(doc.get("chunk_level", 0) or 0),
-                "chunk_idx": int(doc.get("chunk_idx", 0) or 0),
-            }
-            upserted += 1
-
+        for record in records:
+            store[record["chunk_id"]] = record
         self._save(store)
-        return upserted
+        return len(records)
 
-    def get_documents_by_ids(self, chunk_ids: List[str]) -> List[dict]:
-        if not chunk_ids:
-            return []
+    def get_many(self, chunk_ids: List[str]) -> Dict[str, dict]:
         store = self._load()
-        return [store[item] for item in chunk_ids if item in store]
+        return {item: store[item] for item in chunk_ids if item in store}
 
     def delete_by_filename(self, filename: str) -> int:
-        """按文件名删除父级分块，返回删除条数。"""
-        if not filename:
-            return 0
-
         store = self._load()
         before = len(store)
         filtered = {
@@ -79,3 +71,465 @@ class ParentChunkStore:
         if deleted > 0:
             self._save(filtered)
         return deleted
+
+    def iter_all(self) -> Iterable[dict]:
+        return list(self._load().values())
+
+    def iter_pages(self) -> Iterable[dict]:
+        return []
+
+    def clear(self) -> None:
+        self._save({})
+
+    def is_empty(self) -> bool:
+        return not self._load()
+
+    def count_level(self, level: int) -> int:
+        return sum(1 for record in self._load().values() if int(record.get("chunk_level", 0) or 0) == level)
+
+    def version(self) -> int:
+        # JSON 文件每次写入都会整体替换，mtime 即可作为版本戳
+        try:
+            return self.store_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    @property
+    def _generation_path(self) -> Path:
+        return self.store_path.with_suffix(".generation")
+
+    def generation(self) -> int:
+        try:
+            return int(self._generation_path.read_text(encoding="utf-8").strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def bump_generation(self) -> None:
+        tmp_path = self._generation_path.with_suffix(".generation.tmp")
+        tmp_path.write_text(str(self.generation() + 1), encoding="utf-8")
+        tmp_path.replace(self._generation_path)
+
+
+class SQLiteChunkBackend:
+    """基于 SQLite（WAL 模式）的存储后端：chunk_id 主键点查，filename 建索引。"""
+
+    supports_spans = True
+
+    def __init__(self, store_path: Path):
+        self.store_path = store_path
+        self._local = threading.local()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS parent_chunks ("
+                "chunk_id TEXT PRIMARY KEY, "
+                "filename TEXT NOT NULL, "
+                "data TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_parent_chunks_filename "
+                "ON parent_chunks(filename)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "page_id TEXT PRIMARY KEY, "
+                "filename TEXT NOT NULL, "
+                "text TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_pages_filename ON pages(filename)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta ("
+                "key TEXT PRIMARY KEY, "
+                "value INTEGER NOT NULL)"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        # 每个线程持有独立连接，FastAPI 线程池中的同步工具可以并发读
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.store_path), timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _bump_version(conn: sqlite3.Connection, key: str = "version") -> None:
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, 1) "
+            "ON CONFLICT(key) DO UPDATE SET value = value + 1",
+            (key,),
+        )
+
+    def upsert(self, records: List[dict], pages: List[dict] | None = None) -> int:
+        rows = [
+            (record["chunk_id"], record.get("filename", ""), json.dumps(record, ensure_ascii=False))
+            for record in records
+        ]
+        conn = self._conn()
+        with conn:
+            self._bump_version(conn)
+            if pages:
+                conn.executemany(
+                    "INSERT INTO pages (page_id, filename, text) VALUES (?, ?, ?) "
+                    "ON CONFLICT(page_id) DO UPDATE SET filename = excluded.filename, text = excluded.text",
+                    [(page["page_id"], page.get("filename", ""), page.get("text", "")) for page in pages],
+                )
+            conn.executemany(
+                "INSERT INTO parent_chunks (chunk_id, filename, data) VALUES (?, ?, ?) "
+                "ON CONFLICT(chunk_id) DO UPDATE SET filename = excluded.filename, data = excluded.data",
+                rows,
+            )
+        return len(rows)
+
+    def get_many(self, chunk_ids: List[str]) -> Dict[str, dict]:
+        ids = list(dict.fromkeys(item for item in chunk_ids if item))
+        found: Dict[str, dict] = {}
+        conn = self._conn()
+        for i in range(0, len(ids), _SQLITE_BATCH_SIZE):
+            batch = ids[i:i + _SQLITE_BATCH_SIZE]
+            placeholders = ", ".join("?" for _ in batch)
+            cursor = conn.execute(
+                f"SELECT chunk_id, data FROM parent_chunks WHERE chunk_id IN ({placeholders})",
+                batch,
+            )
+            for chunk_id, data in cursor:
+                found[chunk_id] = json.loads(data)
+        return found
+
+    def get_pages(self, page_ids: List[str]) -> Dict[str, str]:
+        ids = list(dict.fromkeys(item for item in page_ids if item))
+        found: Dict[str, str] = {}
+        conn = self._conn()
+        for i in range(0, len(ids), _SQLITE_BATCH_SIZE):
+            batch = ids[i:i + _SQLITE_BATCH_SIZE]
+            placeholders = ", ".join("?" for _ in batch)
+            cursor = conn.execute(
+                f"SELECT page_id, text FROM pages WHERE page_id IN ({placeholders})",
+                batch,
+            )
+            found.update(cursor)
+        return found
+
+    def delete_by_filename(self, filename: str) -> int:
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute("DELETE FROM parent_chunks WHERE filename = ?", (filename,))
+            conn.execute("DELETE FROM pages WHERE filename = ?", (filename,))
+            if cursor.rowcount:
+                self._bump_version(conn)
+        return cursor.rowcount or 0
+
+    def iter_all(self) -> Iterable[dict]:
+        cursor = self._conn().execute("SELECT data FROM parent_chunks")
+        for (data,) in cursor:
+            yield json.loads(data)
+
+    def iter_pages(self) -> Iterable[dict]:
+        cursor = self._conn().execute("SELECT page_id, filename, text FROM pages")
+        for page_id, filename, text in cursor:
+            yield {"page_id": page_id, "filename": filename, "text": text}
+
+    def clear(self) -> None:
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM parent_chunks")
+            conn.execute("DELETE FROM pages")
+            self._bump_version(conn)
+
+    def is_empty(self) -> bool:
+        return self._conn().execute("SELECT 1 FROM parent_chunks LIMIT 1").fetchone() is None
+
+    def count_level(self, level: int) -> int:
+        row = self._conn().execute(
+            "SELECT COUNT(*) FROM parent_chunks WHERE json_extract(data, '$.chunk_level') = ?",
+            (level,),
+        ).fetchone()
+        return int(row[0]) if row else 0
+
+    def version(self) -> int:
+        # 写入时在同一事务内自增，其他进程/worker 通过比对版本号感知变更
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def generation(self) -> int:
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def bump_generation(self) -> None:
+        conn = self._conn()
+        with conn:
+            self._bump_version(conn, "generation")
+
+
+class _ParentChunkCache:
+    """有界 LRU 缓存，按后端版本戳整体失效。"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: "OrderedDict[str, dict]" = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def sync_version(self, version) -> None:
+        with self._lock:
+            if version != self._version:
+                self._items.clear()
+                self._version = version
+
+    def get_many(self, chunk_ids: List[str]) -> Dict[str, dict]:
+        found: Dict[str, dict] = {}
+        with self._lock:
+            for chunk_id in chunk_ids:
+                record = self._items.get(chunk_id)
+                if record is not None:
+                    self._items.move_to_end(chunk_id)
+                    found[chunk_id] = record
+        return found
+
+    def put_many(self, records: Dict[str, dict], version) -> None:
+        with self._lock:
+            # 读取期间若已有写入，丢弃这批可能过期的结果
+            if version != self._version:
+                return
+            for chunk_id, record in records.items():
+                self._items[chunk_id] = record
+                self._items.move_to_end(chunk_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._version = None
+
+
+class ParentChunkStore:
+    """父级分块存储，默认使用 SQLite 后端，可通过 PARENT_CHUNK_STORE_BACKEND=json 切回旧版 JSON 文件。
+
+    storage_mode=span 时整页文本只存一份，父块仅保存 (page_id, start_index, end_index)，
+    读取时切片还原正文；JSON 后端不支持区间存储，始终按全文写入。
+    """
+
+    def __init__(
+        self,
+        store_path: Path | None = None,
+        backend: str | None = None,
+        storage_mode: str | None = None,
+        cache_size: int | None = None,
+    ):
+        base_dir = Path(__file__).resolve().parent
+        data_dir = base_dir.parent / "data"
+        self.backend_name = (backend or PARENT_CHUNK_STORE_BACKEND).lower()
+        self.storage_mode = (storage_mode or PARENT_CHUNK_STORAGE_MODE).lower()
+        if self.storage_mode not in ("text", "span"):
+            raise ValueError(f"不支持的父级分块存储方式: {self.storage_mode}")
+        cache_size = PARENT_CHUNK_CACHE_SIZE if cache_size is None else cache_size
+        self._cache = _ParentChunkCache(cache_size) if cache_size > 0 else None
+        if self.backend_name == "json":
+            self.store_path = store_path or (data_dir / "parent_chunks.json")
+            self.store_path.parent.mkdir(parents=True, exist_ok=True)
+            self._backend = JsonChunkBackend(self.store_path)
+        elif self.backend_name == "sqlite":
+            self.store_path = store_path or (data_dir / "parent_chunks.db")
+            self.store_path.parent.mkdir(parents=True, exist_ok=True)
+            self._backend = SQLiteChunkBackend(self.store_path)
+            if store_path is None:
+                self._migrate_legacy_json(data_dir / "parent_chunks.json")
+        else:
+            raise ValueError(f"不支持的父级分块存储后端: {self.backend_name}")
+
+    def _migrate_legacy_json(self, legacy_path: Path) -> None:
+        """首次启用 SQLite 时，将旧版 parent_chunks.json 一次性导入。"""
+        if not legacy_path.exists() or not self._backend.is_empty():
+            return
+        legacy = JsonChunkBackend(legacy_path)._load()
+        if legacy:
+            self.upsert_documents(list(legacy.values()))
+
+    @staticmethod
+    def _to_record(doc: dict) -> dict | None:
+        chunk_id = (doc.get("chunk_id") or "").strip()
+        if not chunk_id:
+            return None
+        start_index = doc.get("start_index")
+        end_index = doc.get("end_index")
+        return {
+            "text": doc.get("text", ""),
+            "filename": doc.get("filename", ""),
+            "file_type": doc.get("file_type", ""),
+            "file_path": doc.get("file_path", ""),
+            "page_number": doc.get("page_number", 0),
+            "chunk_id": chunk_id,
+            "parent_chunk_id": doc.get("parent_chunk_id", ""),
+            "root_chunk_id": doc.get("root_chunk_id", ""),
+            "chunk_level": int(doc.get("chunk_level", 0) or 0),
+            "chunk_idx": int(doc.get("chunk_idx", 0) or 0),
+            "page_id": doc.get("page_id", ""),
+            "start_index": int(start_index) if start_index is not None else -1,
+            "end_index": int(end_index) if end_index is not None else -1,
+            "child_count": int(doc.get("child_count", 0) or 0),
+            "token_count": int(doc.get("token_count", 0) or 0),
+        }
+
+    @staticmethod
+    def _strip_to_span(record: dict, page_texts: Dict[str, str]) -> dict:
+        """区间能在整页文本中精确还原时，去掉父块正文只保留区间。"""
+        page_text = page_texts.get(record["page_id"])
+        start, end = record["start_index"], record["end_index"]
+        if page_text is None or start < 0 or end <= start:
+            return record
+        if page_text[start:end] != record["text"]:
+            return record
+        return {**record, "text": "", "span_only": True}
+
+    def _restore_spans(self, found: Dict[str, dict]) -> Dict[str, dict]:
+        span_records = [record for record in found.values() if record.get("span_only")]
+        if not span_records:
+            return found
+        page_texts = self._backend.get_pages([record["page_id"] for record in span_records])
+        restored = dict(found)
+        for record in span_records:
+            page_text = page_texts.get(record["page_id"], "")
+            text = page_text[record["start_index"]:record["end_index"]]
+            restored[record["chunk_id"]] = {
+                key: value for key, value in record.items() if key != "span_only"
+            } | {"text": text}
+        return restored
+
+    def upsert_documents(self, docs: List[dict], pages: List[dict] | None = None) -> int:
+        """写入/更新父级分块，返回写入条数。
+
+        :param pages: DocumentLoader.load_pages 返回的整页文本，仅 span 模式下使用
+        """
+        if not docs:
+            return 0
+
+        records = [record for record in (self._to_record(doc) for doc in docs) if record]
+        if not records:
+            return 0
+        try:
+            if self.storage_mode != "span" or not self._backend.supports_spans or not pages:
+                return self._backend.upsert(records)
+
+            page_texts = {page["page_id"]: page.get("text", "") for page in pages if page.get("page_id")}
+            records = [self._strip_to_span(record, page_texts) for record in records]
+            return self._backend.upsert(records, pages=pages)
+        finally:
+            self.invalidate_cache()
+
+    def _fetch(self, chunk_ids: List[str]) -> Dict[str, dict]:
+        """先查进程内缓存，未命中部分一次批量回源。"""
+        if self._cache is None:
+            return self._restore_spans(self._backend.get_many(chunk_ids))
+        version = self._backend.version()
+        self._cache.sync_version(version)
+        found = self._cache.get_many(chunk_ids)
+        missing = [item for item in dict.fromkeys(chunk_ids) if item and item not in found]
+        if missing:
+            loaded = self._restore_spans(self._backend.get_many(missing))
+            self._cache.put_many(loaded, version)
+            found.update(loaded)
+        return found
+
+    def get_version(self):
+        """返回存储的版本戳，任何写入（含其他进程）都会使其变化。"""
+        return self._backend.version()
+
+    def get_generation(self) -> int:
+        """知识库代数：由写入方在 Milvus 写入完成后调用 bump_generation 递增，跨进程可见。
+        与 get_version 不同，本地存储已写入而 Milvus 尚未写完的窗口内不变，
+        检索合并与语义缓存按它分代，不会把旧索引的结果记到新代下。"""
+        return self._backend.generation()
+
+    def bump_generation(self) -> None:
+        self._backend.bump_generation()
+
+    def get_documents_by_ids(self, chunk_ids: List[str]) -> List[dict]:
+        if not chunk_ids:
+            return []
+        found = self._fetch(chunk_ids)
+        return [dict(found[item]) for item in chunk_ids if item in found]
+
+    def get_ancestors(self, docs: List[dict]) -> Dict[str, dict]:
+        """一次批量查询取回一批叶子块的全部祖先（父块与根块），返回 {chunk_id: 副本}。"""
+        ancestor_ids = []
+        for doc in docs:
+            for key in ("parent_chunk_id", "root_chunk_id"):
+                value = (doc.get(key) or "").strip()
+                if value and value != doc.get("chunk_id"):
+                    ancestor_ids.append(value)
+        if not ancestor_ids:
+            return {}
+        found = self._fetch(list(dict.fromkeys(ancestor_ids)))
+        return {chunk_id: dict(record) for chunk_id, record in found.items()}
+
+    @property
+    def stores_pages(self) -> bool:
+        """后端是否保存整页文本（SQLite）；JSON 后端导入 span_only 记录时需由调用方提供整页文本。"""
+        return self._backend.supports_spans
+
+    def export_records(self) -> Iterable[dict]:
+        """按存储原样导出全部记录（span 模式下保留 span_only 标记，不还原正文），用于索引快照。"""
+        return self._backend.iter_all()
+
+    def export_pages(self) -> Iterable[dict]:
+        return self._backend.iter_pages()
+
+    def import_pages(self, pages: List[dict]) -> int:
+        """写入 export_pages 导出的整页文本（JSON 后端不存整页文本，跳过）。须在 import_records 之前调用。"""
+        if not pages or not self._backend.supports_spans:
+            return 0
+        try:
+            self._backend.upsert([], pages=pages)
+            return len(pages)
+        finally:
+            self.invalidate_cache()
+
+    def import_records(self, records: List[dict], page_texts: Dict[str, str] | None = None) -> int:
+        """原样写入 export_records 导出的记录，可分批调用。
+
+        目标后端不支持区间存储（JSON）时，用 page_texts（{page_id: 整页文本}，每批都需传入）还原 span_only 记录的正文。
+        """
+        if not records:
+            return 0
+        try:
+            if self._backend.supports_spans:
+                return self._backend.upsert(records)
+            page_texts = page_texts or {}
+            restored = []
+            for record in records:
+                if record.get("span_only"):
+                    text = page_texts.get(record["page_id"], "")[record["start_index"]:record["end_index"]]
+                    record = {key: value for key, value in record.items() if key != "span_only"} | {"text": text}
+                restored.append(record)
+            return self._backend.upsert(restored)
+        finally:
+            self.invalidate_cache()
+
+    def is_empty(self) -> bool:
+        return self._backend.is_empty()
+
+    def count_by_level(self, level: int) -> int:
+        """指定层级的分块条数（如 L1 根块数，用于判断根块索引是否覆盖全部文档）。"""
+        return self._backend.count_level(level)
+
+    def clear(self) -> None:
+        """清空全部分块与整页文本。"""
+        try:
+            self._backend.clear()
+        finally:
+            self.invalidate_cache()
+
+    def delete_by_filename(self, filename: str) -> int:
+        """按文件名删除父级分块，返回删除条数。"""
+        if not filename:
+            return 0
+        try:
+            return self._backend.delete_by_filename(filename)
+        finally:
+            self.invalidate_cache()
+
+    def invalidate_cache(self) -> None:
+        if self._cache is not None:
+            self._cache.clear()
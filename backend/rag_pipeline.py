@@ -1,12 +1,31 @@
-from typing import Literal, TypedDict, List, Optional
+from typing import Annotated, Literal, TypedDict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import contextvars
+import operator
 import os
+import threading
+import time
 from dotenv import load_dotenv
 from langchain.chat_models import init_chat_model
 from langgraph.graph import StateGraph, END
 from pydantic import BaseModel, Field
 
-from rag_utils import retrieve_documents, step_back_expand, generate_hypothetical_document
-from tools import emit_rag_step
+from rag_utils import (
+    retrieve_documents,
+    step_back_expand,
+    build_step_back_query,
+    generate_hypothetical_document,
+    query_term_overlap,
+    remaining_ms,
+    invoke_with_deadline,
+    embed_query,
+    get_knowledge_base_version,
+)
+from context_packer import pack_context, suppress_near_duplicates
+from semantic_cache import SemanticCache
+from singleflight import SingleFlight, budget_bucket, follower_wait, normalize_query
+from tools import emit_rag_step, buffer_rag_steps, replay_rag_steps
 
 load_dotenv()
 
@@ -14,41 +33,87 @@ API_KEY = os.getenv("ARK_API_KEY")
 MODEL = os.getenv("MODEL")
 BASE_URL = os.getenv("BASE_URL")
 GRADE_MODEL = os.getenv("GRADE_MODEL", "gpt-4.1")
-
-_grader_model = None
-_router_model = None
-
-
-def _get_grader_model():
-    global _grader_model
+# 查询扩展方式：multi_call（路由、退步问题、退步答案、HyDE 逐个调用模型）
+# 或 single_call（一次结构化输出拿到全部结果，失败时回退 multi_call）
+REWRITE_EXPANSION_MODE = os.getenv("REWRITE_EXPANSION_MODE", "multi_call").lower()
+# 投机重写：评分的同时提前执行查询重写与扩展检索，评分通过则丢弃
+SPECULATIVE_REWRITE_ENABLED = os.getenv("SPECULATIVE_REWRITE_ENABLED", "false").lower() == "true"
+SPECULATIVE_REWRITE_WORKERS = int(os.getenv("SPECULATIVE_REWRITE_WORKERS", "4"))
+# 投机命中率按最近 N 次投机统计，反映当前流量而不是进程启动以来的累计
+SPECULATIVE_STATS_WINDOW = int(os.getenv("SPECULATIVE_STATS_WINDOW", "200"))
+# 快速评分门控：用已有的 rerank / RRF 分数与查询词覆盖率判定，高置信直接放行、明显不相关直接重写，
+# 仅模糊样本交给 LLM 评分。阈值用 calibrate_grade_gate.py 离线标定。
+GRADE_GATE_ENABLED = os.getenv("GRADE_GATE_ENABLED", "false").lower() == "true"
+GRADE_GATE_TOP_N = int(os.getenv("GRADE_GATE_TOP_N", "3"))
+GRADE_GATE_ACCEPT_RERANK = float(os.getenv("GRADE_GATE_ACCEPT_RERANK", "0.7"))
+GRADE_GATE_REJECT_RERANK = float(os.getenv("GRADE_GATE_REJECT_RERANK", "0.1"))
+GRADE_GATE_ACCEPT_RRF = float(os.getenv("GRADE_GATE_ACCEPT_RRF", "0.9"))
+GRADE_GATE_REJECT_RRF = float(os.getenv("GRADE_GATE_REJECT_RRF", "0.5"))
+GRADE_GATE_ACCEPT_OVERLAP = float(os.getenv("GRADE_GATE_ACCEPT_OVERLAP", "0.6"))
+GRADE_GATE_REJECT_OVERLAP = float(os.getenv("GRADE_GATE_REJECT_OVERLAP", "0.2"))
+# Milvus RRFRanker 的 k（与 milvus_client 共用 MILVUS_RRF_K），用于把 RRF 分数归一化到 [0, 1]
+RRF_K = int(os.getenv("MILVUS_RRF_K", "60"))
+# 请求级截止时间（毫秒），0 表示不限。剩余预算低于各阶段下限时跳过该可选阶段
+RAG_DEADLINE_MS = int(os.getenv("RAG_DEADLINE_MS", "0"))
+DEADLINE_MIN_GRADE_MS = int(os.getenv("DEADLINE_MIN_GRADE_MS", "1500"))
+DEADLINE_MIN_REWRITE_MS = int(os.getenv("DEADLINE_MIN_REWRITE_MS", "4000"))
+DEADLINE_MIN_EXPAND_MS = int(os.getenv("DEADLINE_MIN_EXPAND_MS", "2500"))
+# 语义缓存：相似问题直接复用检索结果，跳过检索、精排、评分与重写
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1024"))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+# 送入评分与生成的上下文 token 预算，0（默认）表示不限；超出时合并父块裁剪到命中句前后 CONTEXT_TRIM_NEIGHBORS 句
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "0"))
+CONTEXT_TRIM_NEIGHBORS = int(os.getenv("CONTEXT_TRIM_NEIGHBORS", "1"))
+# 近重复去除：片段文本有该比例已被排名更高的片段覆盖时去除（建议 0.8），0（默认）表示只去除完全相同的片段
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0"))
+# 相同问题的并发 RAG 流程合并为一次（同时合并检索、精排、评分与重写）
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() != "false"
+
+_grader_models: dict = {}
+_router_models: dict = {}
+
+_speculative_executor = None
+_speculation_lock = threading.Lock()
+_speculation_outcomes = deque(maxlen=max(1, SPECULATIVE_STATS_WINDOW))
+_speculation_total = 0
+# 投机任务的取消信号，扩展分支在发起检索前检查
+_SPECULATION_CANCEL = contextvars.ContextVar("speculation_cancel", default=None)
+
+
+def _get_grader_model(bounded: bool = False):
+    """bounded=True 返回不重试的实例，供按截止时间限时的调用使用。"""
     if not API_KEY or not GRADE_MODEL:
         return None
-    if _grader_model is None:
-        _grader_model = init_chat_model(
+    if bounded not in _grader_models:
+        _grader_models[bounded] = init_chat_model(
             model=GRADE_MODEL,
             model_provider="openai",
             api_key=API_KEY,
             base_url=BASE_URL,
             temperature=0,
             stream_usage=True,
+            **({"max_retries": 0} if bounded else {}),
         )
-    return _grader_model
+    return _grader_models[bounded]
 
 
-def _get_router_model():
-    global _router_model
+def _get_router_model(bounded: bool = False):
+    """bounded=True 返回不重试的实例，供按截止时间限时的调用使用。"""
     if not API_KEY or not MODEL:
         return None
-    if _router_model is None:
-        _router_model = init_chat_model(
+    if bounded not in _router_models:
+        _router_models[bounded] = init_chat_model(
             model=MODEL,
             model_provider="openai",
             api_key=API_KEY,
             base_url=BASE_URL,
             temperature=0,
             stream_usage=True,
+            **({"max_retries": 0} if bounded else {}),
         )
-    return _router_model
+    return _router_models[bounded]
 
 
 GRADE_PROMPT = (
@@ -74,6 +139,37 @@ class RewriteStrategy(BaseModel):
     strategy: Literal["step_back", "hyde", "complex"]
 
 
+class QueryExpansion(BaseModel):
+    """Choose a query expansion strategy and produce every expansion in one pass."""
+
+    strategy: Literal["step_back", "hyde", "complex"]
+    step_back_question: str = Field(
+        default="",
+        description="Higher-level step-back question; required for step_back and complex, otherwise empty",
+    )
+    step_back_answer: str = Field(
+        default="",
+        description="Brief answer to the step-back question (under 120 Chinese characters); empty if no step-back question",
+    )
+    hypothetical_doc: str = Field(
+        default="",
+        description="Hypothetical document passage answering the question; required for hyde and complex, otherwise empty",
+    )
+
+
+SINGLE_CALL_EXPANSION_PROMPT = (
+    "请根据用户问题选择最合适的查询扩展策略，并一次性给出对应的扩展内容。\n"
+    "- step_back：包含具体名称、日期、代码等细节，需要先理解通用概念的问题。\n"
+    "- hyde：模糊、概念性、需要解释或定义的问题。\n"
+    "- complex：多步骤、需要分解或综合多种信息的复杂问题。\n"
+    "策略为 step_back 或 complex 时：给出一句更高层次、更概括的退步问题，"
+    "并用 120 字以内简要回答它（只给通用原理/背景知识）。\n"
+    "策略为 hyde 或 complex 时：生成一段像真实资料片段的假设性文档，不要标题或解释。\n"
+    "不需要的字段留空。\n"
+    "用户问题：{question}"
+)
+
+
 class RAGState(TypedDict):
     question: str
     query: str
@@ -85,7 +181,13 @@ class RAGState(TypedDict):
     step_back_question: Optional[str]
     step_back_answer: Optional[str]
     hypothetical_doc: Optional[str]
+    step_back_retrieval: Optional[dict]
+    hyde_retrieval: Optional[dict]
     rag_trace: Optional[dict]
+    deadline: Optional[float]
+    query_embedding: Optional[List[float]]
+    # 因截止时间被跳过的阶段；并发分支各自追加
+    skipped_stages: Annotated[List[str], operator.add]
 
 
 def _format_docs(docs: List[dict]) -> str:
@@ -100,11 +202,38 @@ def _format_docs(docs: List[dict]) -> str:
     return "\n\n---\n\n".join(chunks)
 
 
+def _pack_docs(docs: List[dict]) -> Tuple[List[dict], dict]:
+    """去除近重复片段后按 token 预算打包，返回 (片段, 打包元信息)。"""
+    docs, dup_count = suppress_near_duplicates(docs, NEAR_DUP_THRESHOLD)
+    packed, pack_meta = pack_context(docs, CONTEXT_TOKEN_BUDGET, CONTEXT_TRIM_NEIGHBORS)
+    pack_meta["near_duplicates_dropped"] = dup_count
+    if pack_meta["context_trimmed_chunks"] or pack_meta["context_dropped_chunks"]:
+        emit_rag_step(
+            "✂️",
+            "上下文按 token 预算打包",
+            (
+                f"{pack_meta['context_tokens_before']} -> {pack_meta['context_tokens']} tokens，"
+                f"裁剪 {pack_meta['context_trimmed_chunks']}，舍弃 {pack_meta['context_dropped_chunks']}"
+            ),
+        )
+    return packed, pack_meta
+
+
+def _budget_below(state: RAGState, min_ms: int) -> bool:
+    left_ms = remaining_ms(state.get("deadline"))
+    return left_ms is not None and left_ms < min_ms
+
+
 def retrieve_initial(state: RAGState) -> RAGState:
     query = state["question"]
     emit_rag_step("🔍", "正在检索知识库...", f"查询: {query[:50]}")
-    retrieved = retrieve_documents(query, top_k=5)
-    results = retrieved.get("docs", [])
+    retrieved = retrieve_documents(
+        query,
+        top_k=5,
+        deadline=state.get("deadline"),
+        dense_embedding=state.get("query_embedding"),
+    )
+    results, pack_meta = _pack_docs(retrieved.get("docs", []))
     retrieve_meta = retrieved.get("meta", {})
     context = _format_docs(results)
     emit_rag_step(
@@ -135,43 +264,220 @@ def retrieve_initial(state: RAGState) -> RAGState:
         "retrieval_stage": "initial",
         "rerank_enabled": retrieve_meta.get("rerank_enabled"),
         "rerank_applied": retrieve_meta.get("rerank_applied"),
+        "rerank_backend": retrieve_meta.get("rerank_backend"),
         "rerank_model": retrieve_meta.get("rerank_model"),
         "rerank_endpoint": retrieve_meta.get("rerank_endpoint"),
         "rerank_error": retrieve_meta.get("rerank_error"),
+        "rerank_cache_hits": retrieve_meta.get("rerank_cache_hits"),
+        "rerank_breaker": retrieve_meta.get("rerank_breaker"),
+        "local_rerank_semantic": retrieve_meta.get("local_rerank_semantic"),
         "retrieval_mode": retrieve_meta.get("retrieval_mode"),
+        "hybrid_breaker_state": retrieve_meta.get("hybrid_breaker_state"),
+        "retrieval_coalesced": retrieve_meta.get("retrieval_coalesced"),
+        "coarse_to_fine": retrieve_meta.get("coarse_to_fine"),
+        "coarse_root_count": retrieve_meta.get("coarse_root_count"),
         "candidate_k": retrieve_meta.get("candidate_k"),
+        "candidate_k_initial": retrieve_meta.get("candidate_k_initial"),
+        "candidate_widened": retrieve_meta.get("candidate_widened"),
+        "search_params": retrieve_meta.get("search_params"),
         "leaf_retrieve_level": retrieve_meta.get("leaf_retrieve_level"),
         "auto_merge_enabled": retrieve_meta.get("auto_merge_enabled"),
         "auto_merge_applied": retrieve_meta.get("auto_merge_applied"),
         "auto_merge_threshold": retrieve_meta.get("auto_merge_threshold"),
+        "auto_merge_ratio": retrieve_meta.get("auto_merge_ratio"),
         "auto_merge_replaced_chunks": retrieve_meta.get("auto_merge_replaced_chunks"),
         "auto_merge_steps": retrieve_meta.get("auto_merge_steps"),
+        **pack_meta,
     }
     return {
         "query": query,
         "docs": results,
         "context": context,
         "rag_trace": rag_trace,
+        "skipped_stages": retrieve_meta.get("deadline_skipped", []),
     }
 
 
-def grade_documents_node(state: RAGState) -> RAGState:
-    grader = _get_grader_model()
-    emit_rag_step("📊", "正在评估文档相关性...")
+def _get_speculative_executor() -> ThreadPoolExecutor:
+    global _speculative_executor
+    if _speculative_executor is None:
+        _speculative_executor = ThreadPoolExecutor(
+            max_workers=SPECULATIVE_REWRITE_WORKERS,
+            thread_name_prefix="rag-speculative",
+        )
+    return _speculative_executor
+
+
+def _speculation_cancelled() -> bool:
+    event = _SPECULATION_CANCEL.get()
+    return event is not None and event.is_set()
+
+
+def _run_speculative_expansion(state: RAGState, cancel_event: threading.Event, steps: list) -> dict:
+    _SPECULATION_CANCEL.set(cancel_event)
+    with buffer_rag_steps() as buffered:
+        try:
+            return expansion_graph.invoke(state)
+        finally:
+            steps.extend(buffered)
+
+
+def _start_speculative_expansion(state: RAGState) -> dict:
+    """在后台提前执行重写与扩展检索，返回句柄。rag_trace 复制一份，避免与评分节点并发修改。"""
+    speculative_state = {**state, "rag_trace": dict(state.get("rag_trace") or {}), "skipped_stages": []}
+    cancel_event = threading.Event()
+    steps: list = []
+    ctx = contextvars.copy_context()
+    future = _get_speculative_executor().submit(
+        ctx.run, _run_speculative_expansion, speculative_state, cancel_event, steps
+    )
+    return {"future": future, "cancel_event": cancel_event, "steps": steps}
+
+
+def _speculation_window_stats() -> dict:
+    """最近 SPECULATIVE_STATS_WINDOW 次投机的命中 / 浪费数（调用方持有 _speculation_lock）"""
+    hits = sum(1 for item in _speculation_outcomes if item == "hit")
+    wasted = sum(1 for item in _speculation_outcomes if item in ("wasted", "cancelled"))
+    return {
+        "speculative_hits": hits,
+        "speculative_wasted": wasted,
+        "speculative_hit_rate": round(hits / (hits + wasted), 4) if hits + wasted else None,
+        "speculative_window": len(_speculation_outcomes),
+        "speculative_requests": _speculation_total,
+    }
+
+
+def _record_speculation(outcome: str) -> dict:
+    global _speculation_total
+    with _speculation_lock:
+        _speculation_outcomes.append(outcome)
+        _speculation_total += 1
+        stats = _speculation_window_stats()
+    return {"speculative_rewrite": True, "speculative_outcome": outcome, **stats}
+
+
+def get_speculation_stats() -> dict:
+    with _speculation_lock:
+        return _speculation_window_stats()
+
+
+def _resolve_speculation(speculation: dict, needed: bool, rag_trace: dict, deadline: Optional[float] = None) -> dict:
+    """评分结束后采用或丢弃投机结果；采用时返回可直接进入 retrieve_expanded 的状态更新。
+    截止时间前未完成则放弃扩展，直接用初次检索结果作答。"""
+    future = speculation["future"]
+    if not needed:
+        speculation["cancel_event"].set()
+        rag_trace.update(_record_speculation("cancelled" if future.cancel() else "wasted"))
+        return {}
+
+    left_ms = remaining_ms(deadline)
+    try:
+        result = future.result(timeout=max(left_ms, 0) / 1000 if left_ms is not None else None)
+    except FutureTimeoutError:
+        speculation["cancel_event"].set()
+        future.cancel()
+        rag_trace.update(_record_speculation("wasted"))
+        emit_rag_step("⏱️", "请求预算耗尽，放弃查询扩展")
+        return {"route": "generate_answer", "skipped_stages": ["rewrite"]}
+    except Exception:
+        rag_trace.update(_record_speculation("failed"))
+        return {}
+
+    replay_rag_steps(speculation["steps"])
+    speculative_trace = result.get("rag_trace") or {}
+    rag_trace.update({
+        key: speculative_trace[key]
+        for key in ("rewrite_strategy", "rewrite_mode")
+        if key in speculative_trace
+    })
+    rag_trace.update(_record_speculation("hit"))
+    return {
+        "route": "retrieve_expanded",
+        "expansion_type": result.get("expansion_type"),
+        "expanded_query": result.get("expanded_query"),
+        "step_back_question": result.get("step_back_question"),
+        "step_back_answer": result.get("step_back_answer"),
+        "hypothetical_doc": result.get("hypothetical_doc"),
+        "step_back_retrieval": result.get("step_back_retrieval"),
+        "hyde_retrieval": result.get("hyde_retrieval"),
+        "skipped_stages": result.get("skipped_stages") or [],
+    }
+
+
+def grade_gate_signals(
+    question: str,
+    docs: List[dict],
+    retrieval_mode: Optional[str],
+    rerank_backend: Optional[str] = "remote",
+) -> dict:
+    """从检索结果中提取快速评分信号。RRF 分数仅在 hybrid 模式下有意义（降级模式下 score 为内积）；
+    本地精排分数是候选集内的相对分，不作为门控信号。"""
+    top_docs = docs[:GRADE_GATE_TOP_N]
+    rerank_scores = []
+    if rerank_backend == "remote":
+        rerank_scores = [float(doc["rerank_score"]) for doc in top_docs if doc.get("rerank_score") is not None]
+    rrf_norm = None
+    if retrieval_mode == "hybrid" and top_docs:
+        # 两路都排第一时 RRF 分数最高为 2 / (k + 1)
+        top_rrf = max(float(doc.get("score") or 0.0) for doc in top_docs)
+        rrf_norm = min(top_rrf / (2.0 / (RRF_K + 1)), 1.0)
+    return {
+        "doc_count": len(docs),
+        "top_rerank_score": max(rerank_scores) if rerank_scores else None,
+        "top_rrf_norm": round(rrf_norm, 4) if rrf_norm is not None else None,
+        "term_overlap": round(query_term_overlap(question, top_docs), 4),
+    }
+
+
+def default_gate_thresholds() -> dict:
+    return {
+        "accept_rerank": GRADE_GATE_ACCEPT_RERANK,
+        "reject_rerank": GRADE_GATE_REJECT_RERANK,
+        "accept_rrf": GRADE_GATE_ACCEPT_RRF,
+        "reject_rrf": GRADE_GATE_REJECT_RRF,
+        "accept_overlap": GRADE_GATE_ACCEPT_OVERLAP,
+        "reject_overlap": GRADE_GATE_REJECT_OVERLAP,
+    }
+
+
+def fast_grade(signals: dict, thresholds: Optional[dict] = None) -> Optional[str]:
+    """根据信号给出 accept / reject，模糊时返回 None 交给 LLM 评分。"""
+    t = thresholds or default_gate_thresholds()
+    if not signals.get("doc_count"):
+        return "reject"
+    overlap = signals.get("term_overlap") or 0.0
+    top_rerank = signals.get("top_rerank_score")
+    if top_rerank is not None:
+        # rerank 分数本身已是强信号，覆盖率只做兜底：放行时不能几乎零覆盖，拒绝时不能高覆盖
+        if top_rerank >= t["accept_rerank"] and overlap >= t["reject_overlap"]:
+            return "accept"
+        if top_rerank < t["reject_rerank"] and overlap < t["accept_overlap"]:
+            return "reject"
+        return None
+    top_rrf = signals.get("top_rrf_norm")
+    if top_rrf is not None:
+        if top_rrf >= t["accept_rrf"] and overlap >= t["accept_overlap"]:
+            return "accept"
+        if top_rrf < t["reject_rrf"] and overlap < t["reject_overlap"]:
+            return "reject"
+        return None
+    if overlap < t["reject_overlap"]:
+        return "reject"
+    return None
+
+
+def _grade(state: RAGState) -> Tuple[str, str]:
+    deadline = state.get("deadline")
+    grader = _get_grader_model(deadline is not None)
     if not grader:
-        grade_update = {
-            "grade_score": "unknown",
-            "grade_route": "rewrite_question",
-            "rewrite_needed": True,
-        }
-        rag_trace = state.get("rag_trace", {}) or {}
-        rag_trace.update(grade_update)
-        return {"route": "rewrite_question", "rag_trace": rag_trace}
+        return "unknown", "rewrite_question"
     question = state["question"]
     context = state.get("context", "")
     prompt = GRADE_PROMPT.format(question=question, context=context)
-    response = grader.with_structured_output(GradeDocuments).invoke(
-        [{"role": "user", "content": prompt}]
+    response = invoke_with_deadline(
+        deadline,
+        grader.with_structured_output(GradeDocuments),
+        [{"role": "user", "content": prompt}],
     )
     score = (response.binary_score or "").strip().lower()
     route = "generate_answer" if score == "yes" else "rewrite_question"
@@ -179,20 +485,114 @@ def grade_documents_node(state: RAGState) -> RAGState:
         emit_rag_step("✅", "文档相关性评估通过", f"评分: {score}")
     else:
         emit_rag_step("⚠️", "文档相关性不足，将重写查询", f"评分: {score}")
+    return score, route
+
+
+def grade_documents_node(state: RAGState) -> RAGState:
+    emit_rag_step("📊", "正在评估文档相关性...")
+    rag_trace = state.get("rag_trace", {}) or {}
+    gate_decision = None
+    if GRADE_GATE_ENABLED:
+        signals = grade_gate_signals(
+            state["question"],
+            state.get("docs", []),
+            rag_trace.get("retrieval_mode"),
+            rag_trace.get("rerank_backend"),
+        )
+        gate_decision = fast_grade(signals)
+        rag_trace.update({"grade_gate": gate_decision or "ambiguous", "grade_gate_signals": signals})
+
+    speculation = None
+    skipped = []
+    if gate_decision == "accept":
+        score, route = "yes", "generate_answer"
+        emit_rag_step("⚡", "快速评分：高置信相关，跳过 LLM 评分", f"信号: {signals}")
+    elif gate_decision == "reject":
+        score, route = "no", "rewrite_question"
+        emit_rag_step("⚡", "快速评分：明显不相关，直接重写查询", f"信号: {signals}")
+    elif _budget_below(state, DEADLINE_MIN_GRADE_MS):
+        # 没有时间再评分和重写，直接用初次检索结果作答
+        score, route = "skipped", "generate_answer"
+        skipped.append("grade")
+        emit_rag_step("⏱️", "请求预算不足，跳过相关性评分")
+    else:
+        if SPECULATIVE_REWRITE_ENABLED and not _budget_below(state, DEADLINE_MIN_REWRITE_MS):
+            speculation = _start_speculative_expansion(state)
+        try:
+            score, route = _grade(state)
+        except TimeoutError:
+            # 评分未在截止时间前返回，直接用初次检索结果作答
+            if speculation is not None:
+                speculation["cancel_event"].set()
+                speculation["future"].cancel()
+                rag_trace.update(_record_speculation("wasted"))
+                speculation = None
+            score, route = "skipped", "generate_answer"
+            skipped.append("grade")
+            emit_rag_step("⏱️", "请求预算耗尽，放弃相关性评分")
+        except Exception:
+            if speculation is not None:
+                speculation["cancel_event"].set()
+                speculation["future"].cancel()
+            raise
+    rewrite_needed = route == "rewrite_question"
+    if rewrite_needed and speculation is None and _budget_below(state, DEADLINE_MIN_REWRITE_MS):
+        route = "generate_answer"
+        skipped.append("rewrite")
+        emit_rag_step("⏱️", "请求预算不足，跳过查询重写")
     grade_update = {
         "grade_score": score,
         "grade_route": route,
-        "rewrite_needed": route == "rewrite_question",
+        "grade_source": "gate" if gate_decision else ("deadline" if score == "skipped" else "llm"),
+        "rewrite_needed": rewrite_needed,
     }
-    rag_trace = state.get("rag_trace", {}) or {}
     rag_trace.update(grade_update)
-    return {"route": route, "rag_trace": rag_trace}
+    update = {"route": route, "rag_trace": rag_trace, "skipped_stages": skipped}
+    if speculation is not None:
+        update.update(_resolve_speculation(speculation, rewrite_needed, rag_trace, state.get("deadline")))
+    return update
+
+
+def _single_call_expansion(question: str, deadline: Optional[float] = None) -> Optional[QueryExpansion]:
+    router = _get_router_model(deadline is not None)
+    if not router:
+        return None
+    try:
+        return invoke_with_deadline(
+            deadline,
+            router.with_structured_output(QueryExpansion),
+            [{"role": "user", "content": SINGLE_CALL_EXPANSION_PROMPT.format(question=question)}],
+        )
+    except Exception:
+        return None
 
 
 def rewrite_question_node(state: RAGState) -> RAGState:
     question = state["question"]
     emit_rag_step("✏️", "正在重写查询...")
-    router = _get_router_model()
+    rag_trace = state.get("rag_trace", {}) or {}
+
+    if REWRITE_EXPANSION_MODE == "single_call":
+        expansion = _single_call_expansion(question, state.get("deadline"))
+        if expansion is not None:
+            strategy = expansion.strategy
+            emit_rag_step("🧠", f"使用策略: {strategy}", "单次调用完成路由与扩展")
+            rag_trace.update({"rewrite_strategy": strategy, "rewrite_mode": "single_call"})
+            return {
+                "expansion_type": strategy,
+                "expanded_query": question,
+                "step_back_question": (expansion.step_back_question or "").strip(),
+                "step_back_answer": (expansion.step_back_answer or "").strip(),
+                "hypothetical_doc": (expansion.hypothetical_doc or "").strip(),
+                "step_back_retrieval": None,
+                "hyde_retrieval": None,
+                "rag_trace": rag_trace,
+            }
+        rag_trace.update({"rewrite_mode": "single_call_fallback"})
+    else:
+        rag_trace.update({"rewrite_mode": "multi_call"})
+
+    router = _get_router_model(state.get("deadline") is not None)
     strategy = "step_back"
     if router:
         prompt = (
@@ -203,130 +603,193 @@ def rewrite_question_node(state: RAGState) -> RAGState:
             f"用户问题：{question}"
         )
         try:
-            decision = router.with_structured_output(RewriteStrategy).invoke(
-                [{"role": "user", "content": prompt}]
+            decision = invoke_with_deadline(
+                state.get("deadline"),
+                router.with_structured_output(RewriteStrategy),
+                [{"role": "user", "content": prompt}],
             )
             strategy = decision.strategy
         except Exception:
             strategy = "step_back"
 
-    expanded_query = question
-    step_back_question = ""
-    step_back_answer = ""
-    hypothetical_doc = ""
+    emit_rag_step("🧠", f"使用策略: {strategy}")
+    rag_trace.update({"rewrite_strategy": strategy})
 
-    if strategy in ("step_back", "complex"):
-        emit_rag_step("🧠", f"使用策略: {strategy}", "生成退步问题")
-        step_back = step_back_expand(question)
-        step_back_question = step_back.get("step_back_question", "")
-        step_back_answer = step_back.get("step_back_answer", "")
-        expanded_query = step_back.get("expanded_query", question)
+    return {
+        "expansion_type": strategy,
+        "expanded_query": question,
+        "step_back_question": "",
+        "step_back_answer": "",
+        "hypothetical_doc": "",
+        "step_back_retrieval": None,
+        "hyde_retrieval": None,
+        "rag_trace": rag_trace,
+    }
 
+
+def _route_expansion(state: RAGState) -> List[str]:
+    """按策略扇出扩展分支；complex 同时走 step_back 与 HyDE，两路在同一步内并发执行。"""
+    strategy = state.get("expansion_type") or "step_back"
+    branches = []
     if strategy in ("hyde", "complex"):
-        emit_rag_step("📝", "HyDE 假设性文档生成中...")
-        hypothetical_doc = generate_hypothetical_document(question)
+        branches.append("expand_hyde")
+    if strategy in ("step_back", "complex"):
+        branches.append("expand_step_back")
+    return branches or ["expand_step_back"]
 
-    rag_trace = state.get("rag_trace", {}) or {}
-    rag_trace.update({
-        "rewrite_strategy": strategy,
-        "rewrite_query": expanded_query,
-    })
 
+def _expansion_skipped(state: RAGState, stage: str) -> Optional[dict]:
+    """剩余预算不足以完成一次生成 + 检索时跳过该扩展分支，由 retrieve_expanded 回退到初次检索结果。"""
+    if not _budget_below(state, DEADLINE_MIN_EXPAND_MS):
+        return None
+    emit_rag_step("⏱️", f"请求预算不足，跳过 {stage} 扩展")
+    return {"skipped_stages": [stage]}
+
+
+def expand_step_back_node(state: RAGState) -> RAGState:
+    """Step-back 分支：生成退步问题与答案（单次调用模式下已就绪则跳过），并用扩展查询检索。"""
+    skipped = _expansion_skipped(state, "step_back")
+    if skipped is not None:
+        return skipped
+    question = state["question"]
+    step_back_question = state.get("step_back_question") or ""
+    step_back_answer = state.get("step_back_answer") or ""
+    if step_back_question:
+        step_back = {
+            "step_back_question": step_back_question,
+            "step_back_answer": step_back_answer,
+            "expanded_query": build_step_back_query(question, step_back_question, step_back_answer),
+        }
+    else:
+        emit_rag_step("🧠", "生成退步问题")
+        step_back = step_back_expand(question, state.get("deadline"))
+    expanded_query = step_back.get("expanded_query", question)
+    if _speculation_cancelled():
+        return {}
+    if _budget_below(state, 0):
+        # 生成已用完预算，扩展检索不再是必经路径，直接回退到初次检索结果
+        emit_rag_step("⏱️", "请求预算耗尽，跳过 step_back 扩展检索")
+        return {"skipped_stages": ["step_back"]}
+    retrieved = retrieve_documents(expanded_query, top_k=5, deadline=state.get("deadline"))
+    step_meta = retrieved.get("meta", {})
+    emit_rag_step(
+        "🧱",
+        "Step-back 三级检索",
+        (
+            f"L{step_meta.get('leaf_retrieve_level', 3)} 召回，"
+            f"候选 {step_meta.get('candidate_k', 0)}，"
+            f"合并替换 {step_meta.get('auto_merge_replaced_chunks', 0)}"
+        ),
+    )
     return {
-        "expansion_type": strategy,
         "expanded_query": expanded_query,
-        "step_back_question": step_back_question,
-        "step_back_answer": step_back_answer,
+        "step_back_question": step_back.get("step_back_question", ""),
+        "step_back_answer": step_back.get("step_back_answer", ""),
+        "step_back_retrieval": retrieved,
+        "skipped_stages": step_meta.get("deadline_skipped", []),
+    }
+
+
+def expand_hyde_node(state: RAGState) -> RAGState:
+    """HyDE 分支：生成假设性文档（单次调用模式下已就绪则跳过），并用其检索。"""
+    skipped = _expansion_skipped(state, "hyde")
+    if skipped is not None:
+        return skipped
+    hypothetical_doc = state.get("hypothetical_doc") or ""
+    if not hypothetical_doc:
+        emit_rag_step("📝", "HyDE 假设性文档生成中...")
+        hypothetical_doc = generate_hypothetical_document(state["question"], state.get("deadline"))
+    if _speculation_cancelled():
+        return {}
+    if _budget_below(state, 0):
+        emit_rag_step("⏱️", "请求预算耗尽，跳过 hyde 扩展检索")
+        return {"skipped_stages": ["hyde"]}
+    retrieved = retrieve_documents(hypothetical_doc or state["question"], top_k=5, deadline=state.get("deadline"))
+    hyde_meta = retrieved.get("meta", {})
+    emit_rag_step(
+        "🧱",
+        "HyDE 三级检索",
+        (
+            f"L{hyde_meta.get('leaf_retrieve_level', 3)} 召回，"
+            f"候选 {hyde_meta.get('candidate_k', 0)}，"
+            f"合并替换 {hyde_meta.get('auto_merge_replaced_chunks', 0)}"
+        ),
+    )
+    return {
         "hypothetical_doc": hypothetical_doc,
-        "rag_trace": rag_trace,
+        "hyde_retrieval": retrieved,
+        "skipped_stages": hyde_meta.get("deadline_skipped", []),
     }
 
 
 def retrieve_expanded(state: RAGState) -> RAGState:
+    """汇合并发的扩展分支：合并检索结果、去重并汇总检索元信息。"""
     strategy = state.get("expansion_type") or "step_back"
-    emit_rag_step("🔄", "使用扩展查询重新检索...", f"策略: {strategy}")
+    emit_rag_step("🔄", "合并扩展查询检索结果...", f"策略: {strategy}")
     results: List[dict] = []
     rerank_applied_any = False
     rerank_enabled_any = False
     rerank_model = None
     rerank_endpoint = None
     rerank_errors = []
+    rerank_cache_hits = 0
+    rerank_breaker = None
+    rerank_backends = []
     retrieval_mode = None
+    hybrid_breaker_state = None
+    search_params = None
+    coarse_to_fine = False
+    coarse_root_count = 0
     candidate_k = None
+    candidate_widened = []
     leaf_retrieve_level = None
     auto_merge_enabled = None
     auto_merge_applied = False
     auto_merge_threshold = None
+    auto_merge_ratio = None
     auto_merge_replaced_chunks = 0
     auto_merge_steps = 0
 
-    if strategy in ("hyde", "complex"):
-        hypothetical_doc = state.get("hypothetical_doc") or generate_hypothetical_document(state["question"])
-        retrieved_hyde = retrieve_documents(hypothetical_doc, top_k=5)
-        results.extend(retrieved_hyde.get("docs", []))
-        hyde_meta = retrieved_hyde.get("meta", {})
-        emit_rag_step(
-            "🧱",
-            "HyDE 三级检索",
-            (
-                f"L{hyde_meta.get('leaf_retrieve_level', 3)} 召回，"
-                f"候选 {hyde_meta.get('candidate_k', 0)}，"
-                f"合并替换 {hyde_meta.get('auto_merge_replaced_chunks', 0)}"
-            ),
-        )
-        rerank_applied_any = rerank_applied_any or bool(hyde_meta.get("rerank_applied"))
-        rerank_enabled_any = rerank_enabled_any or bool(hyde_meta.get("rerank_enabled"))
-        rerank_model = rerank_model or hyde_meta.get("rerank_model")
-        rerank_endpoint = rerank_endpoint or hyde_meta.get("rerank_endpoint")
-        if hyde_meta.get("rerank_error"):
-            rerank_errors.append(f"hyde:{hyde_meta.get('rerank_error')}")
-        retrieval_mode = retrieval_mode or hyde_meta.get("retrieval_mode")
-        candidate_k = candidate_k or hyde_meta.get("candidate_k")
-        leaf_retrieve_level = leaf_retrieve_level or hyde_meta.get("leaf_retrieve_level")
-        auto_merge_enabled = auto_merge_enabled if auto_merge_enabled is not None else hyde_meta.get("auto_merge_enabled")
-        auto_merge_applied = auto_merge_applied or bool(hyde_meta.get("auto_merge_applied"))
-        auto_merge_threshold = auto_merge_threshold or hyde_meta.get("auto_merge_threshold")
-        auto_merge_replaced_chunks += int(hyde_meta.get("auto_merge_replaced_chunks") or 0)
-        auto_merge_steps += int(hyde_meta.get("auto_merge_steps") or 0)
-
-    if strategy in ("step_back", "complex"):
-        expanded_query = state.get("expanded_query") or state["question"]
-        retrieved_stepback = retrieve_documents(expanded_query, top_k=5)
-        results.extend(retrieved_stepback.get("docs", []))
-        step_meta = retrieved_stepback.get("meta", {})
-        emit_rag_step(
-            "🧱",
-            "Step-back 三级检索",
-            (
-                f"L{step_meta.get('leaf_retrieve_level', 3)} 召回，"
-                f"候选 {step_meta.get('candidate_k', 0)}，"
-                f"合并替换 {step_meta.get('auto_merge_replaced_chunks', 0)}"
-            ),
-        )
-        rerank_applied_any = rerank_applied_any or bool(step_meta.get("rerank_applied"))
-        rerank_enabled_any = rerank_enabled_any or bool(step_meta.get("rerank_enabled"))
-        rerank_model = rerank_model or step_meta.get("rerank_model")
-        rerank_endpoint = rerank_endpoint or step_meta.get("rerank_endpoint")
-        if step_meta.get("rerank_error"):
-            rerank_errors.append(f"step_back:{step_meta.get('rerank_error')}")
-        retrieval_mode = retrieval_mode or step_meta.get("retrieval_mode")
-        candidate_k = candidate_k or step_meta.get("candidate_k")
-        leaf_retrieve_level = leaf_retrieve_level or step_meta.get("leaf_retrieve_level")
-        auto_merge_enabled = auto_merge_enabled if auto_merge_enabled is not None else step_meta.get("auto_merge_enabled")
-        auto_merge_applied = auto_merge_applied or bool(step_meta.get("auto_merge_applied"))
-        auto_merge_threshold = auto_merge_threshold or step_meta.get("auto_merge_threshold")
-        auto_merge_replaced_chunks += int(step_meta.get("auto_merge_replaced_chunks") or 0)
-        auto_merge_steps += int(step_meta.get("auto_merge_steps") or 0)
-
-    deduped = []
-    seen = set()
-    for item in results:
-        key = (item.get("filename"), item.get("page_number"), item.get("text"))
-        if key in seen:
+    branches = [
+        ("hyde", state.get("hyde_retrieval")),
+        ("step_back", state.get("step_back_retrieval")),
+    ]
+    if not any(retrieved for _, retrieved in branches):
+        # 扩展分支均因截止时间被跳过，沿用初次检索结果
+        emit_rag_step("⏱️", "扩展检索已跳过，沿用初次检索结果")
+        return {}
+    for branch_name, retrieved in branches:
+        if not retrieved:
             continue
-        seen.add(key)
-        deduped.append(item)
-
+        results.extend(retrieved.get("docs", []))
+        meta = retrieved.get("meta", {})
+        rerank_applied_any = rerank_applied_any or bool(meta.get("rerank_applied"))
+        rerank_enabled_any = rerank_enabled_any or bool(meta.get("rerank_enabled"))
+        rerank_model = rerank_model or meta.get("rerank_model")
+        rerank_endpoint = rerank_endpoint or meta.get("rerank_endpoint")
+        if meta.get("rerank_error"):
+            rerank_errors.append(f"{branch_name}:{meta.get('rerank_error')}")
+        rerank_cache_hits += int(meta.get("rerank_cache_hits") or 0)
+        if meta.get("rerank_backend") and meta.get("rerank_backend") not in rerank_backends:
+            rerank_backends.append(meta.get("rerank_backend"))
+        rerank_breaker = meta.get("rerank_breaker") or rerank_breaker
+        retrieval_mode = retrieval_mode or meta.get("retrieval_mode")
+        hybrid_breaker_state = meta.get("hybrid_breaker_state") or hybrid_breaker_state
+        search_params = meta.get("search_params") or search_params
+        coarse_to_fine = coarse_to_fine or bool(meta.get("coarse_to_fine"))
+        coarse_root_count = max(coarse_root_count, int(meta.get("coarse_root_count") or 0))
+        candidate_k = candidate_k or meta.get("candidate_k")
+        if meta.get("candidate_widened"):
+            candidate_widened.append(f"{branch_name}:{meta.get('candidate_widened')}")
+        leaf_retrieve_level = leaf_retrieve_level or meta.get("leaf_retrieve_level")
+        auto_merge_enabled = auto_merge_enabled if auto_merge_enabled is not None else meta.get("auto_merge_enabled")
+        auto_merge_applied = auto_merge_applied or bool(meta.get("auto_merge_applied"))
+        auto_merge_threshold = auto_merge_threshold or meta.get("auto_merge_threshold")
+        auto_merge_ratio = auto_merge_ratio or meta.get("auto_merge_ratio")
+        auto_merge_replaced_chunks += int(meta.get("auto_merge_replaced_chunks") or 0)
+        auto_merge_steps += int(meta.get("auto_merge_steps") or 0)
+
+    deduped, pack_meta = _pack_docs(results)
     # 扩展阶段可能合并了多路召回（如 hyde + step_back），
     # 这里统一重排展示名次，避免出现 1,2,3,4,5,4,5 这类重复名次。
     for idx, item in enumerate(deduped, 1):
@@ -334,9 +797,11 @@ def retrieve_expanded(state: RAGState) -> RAGState:
 
     context = _format_docs(deduped)
     emit_rag_step("✅", f"扩展检索完成，共 {len(deduped)} 个片段")
+    expanded_query = state.get("expanded_query") or state["question"]
     rag_trace = state.get("rag_trace", {}) or {}
     rag_trace.update({
-        "expanded_query": state.get("expanded_query") or state["question"],
+        "rewrite_query": expanded_query,
+        "expanded_query": expanded_query,
         "step_back_question": state.get("step_back_question", ""),
         "step_back_answer": state.get("step_back_answer", ""),
         "hypothetical_doc": state.get("hypothetical_doc", ""),
@@ -346,26 +811,47 @@ def retrieve_expanded(state: RAGState) -> RAGState:
         "retrieval_stage": "expanded",
         "rerank_enabled": rerank_enabled_any,
         "rerank_applied": rerank_applied_any,
+        "rerank_backend": "+".join(rerank_backends) if rerank_backends else None,
         "rerank_model": rerank_model,
         "rerank_endpoint": rerank_endpoint,
         "rerank_error": "; ".join(rerank_errors) if rerank_errors else None,
+        "rerank_cache_hits": rerank_cache_hits,
+        "rerank_breaker": rerank_breaker,
         "retrieval_mode": retrieval_mode,
+        "hybrid_breaker_state": hybrid_breaker_state,
+        "coarse_to_fine": coarse_to_fine,
+        "coarse_root_count": coarse_root_count,
         "candidate_k": candidate_k,
+        "candidate_widened": "; ".join(candidate_widened) if candidate_widened else None,
+        "search_params": search_params,
         "leaf_retrieve_level": leaf_retrieve_level,
         "auto_merge_enabled": auto_merge_enabled,
         "auto_merge_applied": auto_merge_applied,
         "auto_merge_threshold": auto_merge_threshold,
+        "auto_merge_ratio": auto_merge_ratio,
         "auto_merge_replaced_chunks": auto_merge_replaced_chunks,
         "auto_merge_steps": auto_merge_steps,
+        **pack_meta,
     })
     return {"docs": deduped, "context": context, "rag_trace": rag_trace}
 
 
+def _add_expansion_nodes(graph: StateGraph) -> None:
+    graph.add_node("rewrite_question", rewrite_question_node)
+    graph.add_node("expand_step_back", expand_step_back_node)
+    graph.add_node("expand_hyde", expand_hyde_node)
+    graph.add_conditional_edges(
+        "rewrite_question",
+        _route_expansion,
+        ["expand_step_back", "expand_hyde"],
+    )
+
+
 def build_rag_graph():
     graph = StateGraph(RAGState)
     graph.add_node("retrieve_initial", retrieve_initial)
     graph.add_node("grade_documents", grade_documents_node)
-    graph.add_node("rewrite_question", rewrite_question_node)
+    _add_expansion_nodes(graph)
     graph.add_node("retrieve_expanded", retrieve_expanded)
 
     graph.set_entry_point("retrieve_initial")
@@ -376,18 +862,109 @@ def build_rag_graph():
         {
             "generate_answer": END,
             "rewrite_question": "rewrite_question",
+            "retrieve_expanded": "retrieve_expanded",
         },
     )
-    graph.add_edge("rewrite_question", "retrieve_expanded")
+    graph.add_edge("expand_step_back", "retrieve_expanded")
+    graph.add_edge("expand_hyde", "retrieve_expanded")
     graph.add_edge("retrieve_expanded", END)
     return graph.compile()
 
 
+def build_expansion_graph():
+    """仅包含重写与扩展分支的子图，用于投机执行；结果交给主图的 retrieve_expanded 汇合。"""
+    graph = StateGraph(RAGState)
+    _add_expansion_nodes(graph)
+    graph.set_entry_point("rewrite_question")
+    graph.add_edge("expand_step_back", END)
+    graph.add_edge("expand_hyde", END)
+    return graph.compile()
+
+
 rag_graph = build_rag_graph()
+expansion_graph = build_expansion_graph()
+_semantic_cache = SemanticCache(
+    max_entries=SEMANTIC_CACHE_SIZE,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    ttl=SEMANTIC_CACHE_TTL,
+    version_fn=get_knowledge_base_version,
+)
+_rag_flight = SingleFlight()
+
+
+def invalidate_semantic_cache() -> None:
+    """知识库上传 / 删除后调用；其他进程的写入通过父块存储版本戳感知。"""
+    _semantic_cache.invalidate()
+
+
+def get_semantic_cache_stats() -> dict:
+    return {**_semantic_cache.stats(), "rag_singleflight": _rag_flight.stats()}
+
+
+def _cacheable(result: dict) -> bool:
+    """只缓存完整流程的结果：检索失败、结果为空或因截止时间跳过了阶段的降级结果不缓存。"""
+    rag_trace = result.get("rag_trace") or {}
+    return bool(
+        result.get("docs")
+        and rag_trace.get("retrieval_mode") not in (None, "failed")
+        and not result.get("skipped_stages")
+    )
+
+
+def run_rag_graph(question: str, deadline_ms: Optional[int] = None) -> dict:
+    """执行 RAG 流程。相同问题（归一化后）、知识库版本与预算分档的并发请求共享同一次执行，
+    等待者最多用掉 SINGLEFLIGHT_WAIT_FRACTION 的预算等待，超时后按剩余预算自行执行。
+    :param deadline_ms: 本次请求的时间预算（毫秒），默认 RAG_DEADLINE_MS，<=0 表示不限
+    """
+    budget_ms = RAG_DEADLINE_MS if deadline_ms is None else deadline_ms
+    deadline = time.monotonic() + budget_ms / 1000 if budget_ms > 0 else None
+    if not SINGLEFLIGHT_ENABLED:
+        return _run_rag_graph(question, budget_ms, deadline)
+    key = (normalize_query(question), get_knowledge_base_version(), budget_bucket(budget_ms if budget_ms > 0 else None))
+    result, shared = _rag_flight.do(
+        key, _run_rag_graph, question, budget_ms, deadline,
+        wait_timeout=follower_wait(budget_ms if budget_ms > 0 else None),
+    )
+    if shared:
+        emit_rag_step("🔗", "已合并到进行中的相同问题检索")
+        if result.get("rag_trace") is not None:
+            result["rag_trace"]["coalesced"] = True
+    return result
 
 
-def run_rag_graph(question: str) -> dict:
-    return rag_graph.invoke({
+def _run_rag_graph(question: str, budget_ms: int, deadline: Optional[float]) -> dict:
+
+    query_embedding = None
+    cache_version = None
+    if SEMANTIC_CACHE_ENABLED:
+        try:
+            query_embedding = embed_query(question, deadline)
+        except Exception:
+            query_embedding = None
+        if query_embedding is not None:
+            cache_version = _semantic_cache.version()
+            cached = _semantic_cache.lookup(query_embedding)
+            if cached is not None:
+                payload = cached["payload"]
+                emit_rag_step("⚡", "命中语义缓存，复用检索结果", f"相似度: {cached['similarity']}")
+                rag_trace = payload.get("rag_trace") or {}
+                rag_trace.update({
+                    "query": question,
+                    "semantic_cache_hit": True,
+                    "semantic_cache_similarity": cached["similarity"],
+                    "semantic_cache_question": cached["question"],
+                    "deadline_ms": budget_ms if budget_ms > 0 else None,
+                    "skipped_stages": [],
+                })
+                return {
+                    "question": question,
+                    "query": question,
+                    "docs": payload.get("docs", []),
+                    "context": payload.get("context", ""),
+                    "rag_trace": rag_trace,
+                }
+
+    result = rag_graph.invoke({
         "question": question,
         "query": question,
         "context": "",
@@ -398,5 +975,28 @@ def run_rag_graph(question: str) -> dict:
         "step_back_question": None,
         "step_back_answer": None,
         "hypothetical_doc": None,
+        "step_back_retrieval": None,
+        "hyde_retrieval": None,
         "rag_trace": None,
+        "deadline": deadline,
+        "query_embedding": query_embedding,
+        "skipped_stages": [],
     })
+    rag_trace = result.get("rag_trace")
+    if rag_trace is not None:
+        rag_trace["deadline_ms"] = budget_ms if budget_ms > 0 else None
+        rag_trace["skipped_stages"] = list(dict.fromkeys(result.get("skipped_stages") or []))
+        if SEMANTIC_CACHE_ENABLED:
+            rag_trace["semantic_cache_hit"] = False
+    if query_embedding is not None and _cacheable(result):
+        _semantic_cache.store(
+            question,
+            query_embedding,
+            {
+                "docs": result.get("docs", []),
+                "context": result.get("context", ""),
+                "rag_trace": rag_trace,
+            },
+            version=cache_version,
+        )
+    return result
@@ -1,13 +1,17 @@
 from collections import defaultdict
-from typing import List, Tuple, Dict, Any
-import os
+from functools import partial
+from typing import List, Tuple, Dict, Any, Optional
 import json
-import requests
+import os
+import time
 from dotenv import load_dotenv
 
 from milvus_client import MilvusManager
 from embedding import EmbeddingService
 from parent_chunk_store import ParentChunkStore
+from rerank_client import RerankClient, LocalReranker
+from circuit_breaker import CircuitBreaker
+from singleflight import SingleFlight, budget_bucket, follower_wait, normalize_query
 from langchain.chat_models import init_chat_model
 
 load_dotenv()
@@ -18,16 +22,48 @@ BASE_URL = os.getenv("BASE_URL")
 RERANK_MODEL = os.getenv("RERANK_MODEL")
 RERANK_BINDING_HOST = os.getenv("RERANK_BINDING_HOST")
 RERANK_API_KEY = os.getenv("RERANK_API_KEY")
+# 精排后端：remote（远程 API，不可用时回退本地）、local（始终本地 BM25 混合精排）、none（不精排）
+RERANK_BACKEND = os.getenv("RERANK_BACKEND", "remote").lower()
+RERANK_LOCAL_FALLBACK = os.getenv("RERANK_LOCAL_FALLBACK", "true").lower() != "false"
+# 远程精排的延迟预算（毫秒），作为读超时；超出即回退本地精排。0 表示使用 RERANK_READ_TIMEOUT
+RERANK_LATENCY_BUDGET_MS = int(os.getenv("RERANK_LATENCY_BUDGET_MS", "0"))
 AUTO_MERGE_ENABLED = os.getenv("AUTO_MERGE_ENABLED", "true").lower() != "false"
 AUTO_MERGE_THRESHOLD = int(os.getenv("AUTO_MERGE_THRESHOLD", "2"))
+# 覆盖率阈值（0~1）：父块被召回的子块占比达到该值即合并，0 表示只按 AUTO_MERGE_THRESHOLD 个数判断
+AUTO_MERGE_RATIO = float(os.getenv("AUTO_MERGE_RATIO", "0"))
 LEAF_RETRIEVE_LEVEL = int(os.getenv("LEAF_RETRIEVE_LEVEL", "3"))
+# 检索后端熔断：连续失败达到阈值后，冷却期内直接跳过该路径
+RETRIEVAL_BREAKER_FAILURES = int(os.getenv("RETRIEVAL_BREAKER_FAILURES", "2"))
+RETRIEVAL_BREAKER_COOLDOWN = float(os.getenv("RETRIEVAL_BREAKER_COOLDOWN", "60"))
+# 请求剩余预算低于该值（毫秒）时不再调用远程精排
+DEADLINE_MIN_RERANK_MS = int(os.getenv("DEADLINE_MIN_RERANK_MS", "300"))
+# 请求剩余预算低于该值（毫秒）时不再扩大候选数重新召回
+DEADLINE_MIN_WIDEN_MS = int(os.getenv("DEADLINE_MIN_WIDEN_MS", "800"))
+# 必经的召回调用（嵌入、Milvus 检索）在预算耗尽时仍保留的最短超时（毫秒），避免无结果可答
+DEADLINE_MIN_CALL_MS = int(os.getenv("DEADLINE_MIN_CALL_MS", "200"))
+# 由粗到细检索：先在 L1 根块小索引中选出 COARSE_TOP_ROOTS 个根块，再只在其下的叶子中检索
+COARSE_TO_FINE_ENABLED = os.getenv("COARSE_TO_FINE_ENABLED", "false").lower() == "true"
+COARSE_TOP_ROOTS = int(os.getenv("COARSE_TOP_ROOTS", "8"))
+# 根块索引覆盖检查结果的缓存时间（秒），知识库版本变化时立即重新检查
+ROOT_COVERAGE_TTL = float(os.getenv("ROOT_COVERAGE_TTL", "30"))
+# 自适应候选数：先召回 top_k * MIN_FACTOR 个候选，召回分数或精排分数显示头部不明确时扩大到 top_k * MAX_FACTOR
+ADAPTIVE_CANDIDATE_ENABLED = os.getenv("ADAPTIVE_CANDIDATE_ENABLED", "true").lower() != "false"
+ADAPTIVE_CANDIDATE_MIN_FACTOR = int(os.getenv("ADAPTIVE_CANDIDATE_MIN_FACTOR", "2"))
+ADAPTIVE_CANDIDATE_MAX_FACTOR = int(os.getenv("ADAPTIVE_CANDIDATE_MAX_FACTOR", "4"))
+# 稠密降级模式（内积分数）下的相对分数落差阈值
+ADAPTIVE_SCORE_GAP = float(os.getenv("ADAPTIVE_SCORE_GAP", "0.15"))
+# 混合检索（RRF 分数）下，前 top_k 中同时被稠密、稀疏两路召回的占比低于该值时视为头部不明确
+ADAPTIVE_LEG_AGREEMENT = float(os.getenv("ADAPTIVE_LEG_AGREEMENT", "0.6"))
+ADAPTIVE_RERANK_SPREAD = float(os.getenv("ADAPTIVE_RERANK_SPREAD", "0.05"))
+# 相同查询的并发检索合并为一次
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() != "false"
 
 # 全局初始化检索依赖，避免反复构造
 _embedding_service = EmbeddingService()
 _milvus_manager = MilvusManager()
 _parent_chunk_store = ParentChunkStore()
 
-_stepback_model = None
+_stepback_models: Dict[bool, Any] = {}
 
 
 def _get_rerank_endpoint() -> str:
@@ -37,80 +73,229 @@ def _get_rerank_endpoint() -> str:
     return host if host.endswith("/v1/rerank") else f"{host}/v1/rerank"
 
 
-def _merge_to_parent_level(docs: List[dict], threshold: int = 2) -> Tuple[List[dict], int]:
+_rerank_client = RerankClient(
+    endpoint=_get_rerank_endpoint(),
+    model=RERANK_MODEL,
+    api_key=RERANK_API_KEY,
+)
+_local_reranker = LocalReranker(tokenize=_embedding_service.tokenize)
+
+_retrieval_flight = SingleFlight()
+
+# 检索后端健康状态，进程内共享
+_hybrid_breaker = CircuitBreaker(
+    "hybrid_search",
+    failure_threshold=RETRIEVAL_BREAKER_FAILURES,
+    cooldown=RETRIEVAL_BREAKER_COOLDOWN,
+)
+_dense_breaker = CircuitBreaker(
+    "dense_search",
+    failure_threshold=RETRIEVAL_BREAKER_FAILURES,
+    cooldown=RETRIEVAL_BREAKER_COOLDOWN,
+)
+
+
+def get_retrieval_health() -> Dict[str, Any]:
+    """检索后端健康状态快照，hybrid 熔断时处于稠密降级模式。"""
+    hybrid = _hybrid_breaker.snapshot()
+    dense = _dense_breaker.snapshot()
+    if dense["state"] == "open":
+        mode = "unavailable"
+    elif hybrid["state"] != "closed":
+        mode = "dense_fallback"
+    else:
+        mode = "hybrid"
+    return {
+        "degraded": mode != "hybrid",
+        "retrieval_mode": mode,
+        "backends": {
+            "hybrid_search": hybrid,
+            "dense_search": dense,
+            "rerank": _rerank_client.breaker.snapshot(),
+        },
+        "retrieval_singleflight": _retrieval_flight.stats(),
+        # 服务端 BM25 模式不使用 Python 端统计
+        "bm25_stats": None if _milvus_manager.uses_server_bm25() else _embedding_service.stats_summary(),
+    }
+
+
+def _remote_rerank_configured() -> bool:
+    return bool(RERANK_MODEL and RERANK_API_KEY and RERANK_BINDING_HOST)
+
+
+def _rerank_enabled() -> bool:
+    if RERANK_BACKEND == "none":
+        return False
+    if RERANK_BACKEND == "local":
+        return True
+    return _remote_rerank_configured() or RERANK_LOCAL_FALLBACK
+
+
+def _should_merge(present: int, parent: dict) -> bool:
+    """覆盖率模式下按 已召回子块数 / 父块子块总数 判断；历史数据缺少 child_count 时退回固定个数阈值。"""
+    child_count = int(parent.get("child_count") or 0)
+    if AUTO_MERGE_RATIO > 0 and child_count > 0:
+        return present / child_count >= AUTO_MERGE_RATIO
+    return present >= AUTO_MERGE_THRESHOLD
+
+
+def _matched_spans(parent_text: str, children: List[dict]) -> List[List[int]]:
+    """命中子块（及其已合并的更深层叶子）在父块正文中的区间，供上下文打包时按句裁剪。"""
+    spans = []
+    for child in children:
+        offset = parent_text.find(child.get("text", "")) if child.get("text") else -1
+        if offset < 0:
+            continue
+        child_spans = child.get("matched_spans") or [[0, len(child.get("text", ""))]]
+        spans.extend([offset + start, offset + end] for start, end in child_spans)
+    return sorted(spans)
+
+
+def _merge_level(docs: List[dict], ancestors: Dict[str, dict]) -> Tuple[List[dict], int]:
+    """在内存中把满足条件的兄弟块替换为父块，返回 (新列表, 被替换的子块数)。"""
     groups: Dict[str, List[dict]] = defaultdict(list)
     for doc in docs:
         parent_id = (doc.get("parent_chunk_id") or "").strip()
-        if parent_id:
+        if parent_id in ancestors:
             groups[parent_id].append(doc)
 
-    merge_parent_ids = [parent_id for parent_id, children in groups.items() if len(children) >= threshold]
+    merge_parent_ids = {
+        parent_id for parent_id, children in groups.items()
+        if _should_merge(len(children), ancestors[parent_id])
+    }
     if not merge_parent_ids:
         return docs, 0
 
-    parent_docs = _parent_chunk_store.get_documents_by_ids(merge_parent_ids)
-    parent_map = {item.get("chunk_id", ""): item for item in parent_docs if item.get("chunk_id")}
-
     merged_docs: List[dict] = []
+    emitted = set()
     merged_count = 0
     for doc in docs:
         parent_id = (doc.get("parent_chunk_id") or "").strip()
-        if not parent_id or parent_id not in parent_map:
-            merged_docs.append(doc)
+        if parent_id not in merge_parent_ids:
+            key = doc.get("chunk_id") or (doc.get("filename"), doc.get("page_number"), doc.get("text"))
+            if key not in emitted:
+                emitted.add(key)
+                merged_docs.append(doc)
             continue
-        parent_doc = dict(parent_map[parent_id])
-        score = doc.get("score")
-        if score is not None:
-            parent_doc["score"] = max(float(parent_doc.get("score", score)), float(score))
+        merged_count += 1
+        if parent_id in emitted:
+            continue
+        emitted.add(parent_id)
+        children = groups[parent_id]
+        parent_doc = dict(ancestors[parent_id])
+        scores = [float(child["score"]) for child in children if child.get("score") is not None]
+        if scores:
+            parent_doc["score"] = max(scores)
         parent_doc["merged_from_children"] = True
-        parent_doc["merged_child_count"] = len(groups[parent_id])
+        parent_doc["merged_child_count"] = len(children)
+        parent_doc["matched_spans"] = _matched_spans(parent_doc.get("text", ""), children)
+        if parent_doc.get("child_count"):
+            parent_doc["merged_coverage"] = round(len(children) / int(parent_doc["child_count"]), 4)
         merged_docs.append(parent_doc)
-        merged_count += 1
+    return merged_docs, merged_count
 
-    deduped: List[dict] = []
-    seen = set()
-    for item in merged_docs:
-        key = item.get("chunk_id") or (item.get("filename"), item.get("page_number"), item.get("text"))
-        if key in seen:
-            continue
-        seen.add(key)
-        deduped.append(item)
 
-    return deduped, merged_count
+def _auto_merge_documents(docs: List[dict], top_k: int, enabled: bool = True) -> Tuple[List[dict], Dict[str, Any]]:
+    meta = {
+        "auto_merge_enabled": AUTO_MERGE_ENABLED,
+        "auto_merge_applied": False,
+        "auto_merge_threshold": AUTO_MERGE_THRESHOLD,
+        "auto_merge_ratio": AUTO_MERGE_RATIO,
+        "auto_merge_replaced_chunks": 0,
+        "auto_merge_steps": 0,
+    }
+    if not AUTO_MERGE_ENABLED or not enabled or not docs:
+        return docs[:top_k], meta
+
+    # 叶子块同时携带父块与根块 ID，一次批量查询即可拿到 L3->L2->L1 整棵树所需的全部祖先
+    ancestors = _parent_chunk_store.get_ancestors(docs)
+
+    # 自底向上逐层合并（L3->L2，再 L2->L1），全部在内存中完成
+    merged_docs = docs
+    replaced_count = 0
+    steps = 0
+    for _ in range(2):
+        merged_docs, merged_count = _merge_level(merged_docs, ancestors)
+        if not merged_count:
+            break
+        replaced_count += merged_count
+        steps += 1
+
+    merged_docs = sorted(merged_docs, key=lambda item: item.get("score", 0.0), reverse=True)[:top_k]
+    meta.update({
+        "auto_merge_applied": replaced_count > 0,
+        "auto_merge_replaced_chunks": replaced_count,
+        "auto_merge_steps": steps,
+    })
+    return merged_docs, meta
 
 
-def _auto_merge_documents(docs: List[dict], top_k: int) -> Tuple[List[dict], Dict[str, Any]]:
-    if not AUTO_MERGE_ENABLED or not docs:
-        return docs[:top_k], {
-            "auto_merge_enabled": AUTO_MERGE_ENABLED,
-            "auto_merge_applied": False,
-            "auto_merge_threshold": AUTO_MERGE_THRESHOLD,
-            "auto_merge_replaced_chunks": 0,
-            "auto_merge_steps": 0,
-        }
+def remaining_ms(deadline: Optional[float]) -> Optional[float]:
+    """距截止时间（time.monotonic 时间戳）的剩余毫秒数；未设置截止时间返回 None。"""
+    if deadline is None:
+        return None
+    return (deadline - time.monotonic()) * 1000
 
-    # 两段自动合并：L3->L2，再 L2->L1。
-    merged_docs, merged_count_l3_l2 = _merge_to_parent_level(docs, threshold=AUTO_MERGE_THRESHOLD)
-    merged_docs, merged_count_l2_l1 = _merge_to_parent_level(merged_docs, threshold=AUTO_MERGE_THRESHOLD)
 
-    merged_docs.sort(key=lambda item: item.get("score", 0.0), reverse=True)
-    merged_docs = merged_docs[:top_k]
+def call_timeout(deadline: Optional[float]) -> Optional[float]:
+    """必经调用的超时（秒）：剩余预算，不低于 DEADLINE_MIN_CALL_MS；未设置截止时间返回 None。"""
+    left_ms = remaining_ms(deadline)
+    if left_ms is None:
+        return None
+    return max(left_ms, DEADLINE_MIN_CALL_MS) / 1000
 
-    replaced_count = merged_count_l3_l2 + merged_count_l2_l1
-    return merged_docs, {
-        "auto_merge_enabled": AUTO_MERGE_ENABLED,
-        "auto_merge_applied": replaced_count > 0,
-        "auto_merge_threshold": AUTO_MERGE_THRESHOLD,
-        "auto_merge_replaced_chunks": replaced_count,
-        "auto_merge_steps": int(merged_count_l3_l2 > 0) + int(merged_count_l2_l1 > 0),
-    }
+
+def invoke_with_deadline(deadline: Optional[float], runnable, prompt):
+    """以剩余预算作为模型请求自身的超时调用 runnable，超时或预算已耗尽时抛出 TimeoutError。
+    runnable 应来自 max_retries=0 的模型实例，否则客户端重试会把超时放大数倍。"""
+    left_ms = remaining_ms(deadline)
+    if left_ms is None:
+        return runnable.invoke(prompt)
+    if left_ms <= 0:
+        raise TimeoutError("deadline exceeded")
+    try:
+        return runnable.invoke(prompt, timeout=left_ms / 1000)
+    except Exception as e:
+        left_ms = remaining_ms(deadline)
+        if left_ms is not None and left_ms <= 0:
+            raise TimeoutError("deadline exceeded") from e
+        raise
+
+
+def _local_semantic_scores(
+    docs: List[dict],
+    dense_embedding: Optional[List[float]],
+    retrieval_mode: Optional[str],
+    deadline: Optional[float],
+) -> Optional[Dict[str, float]]:
+    """本地精排的语义分数。混合检索的候选分数是 RRF 名次分，补取一次候选的稠密内积；
+    稠密降级模式的分数本身就是内积。预算不足或查询失败时返回 None（退回召回分数）。"""
+    if retrieval_mode != "hybrid" or dense_embedding is None:
+        return None
+    left_ms = remaining_ms(deadline)
+    if left_ms is not None and left_ms < DEADLINE_MIN_RERANK_MS:
+        return None
+    try:
+        return _milvus_manager.dense_scores(
+            dense_embedding, [doc.get("chunk_id", "") for doc in docs], timeout=call_timeout(deadline)
+        )
+    except Exception:
+        return None
 
 
-def _rerank_documents(query: str, docs: List[dict], top_k: int) -> Tuple[List[dict], Dict[str, Any]]:
+def _rerank_documents(
+    query: str,
+    docs: List[dict],
+    top_k: int,
+    deadline: Optional[float] = None,
+    dense_embedding: Optional[List[float]] = None,
+    retrieval_mode: Optional[str] = None,
+) -> Tuple[List[dict], Dict[str, Any]]:
     docs_with_rank = [{**doc, "rrf_rank": i} for i, doc in enumerate(docs, 1)]
     meta: Dict[str, Any] = {
-        "rerank_enabled": bool(RERANK_MODEL and RERANK_API_KEY and RERANK_BINDING_HOST),
+        "rerank_enabled": _rerank_enabled(),
         "rerank_applied": False,
+        "rerank_backend": None,
         "rerank_model": RERANK_MODEL,
         "rerank_endpoint": _get_rerank_endpoint(),
         "rerank_error": None,
@@ -119,68 +304,55 @@ def _rerank_documents(query: str, docs: List[dict], top_k: int) -> Tuple[List[di
     if not docs_with_rank or not meta["rerank_enabled"]:
         return docs_with_rank[:top_k], meta
 
-    payload = {
-        "model": RERANK_MODEL,
-        "query": query,
-        "documents": [doc.get("text", "") for doc in docs_with_rank],
-        "top_n": min(top_k, len(docs_with_rank)),
-        "return_documents": False,
-    }
+    if RERANK_BACKEND == "remote" and _remote_rerank_configured():
+        budget_ms = RERANK_LATENCY_BUDGET_MS if RERANK_LATENCY_BUDGET_MS > 0 else None
+        left_ms = remaining_ms(deadline)
+        if left_ms is not None and left_ms < DEADLINE_MIN_RERANK_MS:
+            # 剩余预算不足以等一次远程调用，直接走本地精排（或保持召回顺序）
+            meta["rerank_error"] = "deadline"
+            meta["deadline_skipped"] = ["rerank_remote"]
+            if not RERANK_LOCAL_FALLBACK:
+                return docs_with_rank[:top_k], meta
+        else:
+            if left_ms is not None:
+                budget_ms = min(budget_ms, left_ms) if budget_ms else left_ms
+            timeout = budget_ms / 1000 if budget_ms else None
+            reranked, client_meta = _rerank_client.rerank(query, docs_with_rank, top_k, timeout=timeout)
+            meta.update(client_meta)
+            if reranked:
+                meta["rerank_backend"] = "remote"
+                return reranked, meta
+            if not RERANK_LOCAL_FALLBACK:
+                return docs_with_rank[:top_k], meta
+        meta["rerank_backend"] = "local_fallback"
+    else:
+        meta["rerank_backend"] = "local"
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {RERANK_API_KEY}",
-    }
-    try:
-        meta["rerank_applied"] = True
-        response = requests.post(
-            meta["rerank_endpoint"],
-            headers=headers,
-            json=payload,
-            timeout=15,
-        )
-        if response.status_code >= 400:
-            meta["rerank_error"] = f"HTTP {response.status_code}: {response.text}"
-            return docs_with_rank[:top_k], meta
-
-        items = response.json().get("results", [])
-        reranked = []
-        for item in items:
-            idx = item.get("index")
-            if isinstance(idx, int) and 0 <= idx < len(docs_with_rank):
-                doc = dict(docs_with_rank[idx])
-                score = item.get("relevance_score")
-                if score is not None:
-                    doc["rerank_score"] = score
-                reranked.append(doc)
-
-        if reranked:
-            return reranked[:top_k], meta
-
-        meta["rerank_error"] = "empty_rerank_results"
-        return docs_with_rank[:top_k], meta
-    except (requests.RequestException, json.JSONDecodeError, KeyError, ValueError, TypeError) as e:
-        meta["rerank_error"] = str(e)
-        return docs_with_rank[:top_k], meta
+    semantic_scores = _local_semantic_scores(docs_with_rank, dense_embedding, retrieval_mode, deadline)
+    reranked, local_meta = _local_reranker.rerank(query, docs_with_rank, top_k, semantic_scores=semantic_scores)
+    meta.update(local_meta)
+    meta["rerank_model"] = "local_bm25"
+    return reranked, meta
 
 
-def _get_stepback_model():
-    global _stepback_model
+def _get_stepback_model(bounded: bool = False):
+    """bounded=True 返回不重试的实例，供按截止时间限时的调用使用。"""
     if not ARK_API_KEY or not MODEL:
         return None
-    if _stepback_model is None:
-        _stepback_model = init_chat_model(
+    if bounded not in _stepback_models:
+        _stepback_models[bounded] = init_chat_model(
             model=MODEL,
             model_provider="openai",
             api_key=ARK_API_KEY,
             base_url=BASE_URL,
             temperature=0.2,
+            **({"max_retries": 0} if bounded else {}),
         )
-    return _stepback_model
+    return _stepback_models[bounded]
 
 
-def _generate_step_back_question(query: str) -> str:
-    model = _get_stepback_model()
+def _generate_step_back_question(query: str, deadline: Optional[float] = None) -> str:
+    model = _get_stepback_model(deadline is not None)
     if not model:
         return ""
     prompt = (
@@ -189,13 +361,13 @@ def _generate_step_back_question(query: str) -> str:
         f"用户问题：{query}"
     )
     try:
-        return (model.invoke(prompt).content or "").strip()
+        return (invoke_with_deadline(deadline, model, prompt).content or "").strip()
     except Exception:
         return ""
 
 
-def _answer_step_back_question(step_back_question: str) -> str:
-    model = _get_stepback_model()
+def _answer_step_back_question(step_back_question: str, deadline: Optional[float] = None) -> str:
+    model = _get_stepback_model(deadline is not None)
     if not model or not step_back_question:
         return ""
     prompt = (
@@ -204,13 +376,13 @@ def _answer_step_back_question(step_back_question: str) -> str:
         f"退步问题：{step_back_question}"
     )
     try:
-        return (model.invoke(prompt).content or "").strip()
+        return (invoke_with_deadline(deadline, model, prompt).content or "").strip()
     except Exception:
         return ""
 
 
-def generate_hypothetical_document(query: str) -> str:
-    model = _get_stepback_model()
+def generate_hypothetical_document(query: str, deadline: Optional[float] = None) -> str:
+    model = _get_stepback_model(deadline is not None)
     if not model:
         return ""
     prompt = (
@@ -220,22 +392,25 @@ def generate_hypothetical_document(query: str) -> str:
         f"用户问题：{query}"
     )
     try:
-        return (model.invoke(prompt).content or "").strip()
+        return (invoke_with_deadline(deadline, model, prompt).content or "").strip()
     except Exception:
         return ""
 
 
-def step_back_expand(query: str) -> dict:
-    step_back_question = _generate_step_back_question(query)
-    step_back_answer = _answer_step_back_question(step_back_question)
-    if step_back_question or step_back_answer:
-        expanded_query = (
-            f"{query}\n\n"
-            f"退步问题：{step_back_question}\n"
-            f"退步问题答案：{step_back_answer}"
-        )
-    else:
-        expanded_query = query
+def build_step_back_query(query: str, step_back_question: str, step_back_answer: str) -> str:
+    if not (step_back_question or step_back_answer):
+        return query
+    return (
+        f"{query}\n\n"
+        f"退步问题：{step_back_question}\n"
+        f"退步问题答案：{step_back_answer}"
+    )
+
+
+def step_back_expand(query: str, deadline: Optional[float] = None) -> dict:
+    step_back_question = _generate_step_back_question(query, deadline)
+    step_back_answer = _answer_step_back_question(step_back_question, deadline)
+    expanded_query = build_step_back_query(query, step_back_question, step_back_answer)
     return {
         "step_back_question": step_back_question,
         "step_back_answer": step_back_answer,
@@ -243,60 +418,339 @@ def step_back_expand(query: str) -> dict:
     }
 
 
-def retrieve_documents(query: str, top_k: int = 5) -> Dict[str, Any]:
-    candidate_k = max(top_k * 3, top_k)
-    filter_expr = f"chunk_level == {LEAF_RETRIEVE_LEVEL}"
-    try:
-        dense_embeddings = _embedding_service.get_embeddings([query])
-        dense_embedding = dense_embeddings[0]
-        sparse_embedding = _embedding_service.get_sparse_embedding(query)
+def query_term_overlap(query: str, docs: List[dict]) -> float:
+    """查询词在文档中出现的比例（基于 BM25 同款分词），用作快速相关性信号。"""
+    query_terms = set(_embedding_service.tokenize(query))
+    if not query_terms or not docs:
+        return 0.0
+    doc_terms = set()
+    for doc in docs:
+        doc_terms.update(_embedding_service.tokenize(doc.get("text", "")))
+    return len(query_terms & doc_terms) / len(query_terms)
 
-        retrieved = _milvus_manager.hybrid_retrieve(
-            dense_embedding=dense_embedding,
-            sparse_embedding=sparse_embedding,
-            top_k=candidate_k,
-            filter_expr=filter_expr,
+
+def _failed_retrieval(candidate_k: int, error: str = "retrieve_failed") -> Dict[str, Any]:
+    return {
+        "docs": [],
+        "meta": {
+            "rerank_enabled": _rerank_enabled(),
+            "rerank_applied": False,
+            "rerank_model": RERANK_MODEL,
+            "rerank_endpoint": _get_rerank_endpoint(),
+            "rerank_error": error,
+            "retrieval_mode": "failed",
+            "candidate_k": candidate_k,
+            "leaf_retrieve_level": LEAF_RETRIEVE_LEVEL,
+            "auto_merge_enabled": AUTO_MERGE_ENABLED,
+            "auto_merge_applied": False,
+            "auto_merge_threshold": AUTO_MERGE_THRESHOLD,
+            "auto_merge_ratio": AUTO_MERGE_RATIO,
+            "auto_merge_replaced_chunks": 0,
+            "auto_merge_steps": 0,
+            "candidate_count": 0,
+            "hybrid_breaker_state": _hybrid_breaker.state,
+        },
+    }
+
+
+def embed_query(query: str, deadline: Optional[float] = None) -> List[float]:
+    return _embedding_service.get_embeddings([query], timeout=call_timeout(deadline))[0]
+
+
+def get_knowledge_base_version():
+    """知识库版本戳：上传 / 删除（含其他进程）在 Milvus 与本地分块存储都写完后才变化。"""
+    return _parent_chunk_store.get_generation()
+
+
+def retrieve_documents(
+    query: str,
+    top_k: int = 5,
+    deadline: Optional[float] = None,
+    dense_embedding: Optional[List[float]] = None,
+    search_params: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """三级分块检索：召回 -> 精排 -> 自动合并。相同查询（归一化后）、知识库版本与预算分档的并发调用只执行一次，
+    等待者最多用掉 SINGLEFLIGHT_WAIT_FRACTION 的剩余预算等待，超时后用余下预算自行检索；
+    到达时预算已耗尽的等待者不再自行检索，超时返回失败结果。
+    :param deadline: 请求截止时间（time.monotonic 时间戳），嵌入与 Milvus 调用以剩余预算为超时，
+        预算不足时跳过候选扩大、远程精排与自动合并
+    :param dense_embedding: 已算好的查询向量（如语义缓存查询时得到的），避免重复调用嵌入 API
+    :param search_params: 单次请求覆盖的检索参数 {"ef", "drop_ratio_search", "rrf_k"}，缺省取 MILVUS_* 配置
+    """
+    search_params = _milvus_manager.resolve_search_params(search_params)
+    if not SINGLEFLIGHT_ENABLED:
+        return _retrieve_documents(query, top_k, deadline, dense_embedding, search_params)
+    left_ms = remaining_ms(deadline)
+    key = (
+        normalize_query(query),
+        top_k,
+        get_knowledge_base_version(),
+        tuple(sorted(search_params.items())),
+        budget_bucket(left_ms),
+    )
+    if left_ms is not None and left_ms <= 0:
+        # 预算已耗尽：只给 leader 必经调用的最短时间，仍未完成则返回失败结果，不再发起新的检索
+        wait_timeout = DEADLINE_MIN_CALL_MS / 1000
+        on_timeout = partial(_failed_retrieval, top_k, "deadline")
+    else:
+        wait_timeout, on_timeout = follower_wait(left_ms), None
+    result, shared = _retrieval_flight.do(
+        key, _retrieve_documents, query, top_k, deadline, dense_embedding, search_params,
+        wait_timeout=wait_timeout, on_timeout=on_timeout,
+    )
+    result["meta"]["retrieval_coalesced"] = shared
+    return result
+
+
+_root_coverage: Dict[str, Any] = {"version": None, "checked_at": 0.0, "covered": False}
+
+
+def _roots_cover_knowledge_base() -> bool:
+    """根块索引是否覆盖知识库全部 L1 根块。部分覆盖（开启由粗到细检索前入库、尚未回填的文档）时，
+    root_chunk_id 过滤会漏掉这些文档，只能走全量叶子检索。按知识库版本与 ROOT_COVERAGE_TTL 缓存。"""
+    version = get_knowledge_base_version()
+    now = time.monotonic()
+    if _root_coverage["version"] == version and now - _root_coverage["checked_at"] < ROOT_COVERAGE_TTL:
+        return _root_coverage["covered"]
+    try:
+        root_total = _parent_chunk_store.count_by_level(1)
+        covered = root_total > 0 and _milvus_manager.count_roots() >= root_total
+    except Exception:
+        return False
+    _root_coverage.update({"version": version, "checked_at": now, "covered": covered})
+    return covered
+
+
+def _coarse_root_ids(
+    dense_embedding: List[float],
+    search_params: Dict[str, Any],
+    deadline: Optional[float] = None,
+) -> List[str]:
+    """由粗到细第一阶段：返回最相关的根块 ID；根块索引缺失、未覆盖全部文档或查询失败时返回空列表（退回全量叶子检索）。"""
+    if not _roots_cover_knowledge_base():
+        return []
+    try:
+        roots = _milvus_manager.search_roots(
+            dense_embedding, top_k=COARSE_TOP_ROOTS, search_params=search_params, timeout=call_timeout(deadline)
         )
-        reranked, rerank_meta = _rerank_documents(query=query, docs=retrieved, top_k=top_k)
-        merged_docs, merge_meta = _auto_merge_documents(docs=reranked, top_k=top_k)
-        rerank_meta["retrieval_mode"] = "hybrid"
-        rerank_meta["candidate_k"] = candidate_k
-        rerank_meta["leaf_retrieve_level"] = LEAF_RETRIEVE_LEVEL
-        rerank_meta.update(merge_meta)
-        return {"docs": merged_docs, "meta": rerank_meta}
     except Exception:
+        return []
+    return list(dict.fromkeys(root["chunk_id"] for root in roots if root.get("chunk_id")))
+
+
+def _hydrate_documents(docs: List[dict]) -> List[dict]:
+    """叶子正文外置时，按 chunk_id 一次批量从本地分块存储补全正文与元数据（保留召回分数）。
+    存储中缺失的（开启外置前入库的历史数据）回查 Milvus 行内字段，仍无正文的候选丢弃。"""
+    if not _milvus_manager.leaf_text_offload or not docs:
+        return docs
+    chunk_ids = [doc.get("chunk_id", "") for doc in docs]
+    records = {record["chunk_id"]: record for record in _parent_chunk_store.get_documents_by_ids(chunk_ids)}
+    missing = [chunk_id for chunk_id in chunk_ids if chunk_id and chunk_id not in records]
+    if missing:
         try:
-            dense_embeddings = _embedding_service.get_embeddings([query])
-            dense_embedding = dense_embeddings[0]
-            retrieved = _milvus_manager.dense_retrieve(
+            for row in _milvus_manager.get_chunks_by_ids(missing):
+                if row.get("text"):
+                    records.setdefault(row["chunk_id"], row)
+        except Exception:
+            pass
+    hydrated = []
+    for doc in docs:
+        record = records.get(doc.get("chunk_id"))
+        if record is not None:
+            hydrated.append({**record, "id": doc.get("id"), "score": doc.get("score", 0.0)})
+    return hydrated
+
+
+def _hydrate_or_none(docs: List[dict]) -> Optional[List[dict]]:
+    """补全召回结果的正文；本地分块存储不可用时按召回失败处理（返回 None），不影响检索熔断器。"""
+    try:
+        return _hydrate_documents(docs)
+    except Exception:
+        return None
+
+
+def hydrate_leaf_texts(chunk_ids: List[str], texts: List[str]) -> List[str]:
+    """叶子正文外置（LEAF_TEXT_OFFLOAD=true）时 Milvus 行内 text 为空，从本地分块存储补全；供离线脚本使用。"""
+    if all(texts):
+        return texts
+    records = {doc["chunk_id"]: doc.get("text", "") for doc in _hydrate_documents([{"chunk_id": item} for item in chunk_ids])}
+    return [text or records.get(chunk_id, "") for chunk_id, text in zip(chunk_ids, texts)]
+
+
+def _search_candidates(
+    query: str,
+    dense_embedding: List[float],
+    candidate_k: int,
+    filter_expr: str,
+    search_params: Dict[str, Any],
+    deadline: Optional[float] = None,
+) -> Tuple[Optional[List[dict]], str, Optional[str]]:
+    """召回一批候选，返回 (候选 | 失败时 None, retrieval_mode, hybrid_error)。Milvus 调用以剩余预算为超时。"""
+    hybrid_error = None
+    if _hybrid_breaker.allow_request():
+        try:
+            # 服务端 BM25 模式直接发送查询原文，由 Milvus 计算稀疏向量
+            sparse_embedding = None if _milvus_manager.uses_server_bm25() else _embedding_service.get_sparse_embedding(query)
+            retrieved = _milvus_manager.hybrid_retrieve(
                 dense_embedding=dense_embedding,
+                sparse_embedding=sparse_embedding,
                 top_k=candidate_k,
                 filter_expr=filter_expr,
+                search_params=search_params,
+                query_text=query,
+                timeout=call_timeout(deadline),
             )
-            reranked, rerank_meta = _rerank_documents(query=query, docs=retrieved, top_k=top_k)
-            merged_docs, merge_meta = _auto_merge_documents(docs=reranked, top_k=top_k)
-            rerank_meta["retrieval_mode"] = "dense_fallback"
-            rerank_meta["candidate_k"] = candidate_k
-            rerank_meta["leaf_retrieve_level"] = LEAF_RETRIEVE_LEVEL
-            rerank_meta.update(merge_meta)
-            return {"docs": merged_docs, "meta": rerank_meta}
+            _hybrid_breaker.record_success()
+        except Exception as e:
+            hybrid_error = str(e)
+            _hybrid_breaker.record_failure(hybrid_error)
+        else:
+            # 补全正文读的是本地分块存储，失败不应计入 Milvus 混合检索的熔断
+            return _hydrate_or_none(retrieved), "hybrid", None
+    else:
+        hybrid_error = "circuit_open"
+
+    # 稀疏路径失败或熔断中：复用已算好的稠密向量直接走稠密检索
+    if not _dense_breaker.allow_request():
+        return None, "dense_fallback", hybrid_error
+    try:
+        retrieved = _milvus_manager.dense_retrieve(
+            dense_embedding=dense_embedding,
+            top_k=candidate_k,
+            filter_expr=filter_expr,
+            search_params=search_params,
+            timeout=call_timeout(deadline),
+        )
+        _dense_breaker.record_success()
+    except Exception as e:
+        _dense_breaker.record_failure(str(e))
+        return None, "dense_fallback", hybrid_error
+    return _hydrate_or_none(retrieved), "dense_fallback", hybrid_error
+
+
+def _score_head_ambiguous(
+    docs: List[dict],
+    top_k: int,
+    candidate_k: int,
+    retrieval_mode: str = "dense_fallback",
+    rrf_k: int = 60,
+) -> bool:
+    """召回头部不明确时，更深处可能还有同等相关的片段。
+    稠密检索看内积分数：top_k 边界处仍接近头部（候选尾部下降不明显）。
+    混合检索的 RRF 分数只由排名决定、天然平坦（两路完全一致时相对落差也只有约 0.07），
+    改看两路是否一致：单路最高贡献 1/(k+1)，分数超过它的候选必定同时被两路召回。"""
+    if len(docs) < candidate_k or len(docs) <= top_k:
+        # 候选已取尽，扩大也拿不到更多
+        return False
+    scores = sorted((float(doc.get("score") or 0.0) for doc in docs), reverse=True)
+    if retrieval_mode == "hybrid":
+        single_leg_max = 1 / (rrf_k + 1)
+        agreed = sum(1 for score in scores[:top_k] if score > single_leg_max)
+        return agreed / top_k < ADAPTIVE_LEG_AGREEMENT
+    if scores[0] <= 0:
+        return True
+    return (scores[top_k - 1] - scores[-1]) / scores[0] < ADAPTIVE_SCORE_GAP
+
+
+def _rerank_head_ambiguous(docs: List[dict], top_k: int) -> bool:
+    """远程精排后头部分数拉不开差距，说明精排也无法区分，需要更多候选。"""
+    scores = [float(doc["rerank_score"]) for doc in docs[:top_k] if doc.get("rerank_score") is not None]
+    if len(scores) < 2:
+        return False
+    return max(scores) - min(scores) < ADAPTIVE_RERANK_SPREAD
+
+
+def _widen_budget_exhausted(deadline: Optional[float]) -> bool:
+    left_ms = remaining_ms(deadline)
+    return left_ms is not None and left_ms < DEADLINE_MIN_WIDEN_MS
+
+
+def _retrieve_documents(
+    query: str,
+    top_k: int,
+    deadline: Optional[float],
+    dense_embedding: Optional[List[float]],
+    search_params: Dict[str, Any],
+) -> Dict[str, Any]:
+    max_candidate_k = max(top_k * ADAPTIVE_CANDIDATE_MAX_FACTOR, top_k) if ADAPTIVE_CANDIDATE_ENABLED else max(top_k * 3, top_k)
+    candidate_k = max(top_k * ADAPTIVE_CANDIDATE_MIN_FACTOR, top_k) if ADAPTIVE_CANDIDATE_ENABLED else max_candidate_k
+    initial_candidate_k = candidate_k
+    filter_expr = f"chunk_level == {LEAF_RETRIEVE_LEVEL}"
+    if dense_embedding is None:
+        try:
+            dense_embedding = embed_query(query, deadline)
         except Exception:
-            return {
-                "docs": [],
-                "meta": {
-                    "rerank_enabled": bool(RERANK_MODEL and RERANK_API_KEY and RERANK_BINDING_HOST),
-                    "rerank_applied": False,
-                    "rerank_model": RERANK_MODEL,
-                    "rerank_endpoint": _get_rerank_endpoint(),
-                    "rerank_error": "retrieve_failed",
-                    "retrieval_mode": "failed",
-                    "candidate_k": candidate_k,
-                    "leaf_retrieve_level": LEAF_RETRIEVE_LEVEL,
-                    "auto_merge_enabled": AUTO_MERGE_ENABLED,
-                    "auto_merge_applied": False,
-                    "auto_merge_threshold": AUTO_MERGE_THRESHOLD,
-                    "auto_merge_replaced_chunks": 0,
-                    "auto_merge_steps": 0,
-                    "candidate_count": 0,
-                },
-            }
+            return _failed_retrieval(candidate_k, "embedding_failed")
+
+    root_ids = _coarse_root_ids(dense_embedding, search_params, deadline) if COARSE_TO_FINE_ENABLED else []
+    if root_ids:
+        quoted_ids = ", ".join(json.dumps(item, ensure_ascii=False) for item in root_ids)
+        filter_expr = f"{filter_expr} and root_chunk_id in [{quoted_ids}]"
+
+    retrieved, retrieval_mode, hybrid_error = _search_candidates(
+        query, dense_embedding, candidate_k, filter_expr, search_params, deadline
+    )
+    if retrieved is None:
+        return _failed_retrieval(candidate_k)
+
+    # 自适应候选数：先小批量召回，头部不明确时才扩大到 max_candidate_k；剩余预算不足时不再扩大
+    widen_reason = None
+    widen_skipped = False
+    if candidate_k < max_candidate_k and _score_head_ambiguous(
+        retrieved, top_k, candidate_k, retrieval_mode, search_params["rrf_k"]
+    ):
+        if _widen_budget_exhausted(deadline):
+            widen_skipped = True
+        else:
+            widened, retrieval_mode, hybrid_error = _search_candidates(
+                query, dense_embedding, max_candidate_k, filter_expr, search_params, deadline
+            )
+            if widened is not None:
+                retrieved, candidate_k, widen_reason = widened, max_candidate_k, "score_gap"
+
+    try:
+        reranked, rerank_meta = _rerank_documents(
+            query=query, docs=retrieved, top_k=top_k, deadline=deadline,
+            dense_embedding=dense_embedding, retrieval_mode=retrieval_mode,
+        )
+        if (
+            candidate_k < max_candidate_k
+            and rerank_meta.get("rerank_backend") == "remote"
+            and len(retrieved) >= candidate_k
+            and _rerank_head_ambiguous(reranked, top_k)
+        ):
+            if _widen_budget_exhausted(deadline):
+                widen_skipped = True
+            else:
+                widened, retrieval_mode, hybrid_error = _search_candidates(
+                    query, dense_embedding, max_candidate_k, filter_expr, search_params, deadline
+                )
+                if widened is not None:
+                    # 已打过分的候选命中 rerank 缓存，只为新增候选付费
+                    retrieved, candidate_k, widen_reason = widened, max_candidate_k, "rerank_spread"
+                    reranked, rerank_meta = _rerank_documents(
+                        query=query, docs=retrieved, top_k=top_k, deadline=deadline,
+                        dense_embedding=dense_embedding, retrieval_mode=retrieval_mode,
+                    )
+        if widen_skipped:
+            rerank_meta["deadline_skipped"] = rerank_meta.get("deadline_skipped", []) + ["widen"]
+        left_ms = remaining_ms(deadline)
+        if left_ms is not None and left_ms <= 0:
+            merged_docs, merge_meta = _auto_merge_documents(docs=reranked, top_k=top_k, enabled=False)
+            rerank_meta["deadline_skipped"] = rerank_meta.get("deadline_skipped", []) + ["auto_merge"]
+        else:
+            merged_docs, merge_meta = _auto_merge_documents(docs=reranked, top_k=top_k)
+    except Exception:
+        return _failed_retrieval(candidate_k)
+    rerank_meta["retrieval_mode"] = retrieval_mode
+    rerank_meta["coarse_to_fine"] = bool(root_ids)
+    rerank_meta["coarse_root_count"] = len(root_ids)
+    rerank_meta["hybrid_error"] = hybrid_error
+    rerank_meta["hybrid_breaker_state"] = _hybrid_breaker.state
+    rerank_meta["candidate_k"] = candidate_k
+    rerank_meta["candidate_k_initial"] = initial_candidate_k
+    rerank_meta["candidate_widened"] = widen_reason
+    rerank_meta["leaf_retrieve_level"] = LEAF_RETRIEVE_LEVEL
+    rerank_meta["search_params"] = search_params
+    rerank_meta.update(merge_meta)
+    return {"docs": merged_docs, "meta": rerank_meta}
@@ -0,0 +1,227 @@
+"""Rerank 客户端 - 连接复用、结果缓存与熔断"""
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Callable, Dict, List, Tuple
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+from circuit_breaker import CircuitBreaker
+
+load_dotenv()
+
+RERANK_CONNECT_TIMEOUT = float(os.getenv("RERANK_CONNECT_TIMEOUT", "3"))
+RERANK_READ_TIMEOUT = float(os.getenv("RERANK_READ_TIMEOUT", "15"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "4096"))
+RERANK_POOL_SIZE = int(os.getenv("RERANK_POOL_SIZE", "10"))
+RERANK_BREAKER_FAILURES = int(os.getenv("RERANK_BREAKER_FAILURES", "3"))
+RERANK_BREAKER_COOLDOWN = float(os.getenv("RERANK_BREAKER_COOLDOWN", "30"))
+# 本地精排中 BM25 分数的权重，其余权重给召回阶段分数
+LOCAL_RERANK_ALPHA = float(os.getenv("LOCAL_RERANK_ALPHA", "0.5"))
+
+
+class RerankClient:
+    """Rerank API 客户端：复用 HTTP 连接池，按 (query, chunk_id) 缓存相关性分数，连续失败后熔断。"""
+
+    def __init__(self, endpoint: str, model: str | None, api_key: str | None):
+        self.endpoint = endpoint
+        self.model = model
+        self.api_key = api_key
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=RERANK_POOL_SIZE, pool_maxsize=RERANK_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.breaker = CircuitBreaker(
+            "rerank",
+            failure_threshold=RERANK_BREAKER_FAILURES,
+            cooldown=RERANK_BREAKER_COOLDOWN,
+        )
+        self._cache: "OrderedDict[tuple, float]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    @staticmethod
+    def _cache_key(query: str, doc: dict) -> tuple:
+        # 同名文件重新上传后 chunk_id 不变，带上正文摘要避免命中过期分数
+        text = doc.get("text", "")
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+        return query, doc.get("chunk_id") or "", digest
+
+    def _cache_get(self, key: tuple) -> float | None:
+        with self._cache_lock:
+            score = self._cache.get(key)
+            if score is not None:
+                self._cache.move_to_end(key)
+            return score
+
+    def _cache_put(self, key: tuple, score: float) -> None:
+        if RERANK_CACHE_SIZE <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = score
+            self._cache.move_to_end(key)
+            while len(self._cache) > RERANK_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def _request_scores(self, query: str, docs: List[dict], timeout: float | None = None) -> Dict[int, float]:
+        """对 docs 全量打分，返回 {下标: 相关性分数}。"""
+        payload = {
+            "model": self.model,
+            "query": query,
+            "documents": [doc.get("text", "") for doc in docs],
+            # 取回全部分数以便写入缓存，排序截断在本地完成
+            "top_n": len(docs),
+            "return_documents": False,
+        }
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}",
+        }
+        response = self.session.post(
+            self.endpoint,
+            headers=headers,
+            json=payload,
+            timeout=(RERANK_CONNECT_TIMEOUT, timeout or RERANK_READ_TIMEOUT),
+        )
+        if response.status_code >= 400:
+            raise ValueError(f"HTTP {response.status_code}: {response.text}")
+
+        scores: Dict[int, float] = {}
+        for item in response.json().get("results", []):
+            idx = item.get("index")
+            score = item.get("relevance_score")
+            if isinstance(idx, int) and 0 <= idx < len(docs) and score is not None:
+                scores[idx] = float(score)
+        if not scores:
+            raise ValueError("empty_rerank_results")
+        return scores
+
+    def rerank(
+        self,
+        query: str,
+        docs: List[dict],
+        top_k: int,
+        timeout: float | None = None,
+    ) -> Tuple[List[dict] | None, Dict[str, Any]]:
+        """返回 (按 rerank_score 排序的前 top_k 个文档, 元信息)；无法精排时文档为 None。
+        :param timeout: 读超时（秒），用于按延迟预算截断，默认 RERANK_READ_TIMEOUT
+        """
+        meta: Dict[str, Any] = {
+            "rerank_applied": False,
+            "rerank_error": None,
+            "rerank_cache_hits": 0,
+        }
+        keys = [self._cache_key(query, doc) for doc in docs]
+        scores: Dict[int, float] = {}
+        for idx, key in enumerate(keys):
+            cached = self._cache_get(key)
+            if cached is not None:
+                scores[idx] = cached
+        meta["rerank_cache_hits"] = len(scores)
+
+        missing = [idx for idx in range(len(docs)) if idx not in scores]
+        if missing:
+            if not self.breaker.allow_request():
+                meta["rerank_error"] = "circuit_open"
+                meta["rerank_breaker"] = self.breaker.snapshot()
+                return None, meta
+            meta["rerank_applied"] = True
+            started = time.perf_counter()
+            try:
+                fetched = self._request_scores(query, [docs[idx] for idx in missing], timeout=timeout)
+            except Exception as e:
+                # 任何异常都要记为失败：半开探测若未记录结果，熔断器会一直停在 half_open 拒绝所有请求
+                self.breaker.record_failure(str(e))
+                meta["rerank_error"] = str(e)
+                meta["rerank_breaker"] = self.breaker.snapshot()
+                meta["rerank_latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                return None, meta
+            except BaseException:
+                self.breaker.record_failure("interrupted")
+                raise
+            meta["rerank_latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            self.breaker.record_success()
+            for local_idx, score in fetched.items():
+                idx = missing[local_idx]
+                scores[idx] = score
+                self._cache_put(keys[idx], score)
+        else:
+            meta["rerank_applied"] = True
+
+        meta["rerank_breaker"] = self.breaker.snapshot()
+        ordered = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        reranked = [{**docs[idx], "rerank_score": score} for idx, score in ordered[:top_k]]
+        return reranked, meta
+
+
+class LocalReranker:
+    """进程内轻量精排：在候选集内计算 BM25，并与稠密内积分数按权重混合（未提供时退回召回阶段分数）。
+    无网络调用，用作远程 rerank 未配置、熔断或超出延迟预算时的兜底。"""
+
+    def __init__(self, tokenize: Callable[[str], List[str]], k1: float = 1.5, b: float = 0.75):
+        self.tokenize = tokenize
+        self.k1 = k1
+        self.b = b
+
+    def _bm25_scores(self, query: str, docs: List[dict]) -> List[float]:
+        query_terms = set(self.tokenize(query))
+        doc_tokens = [self.tokenize(doc.get("text", "")) for doc in docs]
+        if not query_terms or not docs:
+            return [0.0] * len(docs)
+        doc_freq = Counter()
+        for tokens in doc_tokens:
+            doc_freq.update(set(tokens) & query_terms)
+        avg_len = sum(len(tokens) for tokens in doc_tokens) / len(doc_tokens) or 1.0
+        total = len(docs)
+        scores = []
+        for tokens in doc_tokens:
+            tf = Counter(token for token in tokens if token in query_terms)
+            norm = self.k1 * (1 - self.b + self.b * len(tokens) / avg_len)
+            score = 0.0
+            for term, freq in tf.items():
+                idf = math.log((total - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5) + 1)
+                score += idf * freq * (self.k1 + 1) / (freq + norm)
+            scores.append(score)
+        return scores
+
+    @staticmethod
+    def _normalize(values: List[float]) -> List[float]:
+        if not values:
+            return []
+        low, high = min(values), max(values)
+        if high - low <= 1e-12:
+            return [1.0 if high > 0 else 0.0 for _ in values]
+        return [(value - low) / (high - low) for value in values]
+
+    def rerank(
+        self,
+        query: str,
+        docs: List[dict],
+        top_k: int,
+        semantic_scores: Dict[str, float] | None = None,
+    ) -> Tuple[List[dict], Dict[str, Any]]:
+        """:param semantic_scores: {chunk_id: 稠密内积}，覆盖全部候选时替代召回分数参与混合。
+        混合检索的召回分数是 RRF 名次分，与 BM25 混合基本只会复现融合顺序。"""
+        started = time.perf_counter()
+        bm25 = self._normalize(self._bm25_scores(query, docs))
+        use_dense = bool(semantic_scores) and all(doc.get("chunk_id") in semantic_scores for doc in docs)
+        if use_dense:
+            raw = [float(semantic_scores[doc["chunk_id"]]) for doc in docs]
+        else:
+            raw = [float(doc.get("score") or 0.0) for doc in docs]
+        retrieval = self._normalize(raw)
+        mixed = [
+            LOCAL_RERANK_ALPHA * lexical + (1 - LOCAL_RERANK_ALPHA) * semantic
+            for lexical, semantic in zip(bm25, retrieval)
+        ]
+        order = sorted(range(len(docs)), key=lambda idx: mixed[idx], reverse=True)
+        reranked = [{**docs[idx], "rerank_score": round(mixed[idx], 6)} for idx in order[:top_k]]
+        return reranked, {
+            "rerank_applied": True,
+            "rerank_latency_ms": round((time.perf_counter() - started) * 1000, 3),
+            "local_rerank_semantic": "dense_ip" if use_dense else "retrieval_score",
+        }
@@ -29,22 +29,57 @@ class RagTrace(BaseModel):
     retrieval_stage: Optional[str] = None
     grade_score: Optional[str] = None
     grade_route: Optional[str] = None
+    grade_source: Optional[str] = None
+    grade_gate: Optional[str] = None
+    grade_gate_signals: Optional[dict] = None
     rewrite_needed: Optional[bool] = None
     rewrite_strategy: Optional[str] = None
     rewrite_query: Optional[str] = None
+    rewrite_mode: Optional[str] = None
+    speculative_rewrite: Optional[bool] = None
+    speculative_outcome: Optional[str] = None
+    speculative_hits: Optional[int] = None
+    speculative_wasted: Optional[int] = None
+    speculative_hit_rate: Optional[float] = None
+    speculative_window: Optional[int] = None
+    speculative_requests: Optional[int] = None
     rerank_enabled: Optional[bool] = None
     rerank_applied: Optional[bool] = None
+    rerank_backend: Optional[str] = None
     rerank_model: Optional[str] = None
     rerank_endpoint: Optional[str] = None
     rerank_error: Optional[str] = None
+    rerank_cache_hits: Optional[int] = None
+    rerank_breaker: Optional[dict] = None
+    local_rerank_semantic: Optional[str] = None
     retrieval_mode: Optional[str] = None
+    hybrid_breaker_state: Optional[str] = None
+    retrieval_coalesced: Optional[bool] = None
+    coalesced: Optional[bool] = None
+    coarse_to_fine: Optional[bool] = None
+    coarse_root_count: Optional[int] = None
     candidate_k: Optional[int] = None
+    candidate_k_initial: Optional[int] = None
+    candidate_widened: Optional[str] = None
+    search_params: Optional[dict] = None
     leaf_retrieve_level: Optional[int] = None
     auto_merge_enabled: Optional[bool] = None
     auto_merge_applied: Optional[bool] = None
     auto_merge_threshold: Optional[int] = None
+    auto_merge_ratio: Optional[float] = None
     auto_merge_replaced_chunks: Optional[int] = None
     auto_merge_steps: Optional[int] = None
+    context_token_budget: Optional[int] = None
+    context_tokens_before: Optional[int] = None
+    context_tokens: Optional[int] = None
+    context_trimmed_chunks: Optional[int] = None
+    context_dropped_chunks: Optional[int] = None
+    near_duplicates_dropped: Optional[int] = None
+    deadline_ms: Optional[int] = None
+    skipped_stages: Optional[List[str]] = None
+    semantic_cache_hit: Optional[bool] = None
+    semantic_cache_similarity: Optional[float] = None
+    semantic_cache_question: Optional[str] = None
     retrieved_chunks: Optional[List[RetrievedChunk]] = None
     initial_retrieved_chunks: Optional[List[RetrievedChunk]] = None
     expanded_retrieved_chunks: Optional[List[RetrievedChunk]] = None
@@ -102,3 +137,20 @@ class DocumentDeleteResponse(BaseModel):
     filename: str
     chunks_deleted: int
     message: str
+
+
+class RetrievalHealthResponse(BaseModel):
+    degraded: bool
+    retrieval_mode: str
+    backends: dict
+    retrieval_singleflight: Optional[dict] = None
+    bm25_stats: Optional[dict] = None
+    semantic_cache: Optional[dict] = None
+    speculation: Optional[dict] = None
+
+
+class MilvusLoadResponse(BaseModel):
+    load_state: dict
+    mmap: Optional[dict] = None
+    warm_up: Optional[dict] = None
+    message: str
@@ -0,0 +1,145 @@
+"""语义缓存 - 按查询向量相似度复用检索结果，知识库版本变化时整体失效"""
+import copy
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+
+
+class SemanticCache:
+    """进程内小型向量索引：保存 (查询向量, 检索结果)，新查询与某条缓存的余弦相似度
+    不低于 threshold 时直接命中。容量满时淘汰最久未使用的条目。"""
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        threshold: float = 0.95,
+        ttl: float = 0.0,
+        version_fn: Callable[[], Any] | None = None,
+    ):
+        self.max_entries = max(1, max_entries)
+        self.threshold = threshold
+        self.ttl = ttl
+        self._version_fn = version_fn
+        self._generation = 0
+        self._version = None
+        self._vectors: np.ndarray | None = None
+        self._entries: list = []
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def _current_version(self) -> tuple:
+        external = None
+        if self._version_fn is not None:
+            try:
+                external = self._version_fn()
+            except Exception:
+                external = None
+        return self._generation, external
+
+    def _sync_version(self) -> tuple:
+        version = self._current_version()
+        if version != self._version:
+            self._vectors = None
+            self._entries = []
+            self._version = version
+        return version
+
+    def _evict_expired(self, now: float) -> None:
+        """移除超过 ttl 的条目（调用方持有 _lock），避免过期的最相似条目遮住仍有效的次优匹配。"""
+        if self.ttl <= 0 or not self._entries:
+            return
+        keep = [i for i, entry in enumerate(self._entries) if now - entry["created_at"] <= self.ttl]
+        if len(keep) == len(self._entries):
+            return
+        if keep:
+            self._vectors = self._vectors[keep]
+            self._entries = [self._entries[i] for i in keep]
+        else:
+            self._vectors = None
+            self._entries = []
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray | None:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        if vector.ndim != 1 or norm == 0.0:
+            return None
+        return vector / norm
+
+    def lookup(self, embedding) -> Optional[Dict[str, Any]]:
+        """返回命中的缓存条目副本（含 similarity 与原始问题），未命中返回 None。"""
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._sync_version()
+            now = time.monotonic()
+            self._evict_expired(now)
+            if vector is None or self._vectors is None or self._vectors.shape[1] != vector.shape[0]:
+                self._misses += 1
+                return None
+            similarities = self._vectors @ vector
+            idx = int(np.argmax(similarities))
+            similarity = float(similarities[idx])
+            entry = self._entries[idx]
+            if similarity < self.threshold:
+                self._misses += 1
+                return None
+            entry["last_used"] = now
+            self._hits += 1
+            return {
+                "question": entry["question"],
+                "similarity": round(similarity, 4),
+                "payload": copy.deepcopy(entry["payload"]),
+            }
+
+    def store(self, question: str, embedding, payload: Dict[str, Any], version: tuple | None = None) -> bool:
+        """写入一条缓存。version 为查询开始时的版本，期间知识库有变更则放弃写入。"""
+        vector = self._normalize(embedding)
+        if vector is None:
+            return False
+        with self._lock:
+            current = self._sync_version()
+            if version is not None and version != current:
+                return False
+            now = time.monotonic()
+            # 先腾出过期条目的位置，避免容量满时淘汰仍有效的条目
+            self._evict_expired(now)
+            entry = {
+                "question": question,
+                "payload": copy.deepcopy(payload),
+                "created_at": now,
+                "last_used": now,
+            }
+            if self._vectors is None or self._vectors.shape[1] != vector.shape[0]:
+                self._vectors = vector[np.newaxis, :].copy()
+                self._entries = [entry]
+            elif len(self._entries) < self.max_entries:
+                self._vectors = np.vstack([self._vectors, vector])
+                self._entries.append(entry)
+            else:
+                victim = min(range(len(self._entries)), key=lambda i: self._entries[i]["last_used"])
+                self._vectors[victim] = vector
+                self._entries[victim] = entry
+            return True
+
+    def version(self) -> tuple:
+        with self._lock:
+            return self._sync_version()
+
+    def invalidate(self) -> None:
+        """知识库变更（上传 / 删除）时调用，清空全部条目。"""
+        with self._lock:
+            self._generation += 1
+            self._sync_version()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / total, 4) if total else None,
+            }
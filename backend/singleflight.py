@@ -0,0 +1,112 @@
+"""请求合并（singleflight）- 相同 key 的并发调用共享同一次进行中的计算"""
+import copy
+import os
+import threading
+import unicodedata
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 剩余时间预算按该粒度分档并计入合并 key，预算相差较大的请求不互相合并（避免宽预算请求拿到短预算 leader 的降级结果）
+SINGLEFLIGHT_BUDGET_BUCKET_MS = int(os.getenv("SINGLEFLIGHT_BUDGET_BUCKET_MS", "1000"))
+# 等待者最多用掉剩余预算的这一比例等待 leader，超时后用余下的预算自行执行
+SINGLEFLIGHT_WAIT_FRACTION = float(os.getenv("SINGLEFLIGHT_WAIT_FRACTION", "0.5"))
+
+
+def normalize_query(query: str) -> str:
+    """合并 key 用的查询归一化：全角转半角、折叠空白、英文小写。"""
+    return " ".join(unicodedata.normalize("NFKC", query or "").split()).lower()
+
+
+def budget_bucket(budget_ms: Optional[float]) -> Optional[int]:
+    """合并 key 用的预算分档；不限预算返回 None。"""
+    if budget_ms is None:
+        return None
+    return int(max(budget_ms, 0) // max(SINGLEFLIGHT_BUDGET_BUCKET_MS, 1))
+
+
+def follower_wait(budget_ms: Optional[float]) -> Optional[float]:
+    """等待者的等待上限（秒）：剩余预算的 SINGLEFLIGHT_WAIT_FRACTION；不限预算返回 None。"""
+    if budget_ms is None:
+        return None
+    return max(budget_ms, 0) * min(max(SINGLEFLIGHT_WAIT_FRACTION, 0.0), 1.0) / 1000
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """第一个到达的调用（leader）执行计算，期间到达的相同 key 调用阻塞等待并拿到结果副本；
+    计算结束即移除 key，之后的调用重新计算（不做结果缓存）。
+    等待者可设置等待上限，leader 超时未完成时等待者自行执行计算，不会因慢 leader 突破自身的时间预算。"""
+
+    def __init__(self):
+        self._calls: Dict[Any, _Call] = {}
+        self._lock = threading.Lock()
+        self._coalesced = 0
+        self._wait_timeouts = 0
+
+    def do(
+        self,
+        key,
+        fn: Callable[..., Any],
+        *args,
+        wait_timeout: Optional[float] = None,
+        on_timeout: Optional[Callable[[], Any]] = None,
+        **kwargs,
+    ) -> Tuple[Any, bool]:
+        """返回 (结果, 是否复用了他人的计算)；leader 抛出的异常会同样抛给所有等待者。
+        :param wait_timeout: 等待者最多等待的秒数，超时后自行调用 fn；None 表示一直等待
+        :param on_timeout: 等待超时后改为调用它（如预算已耗尽时返回降级结果），不再自行执行 fn
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.waiters += 1
+                self._coalesced += 1
+
+        if not leader:
+            if not call.done.wait(None if wait_timeout is None else max(wait_timeout, 0)):
+                with self._lock:
+                    self._wait_timeouts += 1
+                if on_timeout is not None:
+                    return on_timeout(), False
+                return fn(*args, **kwargs), False
+            if call.error is not None:
+                raise call.error
+            # 结果会被下游节点就地修改，每个等待者各拿一份副本
+            return copy.deepcopy(call.result), True
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        else:
+            with self._lock:
+                self._calls.pop(key, None)
+                has_waiters = call.waiters > 0
+            if has_waiters:
+                # 先留一份快照，leader 调用方随后修改结果不会影响等待者
+                call.result = copy.deepcopy(result)
+            return result, False
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    self._calls.pop(key, None)
+            call.done.set()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"in_flight": len(self._calls), "coalesced": self._coalesced, "wait_timeouts": self._wait_timeouts}
@@ -1,4 +1,6 @@
 from typing import Optional
+from contextlib import contextmanager
+import contextvars
 import os
 import requests
 from dotenv import load_dotenv
@@ -16,6 +18,8 @@ _LAST_RAG_CONTEXT = None
 _KNOWLEDGE_TOOL_CALLS_THIS_TURN = 0
 _RAG_STEP_QUEUE = None  # asyncio.Queue, set by agent before streaming
 _RAG_STEP_LOOP = None   # asyncio loop, captured when setting queue
+# 投机执行的工作先把步骤缓冲起来，被采用时再回放，被丢弃时不打扰前端
+_RAG_STEP_BUFFER = contextvars.ContextVar("rag_step_buffer", default=None)
 
 
 def _set_last_rag_context(context: dict):
@@ -52,9 +56,30 @@ def set_rag_step_queue(queue):
         _RAG_STEP_LOOP = None
 
 
+@contextmanager
+def buffer_rag_steps():
+    """在当前上下文内缓冲 emit_rag_step 的步骤而不推送，产出缓冲列表。"""
+    steps = []
+    token = _RAG_STEP_BUFFER.set(steps)
+    try:
+        yield steps
+    finally:
+        _RAG_STEP_BUFFER.reset(token)
+
+
+def replay_rag_steps(steps: list):
+    """推送之前缓冲的步骤。"""
+    for step in steps:
+        emit_rag_step(step["icon"], step["label"], step.get("detail", ""))
+
+
 def emit_rag_step(icon: str, label: str, detail: str = ""):
     """向队列发送一个 RAG 检索步骤。支持跨线程安全调用。"""
     global _RAG_STEP_QUEUE, _RAG_STEP_LOOP
+    buffer = _RAG_STEP_BUFFER.get()
+    if buffer is not None:
+        buffer.append({"icon": icon, "label": label, "detail": detail})
+        return
     if _RAG_STEP_QUEUE is not None and _RAG_STEP_LOOP is not None:
         step = {"icon": icon, "label": label, "detail": detail}
         try:
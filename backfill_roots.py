@@ -0,0 +1,32 @@
+"""回填 L1 根块索引（由粗到细检索，COARSE_TO_FINE_ENABLED=true）。
+
+用法：
+    python backfill_roots.py [--rebuild]
+
+根块向量只在开启由粗到细检索后上传的文档写入；开启前已入库的文档没有根块向量，
+根块索引未覆盖全部 L1 根块时检索自动退回全量叶子检索。运行本脚本为本地分块存储中
+缺失的根块补写稠密向量（会调用嵌入 API），--rebuild 删除根块集合后全部重新生成。
+"""
+import argparse
+import json
+import os
+import sys
+
+# 将 backend 路径添加到 sys.path，以便导入 RAG 模块
+sys.path.append(os.path.join(os.path.dirname(__file__), "backend"))
+from milvus_writer import MilvusWriter
+from parent_chunk_store import ParentChunkStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回填 L1 根块索引")
+    parser.add_argument("--rebuild", action="store_true", help="删除根块集合后全部重新生成")
+    parser.add_argument("--batch-size", type=int, default=50, help="单次嵌入 API 调用的根块数")
+    args = parser.parse_args()
+
+    result = MilvusWriter().backfill_roots(ParentChunkStore(), rebuild=args.rebuild, batch_size=args.batch_size)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""稀疏编码配置基准：对比 CJK 切分粒度、停用字与 top-N 裁剪下的索引规模、稀疏检索延迟与召回率。
+
+用法：
+    python benchmark_sparse.py [queries.jsonl] [--top-k 10] [--samples 100] [--doc-top-n 0,64,32] [--query-top-n 0,8]
+
+queries.jsonl 每行一个 JSON：{"question": "...", "chunk_ids": ["..."]}，chunk_ids 为标注的相关叶子分块。
+不提供时从叶子分块中抽样，取分块中间一段文本作为查询、该分块作为唯一相关项（已知项检索）。
+每组配置在进程内重新拟合 BM25 统计并编码全部叶子分块，写入临时集合 <MILVUS_COLLECTION>_sparse_bench
+测量检索延迟，结束后删除临时集合。索引规模以倒排 posting 条目数（非零项）近似，约 8 字节 / 条。
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+from pymilvus import DataType
+
+# 将 backend 路径添加到 sys.path，以便导入 RAG 模块
+sys.path.append(os.path.join(os.path.dirname(__file__), "backend"))
+from embedding import EmbeddingService
+from rag_utils import LEAF_RETRIEVE_LEVEL, _milvus_manager, hydrate_leaf_texts
+
+
+def load_leaves() -> tuple[list[str], list[str]]:
+    iterator = _milvus_manager.client.query_iterator(
+        collection_name=_milvus_manager.collection_name,
+        batch_size=1000,
+        filter=f"chunk_level == {LEAF_RETRIEVE_LEVEL}",
+        output_fields=["chunk_id", "text"],
+    )
+    chunk_ids, texts = [], []
+    try:
+        while True:
+            batch = iterator.next()
+            if not batch:
+                break
+            for row in batch:
+                chunk_ids.append(row["chunk_id"])
+                texts.append(row.get("text", ""))
+    finally:
+        iterator.close()
+    return chunk_ids, hydrate_leaf_texts(chunk_ids, texts)
+
+
+def load_queries(path: str | None, chunk_ids: list[str], texts: list[str], samples: int) -> list[tuple[str, set]]:
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            items = [json.loads(line) for line in f if line.strip()]
+        return [(item["question"], set(item.get("chunk_ids") or [])) for item in items]
+    rng = random.Random(42)
+    picked = rng.sample(range(len(texts)), min(samples, len(texts)))
+    queries = []
+    for idx in picked:
+        text = texts[idx]
+        start = max(0, len(text) // 2 - 30)
+        if text[start:start + 60].strip():
+            queries.append((text[start:start + 60], {chunk_ids[idx]}))
+    return queries
+
+
+def create_bench_collection(name: str):
+    client = _milvus_manager.client
+    if client.has_collection(name):
+        client.drop_collection(name)
+    schema = client.create_schema(auto_id=True, enable_dynamic_field=False)
+    schema.add_field("id", DataType.INT64, is_primary=True, auto_id=True)
+    schema.add_field("chunk_id", DataType.VARCHAR, max_length=512)
+    schema.add_field("sparse_embedding", DataType.SPARSE_FLOAT_VECTOR)
+    index_params = client.prepare_index_params()
+    index_params.add_index(
+        field_name="sparse_embedding",
+        index_type="SPARSE_INVERTED_INDEX",
+        metric_type="IP",
+        params={"drop_ratio_build": 0.0},
+    )
+    client.create_collection(collection_name=name, schema=schema, index_params=index_params)
+
+
+def run_config(config: dict, chunk_ids: list[str], texts: list[str], queries: list, top_k: int, bench_name: str) -> dict:
+    service = EmbeddingService(**config, persist_stats=False)
+    service.fit_corpus(texts)
+    vectors = service.get_sparse_embeddings(texts)
+    postings = sum(len(vector) for vector in vectors)
+    term_df = {}
+    for vector in vectors:
+        for idx in vector:
+            term_df[idx] = term_df.get(idx, 0) + 1
+
+    create_bench_collection(bench_name)
+    client = _milvus_manager.client
+    rows = [
+        {"chunk_id": chunk_id, "sparse_embedding": vector}
+        for chunk_id, vector in zip(chunk_ids, vectors)
+        if vector
+    ]
+    for i in range(0, len(rows), 1000):
+        client.insert(bench_name, rows[i:i + 1000])
+    client.flush(bench_name)
+    client.load_collection(bench_name)
+
+    drop_ratio = _milvus_manager.resolve_search_params()["drop_ratio_search"]
+    recalls, latencies, query_terms = [], [], []
+    for question, relevant in queries:
+        query_vector = service.get_sparse_embedding(question)
+        query_terms.append(len(query_vector))
+        if not query_vector:
+            recalls.append(0.0)
+            continue
+        started = time.perf_counter()
+        results = client.search(
+            collection_name=bench_name,
+            data=[query_vector],
+            anns_field="sparse_embedding",
+            search_params={"metric_type": "IP", "params": {"drop_ratio_search": drop_ratio}},
+            limit=top_k,
+            output_fields=["chunk_id"],
+        )
+        latencies.append((time.perf_counter() - started) * 1000)
+        hits = {hit.get("entity", {}).get("chunk_id") for hits in results for hit in hits}
+        if relevant:
+            recalls.append(len(relevant & hits) / len(relevant))
+
+    return {
+        "postings": postings,
+        "terms": len(term_df),
+        "max_posting": max(term_df.values()) if term_df else 0,
+        "size_mb": postings * 8 / 1024 / 1024,
+        "query_terms": float(np.mean(query_terms)) if query_terms else 0.0,
+        "recall": float(np.mean(recalls)) if recalls else 0.0,
+        "p50": float(np.percentile(latencies, 50)) if latencies else 0.0,
+        "p95": float(np.percentile(latencies, 95)) if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="稀疏编码配置基准")
+    parser.add_argument("queries", nargs="?", help="JSONL 文件，每行包含 question 与 chunk_ids；缺省时从叶子分块抽样")
+    parser.add_argument("--top-k", type=int, default=10, help="评估召回率的返回条数")
+    parser.add_argument("--samples", type=int, default=100, help="抽样查询数（未提供 queries 时）")
+    parser.add_argument("--doc-top-n", default="0,64,32", help="文档侧 top-N 候选，逗号分隔，0 表示不裁剪")
+    parser.add_argument("--query-top-n", default="0,8", help="查询侧 top-N 候选，逗号分隔，0 表示不裁剪")
+    args = parser.parse_args()
+
+    if _milvus_manager.uses_server_bm25():
+        print("当前集合使用服务端 BM25（MILVUS_SPARSE_MODE=bm25），Python 端稀疏编码不在检索路径上")
+        return
+    chunk_ids, texts = load_leaves()
+    if not chunk_ids:
+        print("知识库中没有叶子分块")
+        return
+    queries = load_queries(args.queries, chunk_ids, texts, args.samples)
+    print(f"叶子分块：{len(chunk_ids)}，查询数：{len(queries)}，top_k：{args.top_k}\n")
+
+    doc_grid = [int(value) for value in args.doc_top_n.split(",")]
+    query_grid = [int(value) for value in args.query_top_n.split(",")]
+    bench_name = f"{_milvus_manager.collection_name}_sparse_bench"
+    header = f"{'ngram':<6}{'stop':<6}{'doc_n':<7}{'qry_n':<7}{'postings':>10}{'terms':>8}{'max_df':>8}{'MB':>8}{'q_terms':>9}{'recall':>8}{'p50ms':>8}{'p95ms':>8}"
+    print(header)
+    try:
+        for ngram, stop, doc_top_n, query_top_n in itertools.product([1, 2], [False, True], doc_grid, query_grid):
+            config = {"cjk_ngram": ngram, "drop_stop_chars": stop, "doc_top_n": doc_top_n, "query_top_n": query_top_n}
+            result = run_config(config, chunk_ids, texts, queries, args.top_k, bench_name)
+            print(
+                f"{ngram:<6}{str(stop):<6}{doc_top_n:<7}{query_top_n:<7}{result['postings']:>10}{result['terms']:>8}"
+                f"{result['max_posting']:>8}{result['size_mb']:>8.2f}{result['query_terms']:>9.1f}"
+                f"{result['recall']:>8.3f}{result['p50']:>8.1f}{result['p95']:>8.1f}"
+            )
+    finally:
+        if _milvus_manager.client.has_collection(bench_name):
+            _milvus_manager.client.drop_collection(bench_name)
+    print("\n选定配置后写入 .env：SPARSE_CJK_NGRAM / SPARSE_DROP_STOP_CHARS / SPARSE_DOC_TOP_N / SPARSE_QUERY_TOP_N，并重新入库")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""批量导入文件夹下的文档（首次大规模入库 / 全量重建索引）。
+
+用法：
+    python bulk_load.py data/documents [--recreate] [--batch-size 64] [--workers 4]
+
+需要 pymilvus[bulk_writer]，Milvus 与其对象存储（MINIO_*）可访问。
+进度记录在 data/bulk_ingest/manifest.json，中断后用相同参数重跑即可从断点继续；
+--recreate 会删除并重建集合、清空进度，从头导入全部文件。
+"""
+import argparse
+import json
+import os
+import sys
+
+# 将 backend 路径添加到 sys.path，以便导入 RAG 模块
+sys.path.append(os.path.join(os.path.dirname(__file__), "backend"))
+from bulk_ingest import BULK_EMBED_WORKERS, BulkIngestor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量导入文档到 Milvus")
+    parser.add_argument("folder", help="文档所在文件夹")
+    parser.add_argument("--recreate", action="store_true", help="删除并重建集合后全量导入")
+    parser.add_argument("--batch-size", type=int, default=64, help="单次嵌入 API 调用的文本数")
+    parser.add_argument("--workers", type=int, default=BULK_EMBED_WORKERS, help="并发嵌入线程数")
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="查询导入进度的间隔（秒）")
+    args = parser.parse_args()
+
+    ingestor = BulkIngestor(batch_size=args.batch_size, workers=args.workers)
+    result = ingestor.run(args.folder, recreate=args.recreate, poll_interval=args.poll_interval)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if result["failed"]:
+        print("部分文件失败，修复后重新运行即可继续")
+
+
+if __name__ == "__main__":
+    main()
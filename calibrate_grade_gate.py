@@ -0,0 +1,124 @@
+"""离线标定快速评分门控（GRADE_GATE_*）阈值。
+
+用法：
+    python calibrate_grade_gate.py questions.jsonl [--target 0.95]
+
+questions.jsonl 每行一个 JSON：{"question": "...", "relevant": true}。
+缺少 relevant 标注时，用 LLM 评分器（GRADE_MODEL）的结果作为参考标签。
+脚本对每个问题执行一次初次检索并提取门控信号，再网格搜索阈值：
+在门控判定与参考标签一致率不低于 target 的前提下，最大化跳过 LLM 评分的比例。
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+
+# 将 backend 路径添加到 sys.path，以便导入 RAG 模块
+sys.path.append(os.path.join(os.path.dirname(__file__), "backend"))
+from rag_utils import retrieve_documents
+from rag_pipeline import _format_docs, _grade, fast_grade, grade_gate_signals
+
+GRID = {
+    "accept_rerank": [0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9],
+    "reject_rerank": [0.0, 0.05, 0.1, 0.2, 0.3],
+    "accept_rrf": [0.5, 0.6, 0.7, 0.8, 0.9, 1.0],
+    "reject_rrf": [0.0, 0.2, 0.3, 0.4, 0.5, 0.6],
+    "accept_overlap": [0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9],
+    "reject_overlap": [0.0, 0.1, 0.2, 0.3, 0.4],
+}
+
+ENV_NAMES = {
+    "accept_rerank": "GRADE_GATE_ACCEPT_RERANK",
+    "reject_rerank": "GRADE_GATE_REJECT_RERANK",
+    "accept_rrf": "GRADE_GATE_ACCEPT_RRF",
+    "reject_rrf": "GRADE_GATE_REJECT_RRF",
+    "accept_overlap": "GRADE_GATE_ACCEPT_OVERLAP",
+    "reject_overlap": "GRADE_GATE_REJECT_OVERLAP",
+}
+
+
+def collect_samples(path: str) -> list[dict]:
+    samples = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            question = item["question"]
+            retrieved = retrieve_documents(question, top_k=5)
+            docs = retrieved.get("docs", [])
+            meta = retrieved.get("meta", {})
+            relevant = item.get("relevant")
+            if relevant is None:
+                score, _ = _grade({"question": question, "context": _format_docs(docs)})
+                relevant = score == "yes"
+            samples.append({
+                "question": question,
+                "relevant": bool(relevant),
+                "signals": grade_gate_signals(
+                    question, docs, meta.get("retrieval_mode"), meta.get("rerank_backend")
+                ),
+            })
+    return samples
+
+
+def evaluate(samples: list[dict], thresholds: dict) -> tuple[float, float]:
+    """返回 (门控覆盖率, 门控判定一致率)。"""
+    gated = agreed = 0
+    for sample in samples:
+        decision = fast_grade(sample["signals"], thresholds)
+        if decision is None:
+            continue
+        gated += 1
+        agreed += int((decision == "accept") == sample["relevant"])
+    coverage = gated / len(samples) if samples else 0.0
+    agreement = agreed / gated if gated else 1.0
+    return coverage, agreement
+
+
+def search(samples: list[dict], target: float) -> tuple[dict, float, float] | None:
+    best = None
+    keys = list(GRID)
+    for values in itertools.product(*(GRID[key] for key in keys)):
+        thresholds = dict(zip(keys, values))
+        if thresholds["reject_rerank"] >= thresholds["accept_rerank"]:
+            continue
+        if thresholds["reject_rrf"] >= thresholds["accept_rrf"]:
+            continue
+        if thresholds["reject_overlap"] >= thresholds["accept_overlap"]:
+            continue
+        coverage, agreement = evaluate(samples, thresholds)
+        if agreement < target:
+            continue
+        if best is None or (coverage, agreement) > (best[1], best[2]):
+            best = (thresholds, coverage, agreement)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="标定快速评分门控阈值")
+    parser.add_argument("questions", help="JSONL 文件，每行包含 question，可选 relevant")
+    parser.add_argument("--target", type=float, default=0.95, help="门控判定的最低一致率")
+    args = parser.parse_args()
+
+    samples = collect_samples(args.questions)
+    if not samples:
+        print("没有可用样本")
+        return
+    print(f"样本数：{len(samples)}，相关：{sum(s['relevant'] for s in samples)}")
+
+    best = search(samples, args.target)
+    if best is None:
+        print(f"没有阈值组合能达到一致率 {args.target}，建议保持 GRADE_GATE_ENABLED=false")
+        return
+    thresholds, coverage, agreement = best
+    print(f"跳过 LLM 评分比例：{coverage:.1%}，门控一致率：{agreement:.1%}")
+    print("GRADE_GATE_ENABLED=true")
+    for key, value in thresholds.items():
+        print(f"{ENV_NAMES[key]}={value}")
+
+
+if __name__ == "__main__":
+    main()
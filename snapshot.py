@@ -0,0 +1,46 @@
+"""知识库索引快照：导出已建好的索引，在新环境直接导入（不重新解析文档、不调用嵌入 API）。
+
+用法：
+    python snapshot.py export snapshots/kb-20260101
+    python snapshot.py import snapshots/kb-20260101 [--recreate] [--bulk]
+
+导出内容见 backend/index_snapshot.py；导出时如有上传写入会自动重试，保证快照一致。
+导入要求 MILVUS_SPARSE_MODE、LEAF_TEXT_OFFLOAD 与 EMBEDDER 和导出环境一致；
+目标集合已有数据时需加 --recreate（删除并重建集合、清空本地分块存储）。
+--bulk 经 Parquet + bulk import 导入叶子集合，需 pymilvus[bulk_writer] 与 MINIO_* 配置。
+"""
+import argparse
+import json
+import os
+import sys
+
+# 将 backend 路径添加到 sys.path，以便导入 RAG 模块
+sys.path.append(os.path.join(os.path.dirname(__file__), "backend"))
+from index_snapshot import IndexSnapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description="知识库索引快照导出 / 导入")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="导出快照到目录（目录须不存在）")
+    export_parser.add_argument("path", help="快照目录")
+    export_parser.add_argument("--retries", type=int, default=3, help="导出期间有写入时的重试次数")
+    import_parser = subparsers.add_parser("import", help="从快照目录导入")
+    import_parser.add_argument("path", help="快照目录")
+    import_parser.add_argument("--recreate", action="store_true", help="删除并重建集合、清空本地分块存储后导入")
+    import_parser.add_argument("--bulk", action="store_true", help="叶子集合走 bulk import")
+    import_parser.add_argument("--poll-interval", type=float, default=5.0, help="查询导入进度的间隔（秒）")
+    args = parser.parse_args()
+
+    snapshot = IndexSnapshot()
+    if args.command == "export":
+        result = snapshot.export_to(args.path, retries=args.retries)
+    else:
+        result = snapshot.import_from(
+            args.path, recreate=args.recreate, bulk=args.bulk, poll_interval=args.poll_interval
+        )
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
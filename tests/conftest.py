@@ -0,0 +1,23 @@
+"""测试公共夹具"""
+import importlib
+
+import pymilvus
+import pytest
+
+
+class _OfflineMilvusClient:
+    """rag_utils / rag_pipeline 在导入时创建 MilvusManager，测试只用其中的纯逻辑函数，不连接 Milvus。"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+@pytest.fixture(scope="session")
+def offline_import():
+    """导入依赖 Milvus 连接的模块：导入期间替换 MilvusClient，测试用例不应触发任何 Milvus 调用。"""
+    def _import(name: str):
+        with pytest.MonkeyPatch.context() as patch:
+            patch.setattr(pymilvus, "MilvusClient", _OfflineMilvusClient)
+            patch.setattr("milvus_client.MilvusClient", _OfflineMilvusClient, raising=False)
+            return importlib.import_module(name)
+    return _import
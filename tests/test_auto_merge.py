@@ -0,0 +1,104 @@
+"""_merge_level：按固定个数阈值或覆盖率把兄弟叶子块替换为父块"""
+import pytest
+
+PARENT_TEXT = "第一句。第二句。第三句。第四句。"
+
+
+@pytest.fixture(scope="module")
+def rag_utils(offline_import):
+    return offline_import("rag_utils")
+
+
+@pytest.fixture
+def merge_level(rag_utils, monkeypatch):
+    monkeypatch.setattr(rag_utils, "AUTO_MERGE_THRESHOLD", 2)
+    monkeypatch.setattr(rag_utils, "AUTO_MERGE_RATIO", 0.0)
+    return rag_utils._merge_level
+
+
+def _leaf(chunk_id, parent_id, text, score):
+    return {"chunk_id": chunk_id, "parent_chunk_id": parent_id, "text": text, "score": score}
+
+
+def _parent(chunk_id, child_count=0):
+    return {"chunk_id": chunk_id, "text": PARENT_TEXT, "child_count": child_count}
+
+
+def test_merges_siblings_at_threshold(merge_level):
+    docs = [
+        _leaf("a1", "A", "第二句。", 0.9),
+        _leaf("b1", "B", "其他", 0.8),
+        _leaf("a2", "A", "第四句。", 0.7),
+    ]
+    merged, count = merge_level(docs, {"A": _parent("A"), "B": _parent("B")})
+
+    assert count == 2
+    assert [doc["chunk_id"] for doc in merged] == ["A", "b1"]
+    parent = merged[0]
+    assert parent["score"] == 0.9
+    assert parent["merged_from_children"] is True
+    assert parent["merged_child_count"] == 2
+    assert parent["matched_spans"] == [[4, 8], [12, 16]]
+
+
+def test_below_threshold_keeps_docs_unchanged(merge_level):
+    docs = [_leaf("a1", "A", "第二句。", 0.9), _leaf("b1", "B", "第三句。", 0.8)]
+    merged, count = merge_level(docs, {"A": _parent("A"), "B": _parent("B")})
+
+    assert count == 0
+    assert merged is docs
+
+
+def test_missing_ancestor_is_never_merged(merge_level):
+    docs = [_leaf("a1", "A", "第二句。", 0.9), _leaf("a2", "A", "第三句。", 0.8)]
+    merged, count = merge_level(docs, {})
+
+    assert count == 0
+    assert merged == docs
+
+
+def test_ancestors_are_not_mutated(merge_level):
+    ancestors = {"A": _parent("A")}
+    merge_level([_leaf("a1", "A", "第二句。", 0.9), _leaf("a2", "A", "第三句。", 0.8)], ancestors)
+
+    assert ancestors["A"] == _parent("A")
+
+
+def test_coverage_ratio_mode(rag_utils, monkeypatch):
+    monkeypatch.setattr(rag_utils, "AUTO_MERGE_THRESHOLD", 2)
+    monkeypatch.setattr(rag_utils, "AUTO_MERGE_RATIO", 0.5)
+    docs = [
+        _leaf("a1", "A", "第一句。", 0.9),
+        _leaf("a2", "A", "第二句。", 0.8),
+        _leaf("b1", "B", "第一句。", 0.7),
+        _leaf("b2", "B", "第二句。", 0.6),
+    ]
+    ancestors = {"A": _parent("A", child_count=4), "B": _parent("B", child_count=8)}
+    merged, count = rag_utils._merge_level(docs, ancestors)
+
+    # A 覆盖 2/4 达到比例；B 只有 2/8，即使达到固定个数阈值也不合并
+    assert count == 2
+    assert [doc["chunk_id"] for doc in merged] == ["A", "b1", "b2"]
+    assert merged[0]["merged_coverage"] == 0.5
+
+
+def test_coverage_ratio_falls_back_to_threshold_without_child_count(rag_utils, monkeypatch):
+    monkeypatch.setattr(rag_utils, "AUTO_MERGE_THRESHOLD", 2)
+    monkeypatch.setattr(rag_utils, "AUTO_MERGE_RATIO", 0.5)
+    docs = [_leaf("a1", "A", "第一句。", 0.9), _leaf("a2", "A", "第二句。", 0.8)]
+    merged, count = rag_utils._merge_level(docs, {"A": _parent("A")})
+
+    assert count == 2
+    assert "merged_coverage" not in merged[0]
+
+
+def test_duplicate_non_merged_docs_are_emitted_once(merge_level):
+    docs = [
+        _leaf("b1", "B", "x", 0.9),
+        _leaf("a1", "A", "第一句。", 0.8),
+        _leaf("a2", "A", "第二句。", 0.7),
+        _leaf("b1", "B", "x", 0.6),
+    ]
+    merged, _ = merge_level(docs, {"A": _parent("A")})
+
+    assert [doc["chunk_id"] for doc in merged] == ["b1", "A"]
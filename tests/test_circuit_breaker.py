@@ -0,0 +1,104 @@
+"""CircuitBreaker 状态转换：closed -> open -> half_open（单次探测）-> closed / open"""
+import threading
+
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = _Clock()
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", fake)
+    return fake
+
+
+def _tripped(clock, threshold=2, cooldown=10.0):
+    breaker = CircuitBreaker("test", failure_threshold=threshold, cooldown=cooldown)
+    for _ in range(threshold):
+        breaker.record_failure("boom")
+    return breaker
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, cooldown=10.0)
+    breaker.record_failure("e1")
+    breaker.record_failure("e2")
+    assert breaker.state == "closed"
+    assert breaker.allow_request()
+
+    breaker.record_failure("e3")
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+    snapshot = breaker.snapshot()
+    assert snapshot["consecutive_failures"] == 3
+    assert snapshot["last_error"] == "e3"
+    assert snapshot["retry_in_seconds"] == 10.0
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker("test", failure_threshold=2, cooldown=10.0)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_half_open_allows_a_single_probe(clock):
+    breaker = _tripped(clock)
+    clock.now += 9.9
+    assert not breaker.allow_request()
+
+    clock.now += 0.1
+    assert breaker.allow_request()
+    assert breaker.state == "half_open"
+    assert not breaker.allow_request()
+    assert not breaker.allow_request()
+
+
+def test_half_open_single_probe_under_concurrency(clock):
+    breaker = _tripped(clock)
+    clock.now += 10.0
+    barrier = threading.Barrier(8)
+    allowed = []
+
+    def probe():
+        barrier.wait()
+        allowed.append(breaker.allow_request())
+
+    threads = [threading.Thread(target=probe) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert allowed.count(True) == 1
+
+
+def test_successful_probe_closes(clock):
+    breaker = _tripped(clock)
+    clock.now += 10.0
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.snapshot()["consecutive_failures"] == 0
+    assert breaker.allow_request()
+
+
+def test_failed_probe_reopens_for_a_full_cooldown(clock):
+    breaker = _tripped(clock, threshold=5)
+    clock.now += 10.0
+    assert breaker.allow_request()
+    breaker.record_failure("probe failed")
+    assert breaker.state == "open"
+    assert breaker.snapshot()["retry_in_seconds"] == 10.0
+    clock.now += 5.0
+    assert not breaker.allow_request()
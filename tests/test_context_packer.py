@@ -0,0 +1,138 @@
+"""context_packer：token 估算、按预算打包上下文与近重复片段去除"""
+from context_packer import estimate_tokens, pack_context, suppress_near_duplicates, trim_to_matches
+
+
+def _doc(chunk_id, tokens, **extra):
+    return {"chunk_id": chunk_id, "text": "字" * tokens, "token_count": tokens, **extra}
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("检索增强") == 4
+    assert estimate_tokens("hello world") == 3
+    assert estimate_tokens("RRF 融合，") == 1 + 2 + 1
+
+
+def test_zero_budget_keeps_everything():
+    docs = [_doc("a", 500), _doc("b", 500)]
+    packed, meta = pack_context(docs, budget=0)
+
+    assert packed is docs
+    assert meta["context_token_budget"] is None
+    assert meta["context_tokens"] == 1000
+
+
+def test_within_budget_is_untouched():
+    docs = [_doc("a", 100), _doc("b", 100)]
+    packed, meta = pack_context(docs, budget=300)
+
+    assert packed is docs
+    assert meta["context_dropped_chunks"] == 0
+
+
+def test_greedy_packing_skips_chunks_that_do_not_fit():
+    docs = [_doc("a", 60), _doc("b", 60), _doc("c", 30)]
+    packed, meta = pack_context(docs, budget=100)
+
+    assert [doc["chunk_id"] for doc in packed] == ["a", "c"]
+    assert meta["context_tokens_before"] == 150
+    assert meta["context_tokens"] == 90
+    assert meta["context_dropped_chunks"] == 1
+
+
+def test_merged_parent_is_trimmed_to_matched_sentences():
+    text = "背景介绍。" * 5 + "命中的句子。" + "其他内容。" * 5
+    start = text.index("命中的句子。")
+    parent = {
+        "chunk_id": "p",
+        "text": text,
+        "merged_from_children": True,
+        "matched_spans": [[start, start + len("命中的句子。")]],
+    }
+    packed, meta = pack_context([parent], budget=20, neighbors=1)
+
+    assert packed[0]["text"] == "背景介绍。命中的句子。其他内容。"
+    assert packed[0]["context_trimmed"] is True
+    assert meta["context_trimmed_chunks"] == 1
+
+
+def test_trim_marks_gaps_between_kept_sentences():
+    text = "甲。乙。丙。丁。戊。"
+    trimmed = trim_to_matches({"text": text, "matched_spans": [[0, 2], [8, 10]]}, neighbors=0)
+    assert trimmed["text"] == "甲。……戊。"
+    assert trim_to_matches({"text": text, "matched_spans": []}) is None
+
+
+def test_first_chunk_prefix_is_kept_when_nothing_fits():
+    packed, meta = pack_context([_doc("a", 100), _doc("b", 100)], budget=10)
+
+    assert len(packed) == 1
+    assert packed[0]["chunk_id"] == "a"
+    assert packed[0]["context_trimmed"] is True
+    assert 0 < meta["context_tokens"] <= 10
+
+
+SHARED = "混合检索把稠密向量与稀疏向量两路结果按排名融合，"
+
+
+def _chunk(chunk_id, text, **extra):
+    return {"chunk_id": chunk_id, "filename": "a.pdf", "page_number": 1, "text": text, **extra}
+
+
+def test_exact_duplicates_are_always_removed():
+    docs = [_chunk("a", SHARED), _chunk("b", SHARED), _chunk("c", SHARED, filename="b.pdf")]
+    kept, dropped = suppress_near_duplicates(docs, threshold=0)
+
+    assert [doc["chunk_id"] for doc in kept] == ["a", "c"]
+    assert dropped == 1
+
+
+def test_zero_threshold_keeps_overlapping_chunks():
+    docs = [_chunk("a", SHARED + "再由精排模型重新打分。"), _chunk("b", SHARED + "再做截断。")]
+    kept, dropped = suppress_near_duplicates(docs, threshold=0)
+
+    assert len(kept) == 2
+    assert dropped == 0
+
+
+def test_covered_chunk_is_removed_above_threshold():
+    docs = [
+        _chunk("a", SHARED + "再由精排模型重新打分。"),
+        _chunk("b", SHARED),
+        _chunk("c", "完全不同的另一段内容，讲的是语义缓存。"),
+    ]
+    kept, dropped = suppress_near_duplicates(docs, threshold=0.8)
+
+    assert [doc["chunk_id"] for doc in kept] == ["a", "c"]
+    assert dropped == 1
+
+
+def test_partial_overlap_below_threshold_is_kept():
+    docs = [_chunk("a", SHARED), _chunk("b", SHARED[:8] + "但后半句讲的是完全不同的缓存淘汰策略与过期时间。")]
+    kept, _ = suppress_near_duplicates(docs, threshold=0.8)
+
+    assert len(kept) == 2
+
+
+def test_descendant_of_selected_ancestor_is_removed():
+    docs = [
+        _chunk("P", "父块正文：" + SHARED),
+        _chunk("c1", "子块正文一", parent_chunk_id="P", root_chunk_id="R"),
+    ]
+    kept, dropped = suppress_near_duplicates(docs, threshold=0.8)
+
+    assert [doc["chunk_id"] for doc in kept] == ["P"]
+    assert dropped == 1
+
+
+def test_ancestor_replaces_descendants_at_best_rank():
+    docs = [
+        _chunk("c1", "子块正文一", parent_chunk_id="P", root_chunk_id="R"),
+        _chunk("x", "无关片段的正文内容"),
+        _chunk("c2", "子块正文二", parent_chunk_id="P", root_chunk_id="R"),
+        _chunk("P", "父块正文：子块正文一，子块正文二"),
+    ]
+    kept, dropped = suppress_near_duplicates(docs, threshold=0.8)
+
+    assert [doc["chunk_id"] for doc in kept] == ["P", "x"]
+    assert dropped == 2
@@ -0,0 +1,62 @@
+"""快速评分门控 fast_grade：高置信放行 / 明显不相关拒绝，其余交给 LLM"""
+import pytest
+
+THRESHOLDS = {
+    "accept_rerank": 0.7,
+    "reject_rerank": 0.1,
+    "accept_rrf": 0.9,
+    "reject_rrf": 0.5,
+    "accept_overlap": 0.6,
+    "reject_overlap": 0.2,
+}
+
+
+@pytest.fixture(scope="module")
+def fast_grade(offline_import):
+    return offline_import("rag_pipeline").fast_grade
+
+
+def _signals(**overrides):
+    return {"doc_count": 3, "top_rerank_score": None, "top_rrf_norm": None, "term_overlap": 0.0, **overrides}
+
+
+def test_no_docs_rejects(fast_grade):
+    assert fast_grade(_signals(doc_count=0, top_rerank_score=0.99, term_overlap=1.0), THRESHOLDS) == "reject"
+
+
+@pytest.mark.parametrize(
+    "rerank,overlap,expected",
+    [
+        (0.9, 0.3, "accept"),
+        (0.9, 0.1, None),  # rerank 高但几乎零覆盖，不直接放行
+        (0.05, 0.3, "reject"),
+        (0.05, 0.8, None),  # rerank 低但覆盖率高，不直接拒绝
+        (0.4, 0.5, None),
+    ],
+)
+def test_rerank_signal(fast_grade, rerank, overlap, expected):
+    assert fast_grade(_signals(top_rerank_score=rerank, term_overlap=overlap), THRESHOLDS) == expected
+
+
+def test_rerank_signal_takes_precedence_over_rrf(fast_grade):
+    signals = _signals(top_rerank_score=0.4, top_rrf_norm=1.0, term_overlap=0.9)
+    assert fast_grade(signals, THRESHOLDS) is None
+
+
+@pytest.mark.parametrize(
+    "rrf,overlap,expected",
+    [
+        (0.95, 0.7, "accept"),
+        (0.95, 0.3, None),  # RRF 只反映排名，放行还需要足够的覆盖率
+        (0.3, 0.1, "reject"),
+        (0.3, 0.4, None),
+        (0.7, 0.7, None),
+    ],
+)
+def test_rrf_signal(fast_grade, rrf, overlap, expected):
+    assert fast_grade(_signals(top_rrf_norm=rrf, term_overlap=overlap), THRESHOLDS) == expected
+
+
+def test_overlap_only_never_accepts(fast_grade):
+    assert fast_grade(_signals(term_overlap=0.1), THRESHOLDS) == "reject"
+    assert fast_grade(_signals(term_overlap=1.0), THRESHOLDS) is None
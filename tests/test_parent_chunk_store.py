@@ -0,0 +1,118 @@
+"""ParentChunkStore 区间存储（span 模式）、版本戳与进程内缓存失效"""
+import pytest
+
+from parent_chunk_store import ParentChunkStore
+
+PAGE_TEXT = "第一句介绍背景。第二句给出结论。第三句补充说明。"
+
+
+def _doc(chunk_id, start, end, text=None, **extra):
+    return {
+        "chunk_id": chunk_id,
+        "text": PAGE_TEXT[start:end] if text is None else text,
+        "filename": "a.pdf",
+        "page_number": 1,
+        "chunk_level": 2,
+        "page_id": "a.pdf::p1",
+        "start_index": start,
+        "end_index": end,
+        **extra,
+    }
+
+
+PAGES = [{"page_id": "a.pdf::p1", "filename": "a.pdf", "text": PAGE_TEXT}]
+
+
+@pytest.fixture
+def span_store(tmp_path):
+    return ParentChunkStore(tmp_path / "chunks.db", backend="sqlite", storage_mode="span", cache_size=0)
+
+
+def test_span_mode_stores_only_offsets_and_restores_text(span_store):
+    span_store.upsert_documents([_doc("c1", 0, 8), _doc("c2", 8, 16)], pages=PAGES)
+
+    raw = {record["chunk_id"]: record for record in span_store.export_records()}
+    assert raw["c1"]["span_only"] is True
+    assert raw["c1"]["text"] == ""
+
+    docs = span_store.get_documents_by_ids(["c2", "c1"])
+    assert [doc["text"] for doc in docs] == [PAGE_TEXT[8:16], PAGE_TEXT[0:8]]
+    assert all("span_only" not in doc for doc in docs)
+
+
+def test_span_mode_keeps_text_when_offsets_do_not_match_page(span_store):
+    span_store.upsert_documents([_doc("c1", 0, 8, text="与页面不一致的正文")], pages=PAGES)
+
+    raw = next(iter(span_store.export_records()))
+    assert "span_only" not in raw
+    assert span_store.get_documents_by_ids(["c1"])[0]["text"] == "与页面不一致的正文"
+
+
+def test_span_mode_without_pages_stores_full_text(span_store):
+    span_store.upsert_documents([_doc("c1", 0, 8)])
+
+    raw = next(iter(span_store.export_records()))
+    assert raw["text"] == PAGE_TEXT[0:8]
+    assert "span_only" not in raw
+
+
+def test_json_backend_ignores_span_mode(tmp_path):
+    store = ParentChunkStore(tmp_path / "chunks.json", backend="json", storage_mode="span", cache_size=0)
+    store.upsert_documents([_doc("c1", 0, 8)], pages=PAGES)
+
+    raw = next(iter(store.export_records()))
+    assert raw["text"] == PAGE_TEXT[0:8]
+    assert not store.stores_pages
+
+
+def test_delete_by_filename_removes_pages(span_store):
+    span_store.upsert_documents([_doc("c1", 0, 8)], pages=PAGES)
+
+    assert span_store.delete_by_filename("a.pdf") == 1
+    assert span_store.get_documents_by_ids(["c1"]) == []
+    assert list(span_store.export_pages()) == []
+
+
+@pytest.mark.parametrize("backend,name", [("sqlite", "chunks.db"), ("json", "chunks.json")])
+def test_writes_change_version_but_not_generation(tmp_path, backend, name):
+    store = ParentChunkStore(tmp_path / name, backend=backend, cache_size=0)
+    before = store.get_version()
+    store.upsert_documents([_doc("c1", 0, 8)])
+    after_upsert = store.get_version()
+    assert after_upsert != before
+    assert store.get_generation() == 0
+
+    store.bump_generation()
+    store.bump_generation()
+    assert store.get_generation() == 2
+    assert ParentChunkStore(tmp_path / name, backend=backend, cache_size=0).get_generation() == 2
+
+
+def test_sqlite_delete_bumps_version_only_when_rows_removed(tmp_path):
+    store = ParentChunkStore(tmp_path / "chunks.db", backend="sqlite", cache_size=0)
+    store.upsert_documents([_doc("c1", 0, 8)])
+    version = store.get_version()
+
+    assert store.delete_by_filename("missing.pdf") == 0
+    assert store.get_version() == version
+    assert store.delete_by_filename("a.pdf") == 1
+    assert store.get_version() == version + 1
+
+
+def test_cache_sees_writes_from_another_instance(tmp_path):
+    path = tmp_path / "chunks.db"
+    reader = ParentChunkStore(path, backend="sqlite", cache_size=16)
+    writer = ParentChunkStore(path, backend="sqlite", cache_size=16)
+    writer.upsert_documents([_doc("c1", 0, 8, text="旧正文")])
+    assert reader.get_documents_by_ids(["c1"])[0]["text"] == "旧正文"
+
+    writer.upsert_documents([_doc("c1", 0, 8, text="新正文")])
+    assert reader.get_documents_by_ids(["c1"])[0]["text"] == "新正文"
+
+
+def test_cached_reads_return_copies(tmp_path):
+    store = ParentChunkStore(tmp_path / "chunks.db", backend="sqlite", cache_size=16)
+    store.upsert_documents([_doc("c1", 0, 8)])
+    store.get_documents_by_ids(["c1"])[0]["text"] = "被调用方修改"
+
+    assert store.get_documents_by_ids(["c1"])[0]["text"] == PAGE_TEXT[0:8]
@@ -0,0 +1,133 @@
+"""SemanticCache：相似度命中、按知识库版本整体失效、TTL 与 LRU 淘汰"""
+import pytest
+
+import semantic_cache
+from semantic_cache import SemanticCache
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = _Clock()
+    monkeypatch.setattr(semantic_cache.time, "monotonic", fake)
+    return fake
+
+
+def test_hit_above_threshold_returns_a_copy():
+    cache = SemanticCache(threshold=0.9)
+    cache.store("什么是 RRF", [1.0, 0.0], {"docs": [{"text": "a"}]})
+
+    hit = cache.lookup([0.99, 0.05])
+    assert hit["question"] == "什么是 RRF"
+    assert hit["similarity"] >= 0.9
+    hit["payload"]["docs"].append({"text": "b"})
+    assert cache.lookup([1.0, 0.0])["payload"] == {"docs": [{"text": "a"}]}
+
+
+def test_miss_below_threshold_or_dimension_mismatch():
+    cache = SemanticCache(threshold=0.9)
+    cache.store("q", [1.0, 0.0], {})
+    assert cache.lookup([0.0, 1.0]) is None
+    assert cache.lookup([1.0, 0.0, 0.0]) is None
+    assert cache.lookup([0.0, 0.0]) is None
+    assert cache.stats()["misses"] == 3
+
+
+def test_invalidate_clears_entries():
+    cache = SemanticCache(threshold=0.9)
+    cache.store("q", [1.0, 0.0], {})
+    cache.invalidate()
+    assert cache.lookup([1.0, 0.0]) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_external_version_change_clears_entries():
+    kb = {"generation": 1}
+    cache = SemanticCache(threshold=0.9, version_fn=lambda: kb["generation"])
+    cache.store("q", [1.0, 0.0], {})
+    assert cache.lookup([1.0, 0.0]) is not None
+
+    kb["generation"] = 2
+    assert cache.lookup([1.0, 0.0]) is None
+
+
+def test_store_with_stale_version_is_rejected():
+    kb = {"generation": 1}
+    cache = SemanticCache(threshold=0.9, version_fn=lambda: kb["generation"])
+    started = cache.version()
+    kb["generation"] = 2  # 检索期间知识库有变更
+
+    assert cache.store("q", [1.0, 0.0], {}, version=started) is False
+    assert cache.lookup([1.0, 0.0]) is None
+    assert cache.store("q", [1.0, 0.0], {}, version=cache.version()) is True
+
+
+def test_version_fn_errors_do_not_break_lookup():
+    def broken():
+        raise RuntimeError("store unavailable")
+
+    cache = SemanticCache(threshold=0.9, version_fn=broken)
+    cache.store("q", [1.0, 0.0], {})
+    assert cache.lookup([1.0, 0.0]) is not None
+
+
+def test_ttl_expires_entries(clock):
+    cache = SemanticCache(threshold=0.9, ttl=60)
+    cache.store("q", [1.0, 0.0], {})
+    clock.now += 59
+    assert cache.lookup([1.0, 0.0]) is not None
+    clock.now += 2
+    assert cache.lookup([1.0, 0.0]) is None
+
+
+def test_zero_ttl_never_expires(clock):
+    cache = SemanticCache(threshold=0.9, ttl=0)
+    cache.store("q", [1.0, 0.0], {})
+    clock.now += 10 ** 6
+    assert cache.lookup([1.0, 0.0]) is not None
+
+
+def test_full_cache_evicts_least_recently_used(clock):
+    cache = SemanticCache(max_entries=2, threshold=0.99)
+    cache.store("a", [1.0, 0.0, 0.0], {})
+    clock.now += 1
+    cache.store("b", [0.0, 1.0, 0.0], {})
+    clock.now += 1
+    assert cache.lookup([1.0, 0.0, 0.0])["question"] == "a"
+    clock.now += 1
+    cache.store("c", [0.0, 0.0, 1.0], {})
+
+    assert cache.lookup([0.0, 1.0, 0.0]) is None
+    assert cache.lookup([1.0, 0.0, 0.0])["question"] == "a"
+    assert cache.lookup([0.0, 0.0, 1.0])["question"] == "c"
+
+
+def test_expired_best_match_does_not_hide_valid_second_best(clock):
+    cache = SemanticCache(threshold=0.9, ttl=60)
+    cache.store("旧问题", [1.0, 0.0], {"answer": "old"})
+    clock.now += 50
+    cache.store("新问题", [0.97, 0.2], {"answer": "new"})
+    clock.now += 20
+
+    hit = cache.lookup([1.0, 0.0])
+    assert hit["question"] == "新问题"
+    assert cache.stats()["entries"] == 1
+
+
+def test_store_reuses_expired_slots_before_evicting_live_entries(clock):
+    cache = SemanticCache(max_entries=2, threshold=0.99, ttl=60)
+    cache.store("a", [1.0, 0.0, 0.0], {})
+    clock.now += 30
+    cache.store("b", [0.0, 1.0, 0.0], {})
+    clock.now += 40
+    cache.store("c", [0.0, 0.0, 1.0], {})
+
+    assert cache.lookup([0.0, 1.0, 0.0])["question"] == "b"
+    assert cache.lookup([0.0, 0.0, 1.0])["question"] == "c"
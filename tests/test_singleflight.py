@@ -0,0 +1,150 @@
+"""SingleFlight：并发相同 key 合并为一次计算，等待者超时后自行执行或走降级回调"""
+import threading
+import time
+
+import pytest
+
+import singleflight
+from singleflight import SingleFlight, budget_bucket, follower_wait, normalize_query
+
+
+def _start_leader(flight, key, result="leader"):
+    """启动一个阻塞在计算中的 leader，返回 (放行事件, 线程, 结果列表)。"""
+    entered = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def slow():
+        entered.set()
+        release.wait(5)
+        if isinstance(result, BaseException):
+            raise result
+        return {"value": result}
+
+    def run():
+        try:
+            results.append(flight.do(key, slow))
+        except BaseException as e:
+            results.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert entered.wait(5)
+    return release, thread, results
+
+
+def _wait_coalesced(flight, count):
+    deadline = time.monotonic() + 5
+    while flight.stats()["coalesced"] < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def _follow(flight, key, fn, **kwargs):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(flight.do(key, fn, **kwargs)))
+    thread.start()
+    return thread, results
+
+
+def test_followers_share_the_leader_result():
+    flight = SingleFlight()
+    release, leader, leader_results = _start_leader(flight, "k")
+    followers = [_follow(flight, "k", lambda: {"value": "own"}) for _ in range(3)]
+    _wait_coalesced(flight, 3)
+    release.set()
+    leader.join()
+    for thread, _ in followers:
+        thread.join()
+
+    assert leader_results == [({"value": "leader"}, False)]
+    assert [results[0] for _, results in followers] == [({"value": "leader"}, True)] * 3
+    assert flight.stats() == {"in_flight": 0, "coalesced": 3, "wait_timeouts": 0}
+
+
+def test_followers_get_independent_copies():
+    flight = SingleFlight()
+    release, leader, _ = _start_leader(flight, "k")
+    followers = [_follow(flight, "k", lambda: None) for _ in range(2)]
+    _wait_coalesced(flight, 2)
+    release.set()
+    leader.join()
+    for thread, _ in followers:
+        thread.join()
+
+    first, second = (results[0][0] for _, results in followers)
+    first["value"] = "changed"
+    assert second["value"] == "leader"
+
+
+def test_leader_error_propagates_to_followers():
+    flight = SingleFlight()
+    release, leader, leader_results = _start_leader(flight, "k", result=ValueError("boom"))
+    errors = []
+
+    def follow():
+        try:
+            flight.do("k", lambda: "own")
+        except ValueError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=follow)
+    thread.start()
+    _wait_coalesced(flight, 1)
+    release.set()
+    leader.join()
+    thread.join()
+
+    assert isinstance(leader_results[0], ValueError)
+    assert len(errors) == 1
+
+
+def test_wait_timeout_runs_fn_itself():
+    flight = SingleFlight()
+    release, leader, _ = _start_leader(flight, "k")
+    try:
+        result = flight.do("k", lambda: "own", wait_timeout=0.05)
+    finally:
+        release.set()
+        leader.join()
+
+    assert result == ("own", False)
+    assert flight.stats()["wait_timeouts"] == 1
+
+
+def test_wait_timeout_prefers_on_timeout_callback():
+    flight = SingleFlight()
+    release, leader, _ = _start_leader(flight, "k")
+    calls = []
+    try:
+        result = flight.do(
+            "k", lambda: calls.append("fn"), wait_timeout=0.0, on_timeout=lambda: "degraded"
+        )
+    finally:
+        release.set()
+        leader.join()
+
+    assert result == ("degraded", False)
+    assert calls == []
+
+
+def test_key_is_released_after_completion():
+    flight = SingleFlight()
+    assert flight.do("k", lambda: 1) == (1, False)
+    assert flight.do("k", lambda: 2) == (2, False)
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_normalize_query_and_budget_bucket(monkeypatch):
+    assert normalize_query("  ＲＲＦ   是什么 ") == "rrf 是什么"
+    monkeypatch.setattr(singleflight, "SINGLEFLIGHT_BUDGET_BUCKET_MS", 1000)
+    assert budget_bucket(None) is None
+    assert budget_bucket(2500) == 2
+    assert budget_bucket(-10) == 0
+
+
+@pytest.mark.parametrize("fraction,budget_ms,expected", [(0.5, 2000, 1.0), (2.0, 1000, 1.0), (0.5, -5, 0.0)])
+def test_follower_wait_is_capped_by_budget_fraction(monkeypatch, fraction, budget_ms, expected):
+    monkeypatch.setattr(singleflight, "SINGLEFLIGHT_WAIT_FRACTION", fraction)
+    assert follower_wait(budget_ms) == pytest.approx(expected)
+    assert follower_wait(None) is None
@@ -0,0 +1,98 @@
+"""EmbeddingService 稀疏词项：中文单字 / 双字切分、停用字与查询侧孤立单字扩展"""
+import pytest
+
+from embedding import EmbeddingService
+
+
+def _service(monkeypatch, **kwargs):
+    monkeypatch.delenv("SPARSE_STOP_CHARS", raising=False)
+    monkeypatch.delenv("SPARSE_SINGLE_CHAR_EXPAND", raising=False)
+    return EmbeddingService(persist_stats=False, **kwargs)
+
+
+def test_unigram_mode_splits_cjk_and_keeps_english_words(monkeypatch):
+    service = _service(monkeypatch, cjk_ngram=1, drop_stop_chars=False)
+    assert service.sparse_terms("Milvus 混合检索!") == ["milvus", "混", "合", "检", "索"]
+
+
+def test_bigram_mode(monkeypatch):
+    service = _service(monkeypatch, cjk_ngram=2, drop_stop_chars=False)
+    assert service.sparse_terms("混合检索 BM25") == ["混合", "合检", "检索", "bm"]
+
+
+def test_bigrams_do_not_span_non_cjk_runs(monkeypatch):
+    service = _service(monkeypatch, cjk_ngram=2, drop_stop_chars=False)
+    assert service.sparse_terms("向量，索引") == ["向量", "索引"]
+
+
+def test_stop_chars_split_segments(monkeypatch):
+    service = _service(monkeypatch, cjk_ngram=2, drop_stop_chars=True)
+    # "的" 被去除并切断前后两段，不会拼出 "量的" / "的索"
+    assert service.sparse_terms("向量的索引") == ["向量", "索引"]
+    assert service.sparse_terms("猫的") == ["猫"]
+
+
+def test_stop_chars_dropped_in_unigram_mode(monkeypatch):
+    service = _service(monkeypatch, cjk_ngram=1, drop_stop_chars=True)
+    assert service.sparse_terms("向量的索引") == ["向", "量", "索", "引"]
+
+
+def _score(query_vector, doc_vector):
+    return sum(weight * doc_vector.get(idx, 0.0) for idx, weight in query_vector.items())
+
+
+CORPUS = ["小猫咪很可爱", "猫粮价格上涨", "狗狗喜欢散步"]
+
+
+def test_single_char_query_matches_bigram_indexed_docs(monkeypatch):
+    service = _service(monkeypatch, cjk_ngram=2, drop_stop_chars=False)
+    service.fit_corpus(CORPUS)
+    docs = service.get_sparse_embeddings(CORPUS)
+    query = service.get_sparse_embedding("猫")
+
+    scores = [_score(query, doc) for doc in docs]
+    assert scores[0] > 0 and scores[1] > 0
+    assert scores[2] == 0
+
+
+def test_single_char_expansion_can_be_disabled(monkeypatch):
+    service = _service(monkeypatch, cjk_ngram=2, drop_stop_chars=False)
+    service.single_char_expand = 0
+    service.fit_corpus(CORPUS)
+    docs = service.get_sparse_embeddings(CORPUS)
+    query = service.get_sparse_embedding("猫")
+
+    assert all(_score(query, doc) == 0 for doc in docs)
+
+
+def test_single_char_expansion_keeps_most_frequent_bigrams(monkeypatch):
+    service = _service(monkeypatch, cjk_ngram=2, drop_stop_chars=False)
+    service.single_char_expand = 1
+    service.fit_corpus(["猫粮", "猫粮", "小猫"])
+
+    assert service._expand_single_char("猫") == ["猫粮"]
+
+
+def test_document_vectors_are_not_expanded(monkeypatch):
+    service = _service(monkeypatch, cjk_ngram=2, drop_stop_chars=False)
+    service.fit_corpus(["小猫咪"])
+    doc = service.get_sparse_embeddings(["猫"])[0]
+
+    assert len(doc) == 1
+
+
+@pytest.mark.parametrize("ngram", [1, 2])
+def test_expansion_index_survives_stats_round_trip(monkeypatch, ngram):
+    service = _service(monkeypatch, cjk_ngram=ngram, drop_stop_chars=False)
+    service.fit_corpus(CORPUS)
+    reloaded = _service(monkeypatch, cjk_ngram=ngram, drop_stop_chars=False)
+    reloaded.load_stats(service.export_stats())
+
+    assert reloaded.get_sparse_embedding("猫") == service.get_sparse_embedding("猫")
+
+
+def test_stats_with_different_ngram_are_rejected(monkeypatch):
+    service = _service(monkeypatch, cjk_ngram=2, drop_stop_chars=False)
+    other = _service(monkeypatch, cjk_ngram=1, drop_stop_chars=False)
+    with pytest.raises(ValueError):
+        other.load_stats(service.export_stats())
@@ -0,0 +1,165 @@
+"""离线标定 Milvus 检索参数（MILVUS_SEARCH_EF / MILVUS_SPARSE_DROP_RATIO）。
+
+用法：
+    python tune_search_params.py [queries.jsonl] [--target 0.95] [--top-k 15] [--samples 50]
+
+queries.jsonl 每行一个 JSON：{"question": "..."}；不提供时从叶子分块中随机抽取文本作为查询。
+脚本先拉取全部叶子分块的向量，用 numpy 暴力计算精确 top-k 作为参考答案，
+再对每个候选参数测量召回率（recall@k）与 p50 / p95 延迟：
+    - 稠密路径：在召回率不低于 target 的 ef 中选最小（最快）的；
+    - 稀疏路径：在召回率不低于 target 的 drop_ratio_search 中选最大（最快）的。
+      服务端 BM25 模式（MILVUS_SPARSE_MODE=bm25）下稀疏向量无法取回，以 drop_ratio_search=0 的结果为参考答案。
+top-k 建议取线上实际的候选数（top_k * ADAPTIVE_CANDIDATE_MAX_FACTOR）。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+# 将 backend 路径添加到 sys.path，以便导入 RAG 模块
+sys.path.append(os.path.join(os.path.dirname(__file__), "backend"))
+from rag_utils import LEAF_RETRIEVE_LEVEL, _embedding_service, _milvus_manager, hydrate_leaf_texts
+
+EF_GRID = [16, 32, 48, 64, 96, 128, 192, 256]
+DROP_RATIO_GRID = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5]
+
+
+def load_leaves(filter_expr: str, with_sparse: bool) -> tuple[list[str], list[str], np.ndarray, list[dict]]:
+    """分批拉取叶子分块，返回 (chunk_id, text, 稠密向量矩阵, 稀疏向量)。"""
+    output_fields = ["chunk_id", "text", "dense_embedding"] + (["sparse_embedding"] if with_sparse else [])
+    iterator = _milvus_manager.client.query_iterator(
+        collection_name=_milvus_manager.collection_name,
+        batch_size=1000,
+        filter=filter_expr,
+        output_fields=output_fields,
+    )
+    chunk_ids, texts, dense, sparse = [], [], [], []
+    try:
+        while True:
+            batch = iterator.next()
+            if not batch:
+                break
+            for row in batch:
+                chunk_ids.append(row["chunk_id"])
+                texts.append(row.get("text", ""))
+                dense.append(row["dense_embedding"])
+                sparse.append({int(k): float(v) for k, v in (row.get("sparse_embedding") or {}).items()})
+    finally:
+        iterator.close()
+    return chunk_ids, hydrate_leaf_texts(chunk_ids, texts), np.asarray(dense, dtype=np.float32), sparse
+
+
+def load_queries(path: str | None, texts: list[str], samples: int) -> list[str]:
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            return [json.loads(line)["question"] for line in f if line.strip()]
+    rng = random.Random(42)
+    picked = rng.sample(texts, min(samples, len(texts)))
+    # 取分块开头一段作为查询，近似用户问题的长度
+    return [text[:64] for text in picked if text]
+
+
+def exact_dense(query_vectors: np.ndarray, matrix: np.ndarray, chunk_ids: list[str], top_k: int) -> list[set]:
+    scores = query_vectors @ matrix.T
+    return [{chunk_ids[i] for i in np.argsort(-row)[:top_k]} for row in scores]
+
+
+def exact_sparse(query_sparse: list[dict], corpus: list[dict], chunk_ids: list[str], top_k: int) -> list[set]:
+    truths = []
+    for query in query_sparse:
+        scores = np.array([sum(value * doc.get(idx, 0.0) for idx, value in query.items()) for doc in corpus])
+        truths.append({chunk_ids[i] for i in np.argsort(-scores)[:top_k] if scores[i] > 0})
+    return truths
+
+
+def measure(search_fn, queries: list, truths: list[set]) -> tuple[float, float, float]:
+    """返回 (平均召回率, p50 毫秒, p95 毫秒)。"""
+    recalls, latencies = [], []
+    for query, truth in zip(queries, truths):
+        started = time.perf_counter()
+        hits = search_fn(query)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if truth:
+            recalls.append(len(truth & {hit["chunk_id"] for hit in hits}) / len(truth))
+    recall = float(np.mean(recalls)) if recalls else 1.0
+    return recall, float(np.percentile(latencies, 50)), float(np.percentile(latencies, 95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按召回率目标标定 Milvus 检索参数")
+    parser.add_argument("queries", nargs="?", help="JSONL 文件，每行包含 question；缺省时从叶子分块抽样")
+    parser.add_argument("--target", type=float, default=0.95, help="最低平均召回率")
+    parser.add_argument("--top-k", type=int, default=15, help="评估召回率的候选数")
+    parser.add_argument("--samples", type=int, default=50, help="抽样查询数（未提供 queries 时）")
+    args = parser.parse_args()
+
+    filter_expr = f"chunk_level == {LEAF_RETRIEVE_LEVEL}"
+    server_bm25 = _milvus_manager.uses_server_bm25()
+    chunk_ids, texts, matrix, corpus_sparse = load_leaves(filter_expr, with_sparse=not server_bm25)
+    if not chunk_ids:
+        print("知识库中没有叶子分块")
+        return
+    queries = load_queries(args.queries, texts, args.samples)
+    if not queries:
+        print("没有可用查询")
+        return
+    print(f"叶子分块：{len(chunk_ids)}，查询数：{len(queries)}，top_k：{args.top_k}")
+
+    query_dense = _embedding_service.get_embeddings(queries)
+    dense_truths = exact_dense(np.asarray(query_dense, dtype=np.float32), matrix, chunk_ids, args.top_k)
+    if server_bm25:
+        query_sparse = queries
+
+        def sparse_search(query, drop_ratio):
+            return _milvus_manager.sparse_retrieve(
+                query_text=query, top_k=args.top_k, filter_expr=filter_expr, search_params={"drop_ratio_search": drop_ratio}
+            )
+
+        sparse_truths = [{hit["chunk_id"] for hit in sparse_search(query, 0.0)} for query in queries]
+    else:
+        query_sparse = [_embedding_service.get_sparse_embedding(query) for query in queries]
+
+        def sparse_search(query, drop_ratio):
+            return _milvus_manager.sparse_retrieve(
+                query, top_k=args.top_k, filter_expr=filter_expr, search_params={"drop_ratio_search": drop_ratio}
+            )
+
+        sparse_truths = exact_sparse(query_sparse, corpus_sparse, chunk_ids, args.top_k)
+
+    print("\n稠密路径（HNSW ef）：")
+    best_ef = None
+    for ef in EF_GRID:
+        recall, p50, p95 = measure(
+            lambda q: _milvus_manager.dense_retrieve(q, top_k=args.top_k, filter_expr=filter_expr, search_params={"ef": ef}),
+            query_dense,
+            dense_truths,
+        )
+        print(f"  ef={ef:<4} recall={recall:.3f} p50={p50:.1f}ms p95={p95:.1f}ms")
+        if best_ef is None and recall >= args.target:
+            best_ef = ef
+
+    print("\n稀疏路径（drop_ratio_search）：")
+    best_drop = None
+    for drop_ratio in DROP_RATIO_GRID:
+        recall, p50, p95 = measure(lambda q: sparse_search(q, drop_ratio), query_sparse, sparse_truths)
+        print(f"  drop_ratio={drop_ratio:<4} recall={recall:.3f} p50={p50:.1f}ms p95={p95:.1f}ms")
+        if recall >= args.target:
+            best_drop = drop_ratio
+
+    print()
+    if best_ef is None:
+        print(f"没有 ef 能达到召回率 {args.target}，建议保持 MILVUS_SEARCH_EF={EF_GRID[-1]} 或检查索引参数")
+    else:
+        print(f"MILVUS_SEARCH_EF={best_ef}")
+    if best_drop is None:
+        print(f"没有 drop_ratio 能达到召回率 {args.target}，建议 MILVUS_SPARSE_DROP_RATIO=0.0")
+    else:
+        print(f"MILVUS_SPARSE_DROP_RATIO={best_drop}")
+
+
+if __name__ == "__main__":
+    main()